@@ -1,26 +1,49 @@
 # Install necessary libraries
-!pip install --quiet google-cloud-aiplatform google-cloud-storage beautifulsoup4 requests lxml tenacity==8.2.2
+!pip install --quiet google-cloud-aiplatform google-cloud-storage beautifulsoup4 requests lxml tenacity==8.2.2 numpy pyarrow pillow
 
 # Import libraries
+import asyncio
+import concurrent.futures
+import gzip
+import io
 import json
+import numpy as np
+import math
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+from lxml import etree
+from PIL import Image, ImageOps
 from google.colab import auth
 from google.cloud import aiplatform
 from google.cloud import storage
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import GenerationConfig, GenerativeModel, Part
+from vertexai.preview import caching
 import random
+import re
 import time
 import uuid
 import datetime
-from tenacity import retry, stop_after_attempt, wait_exponential
+import collections
+import collections.abc
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import urllib.parse
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 # Authenticate to Google Cloud
 auth.authenticate_user()
 print("Authenticated to Google Cloud.")
 
+# Dry-run mode: annotations are printed instead of uploaded. A notebook cell may set DRYRUN beforehand
+DRYRUN = globals().get('DRYRUN', False)
+
 # Set up your Google Cloud project and location
 PROJECT_ID = 'veg3-424503'  # Replace with your actual project ID
 LOCATION = 'us-central1'        # Replace with your desired Google Cloud region
@@ -154,26 +177,13 @@ based on their complete profile of characteristics.
 '''
 
 # Initialize the GenerativeModel.
-GENERATIVE_MODEL = GenerativeModel("gemini-1.5-pro", system_instruction=SYSTEM_INSTRUCTION)
+MODEL_NAME = "gemini-1.5-pro"
+GENERATIVE_MODEL = GenerativeModel(MODEL_NAME, system_instruction=SYSTEM_INSTRUCTION)
 print("Generative model initialized.")
 
-# Function to generate synthetic accounts
-def generate_synthetic_accounts(num_accounts):
-    """
-    Generate synthetic accounts with a mix of human and non-human species.
-
-    Args:
-        num_accounts (int): Number of accounts to generate.
-
-    Returns:
-        list: A list of dictionaries representing synthetic accounts.
-    """
-    accounts = []
-    print(f"Generating {num_accounts} synthetic accounts...")
-
-    # Define species categories
-    human_species = ['Human']
-    non_human_species = [
+# Persona option tables
+HUMAN_SPECIES = ['Human']
+NON_HUMAN_SPECIES = [
     'Dog', 'Cat', 'Cow', 'Pig', 'Chicken', 'Sheep', 'Goat', 'Horse', 'Donkey', 'Mule', 'Duck', 'Goose', 'Turkey',
     'Rabbit', 'Guinea Pig', 'Hamster', 'Ferret', 'Mouse', 'Rat', 'Chimpanzee', 'Rhesus Monkey', 'Marmoset', 'Gorilla',
     'Orangutan', 'Baboon', 'Sloth', 'Armadillo', 'Raccoon', 'Badger', 'Wolverine', 'Hyena', 'Coyote', 'Moose', 'Elk',
@@ -237,51 +247,51 @@ def generate_synthetic_accounts(num_accounts):
     'Godwit', 'Avocet', 'Stilt', 'Phalarope', 'Grouse', 'Ptarmigan', 'Pheasant', 'Quail', 'Turkey', 'Partridge', 'Peafowl',
     'Guinea Fowl', 'Rhea', 'Emu', 'Cassowary', 'Kiwi', 'Penguin', 'Silkworm', 'Honeybee', 'Bumblebee', 'Hornworm',
     'Waxworm', 'Black Soldier Fly', 'Ladybug', 'Predatory Mites', 'Parasitic Wasps', 'Nematodes', 'Hoverflies', 'Lacewings'
-    ]
+]
 
-    # Define roles for humans and non-humans
-    human_roles = [
-        'Volunteer for an Animal Advocacy Organisation',
-        'Donor to an Animal Advocacy Organisation',
-        'Staff Member of an Animal Advocacy Organisation',
-        'Researcher Studying Animal Advocacy Issues',
-        'Independent Animal Advocate',
-        'Animal Lawyer or Legal Advocate',
-        'Animal Carer or Rescuer',
-        'Vegan Influencer, Blogger or Content Creator',
-        'Owner of a Vegan or Cruelty-Free Company',
-        'Staff Member of a Vegan or Cruelty-Free Company',
-        'Investor in a Vegan or Cruelty-Free Company',
-        'Animal Rights Activist',
-        'Environmental Advocate',
-        'Wildlife Conservationist'
-    ]
+# Define roles for humans and non-humans
+HUMAN_ROLES = [
+    'Volunteer for an Animal Advocacy Organisation',
+    'Donor to an Animal Advocacy Organisation',
+    'Staff Member of an Animal Advocacy Organisation',
+    'Researcher Studying Animal Advocacy Issues',
+    'Independent Animal Advocate',
+    'Animal Lawyer or Legal Advocate',
+    'Animal Carer or Rescuer',
+    'Vegan Influencer, Blogger or Content Creator',
+    'Owner of a Vegan or Cruelty-Free Company',
+    'Staff Member of a Vegan or Cruelty-Free Company',
+    'Investor in a Vegan or Cruelty-Free Company',
+    'Animal Rights Activist',
+    'Environmental Advocate',
+    'Wildlife Conservationist'
+]
 
-    # Non-human roles as phrases
-    non_human_roles = [
-        'living in the wild',
-        'in captivity',
-        'on a farm',
-        'in a factory farm',
-        'in a research lab',
-        'in a sanctuary',
-        'in a zoo',
-        'used for entertainment',
-        'used for work',
-        'kept as a companion animal'
-    ]
+# Non-human roles as phrases
+NON_HUMAN_ROLES = [
+    'living in the wild',
+    'in captivity',
+    'on a farm',
+    'in a factory farm',
+    'in a research lab',
+    'in a sanctuary',
+    'in a zoo',
+    'used for entertainment',
+    'used for work',
+    'kept as a companion animal'
+]
 
-    # Define all possible options for text fields
-    advocate_options = ['Yes', 'No']
-    lifestyle_options = [
-        'Vegan', 'Vegetarian', 'Omnivore', 'Pescatarian', 'Flexitarian', 'Raw Vegan', 'Paleo', 'Keto'
-    ]
-    genders = [
+# Define all possible options for text fields
+ADVOCATE_OPTIONS = ['Yes', 'No']
+LIFESTYLE_OPTIONS = [
+    'Vegan', 'Vegetarian', 'Omnivore', 'Pescatarian', 'Flexitarian', 'Raw Vegan', 'Paleo', 'Keto'
+]
+GENDERS = [
     'Male', 'Female', 'Non-binary', 'Genderqueer', 'Agender', 'Bigender', 'Genderfluid', 'Demiboy', 'Demigirl',
     'Gender Nonconforming', 'Two-Spirit', 'Androgynous', 'Pangender', 'Transgender Man', 'Transgender Woman',
     'Transmasculine', 'Transfeminine', 'Neutrois', 'Intersex', 'Third Gender', 'Questioning'
-    ]
-    ethnicities = [
+]
+ETHNICITIES = [
     'Asian', 'Black', 'Hispanic or Latino', 'White', 'Middle Eastern', 'Native American', 'Pacific Islander',
     'Arab', 'Persian', 'Kurdish', 'Assyrian', 'Armenian', 'Berber', 'Druze', 'Coptic', 'Yazidi',
     'Afro-Caribbean', 'Afro-Latino', 'African American', 'Ethiopian', 'Somali', 'Hausa', 'Yoruba', 'Igbo', 'Zulu',
@@ -327,8 +337,8 @@ def generate_synthetic_accounts(num_accounts):
     'Romani', 'Traveler', 'Gothic', 'Viking', 'Norse', 'Sami', 'Lapp',
     'African Arab', 'Bedouin', 'Fulani', 'Tuareg',
     'Mestizo', 'Mulatto', 'Zambo', 'Castizo'
-    ]
-    countries = [
+]
+COUNTRIES = [
     'Afghanistan', 'Albania', 'Algeria', 'Andorra', 'Angola', 'Antigua and Barbuda', 'Argentina', 'Armenia',
     'Australia', 'Austria', 'Azerbaijan', 'Bahamas', 'Bahrain', 'Bangladesh', 'Barbados', 'Belarus', 'Belgium',
     'Belize', 'Benin', 'Bhutan', 'Bolivia', 'Bosnia and Herzegovina', 'Botswana', 'Brazil', 'Brunei', 'Bulgaria',
@@ -353,8 +363,8 @@ def generate_synthetic_accounts(num_accounts):
     'Tonga', 'Trinidad and Tobago', 'Tunisia', 'Turkey', 'Turkmenistan', 'Tuvalu', 'Uganda', 'Ukraine',
     'United Arab Emirates', 'United Kingdom', 'United States', 'Uruguay', 'Uzbekistan', 'Vanuatu', 'Vatican City',
     'Venezuela', 'Vietnam', 'Yemen', 'Zambia', 'Zimbabwe'
-    ]
-    education_levels = [
+]
+EDUCATION_LEVELS = [
     'No Formal Education', 'Some Primary Education', 'Completed Primary Education', 'Some Secondary Education',
     'Completed Secondary Education', 'High School Diploma', 'GED', 'Vocational Training', 'Technical Diploma',
     'Associate Degree', 'Some College', 'Bachelor\'s Degree', 'Honors Bachelor\'s Degree', 'Postgraduate Diploma',
@@ -363,12 +373,12 @@ def generate_synthetic_accounts(num_accounts):
     'Professional Degree (MD)', 'Professional Degree (DDS)', 'Professional Degree (DVM)', 'Postdoctoral Research',
     'Trade School Certification', 'Apprenticeship', 'Adult Education Programs', 'Online Courses',
     'Community College Diploma', 'Military Training', 'Self-Education', 'Alternative Education', 'Continuing Education'
-    ]
-    income_levels = [
+]
+INCOME_LEVELS = [
     'Below Poverty Line', 'Very Low', 'Low', 'Lower-Middle', 'Middle', 'Upper-Middle', 'Comfortable',
     'Affluent', 'High', 'Very High', 'Wealthy', 'Ultra-High Net Worth'
-    ]
-    political_affiliations = [
+]
+POLITICAL_AFFILIATIONS = [
     'Far-Left', 'Left', 'Center-Left', 'Socialist', 'Democratic Socialist', 'Progressive',
     'Liberal', 'Centrist', 'Center', 'Moderate', 'Center-Right', 'Conservative', 'Right', 'Far-Right',
     'Libertarian', 'Anarchist', 'Authoritarian', 'Populist', 'Nationalist', 'Environmentalist',
@@ -379,8 +389,8 @@ def generate_synthetic_accounts(num_accounts):
     'Monarchist', 'Theocrat', 'Reactionary', 'Progressive Conservative', 'Paleoconservative',
     'Neo-Liberal', 'Radical', 'Social Liberal', 'Economic Liberal', 'Ethno-Nationalist', 'Sovereigntist',
     'Anti-Establishment', 'Feminist', 'Labor Unionist', 'Humanist', 'Anti-Globalist', 'Pro-Globalist'
-    ]
-    religious_affiliations = [
+]
+RELIGIOUS_AFFILIATIONS = [
     'Christianity', 'Catholicism', 'Protestantism', 'Orthodox Christianity', 'Evangelical Christianity', 'Pentecostalism',
     'Latter-day Saints (Mormonism)', 'Anglicanism', 'Baptist', 'Methodism', 'Lutheranism', 'Presbyterianism',
     'Eastern Orthodox', 'Coptic Christianity', 'Islam', 'Sunni Islam', 'Shia Islam', 'Sufism', 'Ahmadiyya',
@@ -394,62 +404,319 @@ def generate_synthetic_accounts(num_accounts):
     'Gnosticism', 'Pantheism', 'Panentheism', 'Esoteric Beliefs', 'Diverse Indigenous Religions',
     'African Traditional Religions', 'Candomblé', 'Umbanda', 'Native American Spirituality',
     'Australian Aboriginal Spirituality', 'Juche', 'Falun Gong', 'Raelism', 'Pastafarianism (Church of the Flying Spaghetti Monster)'
-    ]
+]
+
+# Persona pool settings
+PERSONA_POOL_SEED = 42  # Seed for reproducible persona pools; None draws a fresh pool every run
+PERSONA_MATERIALIZED_CACHE_SIZE = 10000  # Materialized account dicts kept per pool
+EMBED_PERSONA_IN_OUTPUT = False  # True embeds the full synthetic account in every output record
+PERSONA_CATALOG_BUCKET_NAME = OUTPUT_BUCKET_NAME
+PERSONA_CATALOG_PREFIX = 'persona-catalogs/'
+
+# Categorical fields of human personas, in account dict order, with their option tables
+HUMAN_CATEGORICAL_FIELDS = [
+    ('role_in_animal_advocacy', HUMAN_ROLES),
+    ('advocate_for_animals', ADVOCATE_OPTIONS),
+    ('current_lifestyle_diet', LIFESTYLE_OPTIONS),
+    ('gender', GENDERS),
+    ('ethnicity', ETHNICITIES),
+    ('country', COUNTRIES),
+    ('education_level', EDUCATION_LEVELS),
+    ('income_level', INCOME_LEVELS),
+    ('political_affiliation', POLITICAL_AFFILIATIONS),
+    ('religious_affiliation', RELIGIOUS_AFFILIATIONS),
+]
+
+# Approach to animal advocacy (Scales from 0 to 1)
+ADVOCACY_SCALE_FIELDS = [
+    'incrementalist_vs_abolitionist',
+    'individual_vs_institutional',
+    'solely_on_animal_activism_vs_intersectional',
+    'focus_on_welfare_vs_rights',
+    'diplomatic_vs_confrontational',
+    'intuitive_vs_empirical_effectiveness',
+]
+
+# Psychometrics (Scales from 0 to 1)
+PSYCHOMETRIC_SCALE_FIELDS = [
+    'openness_to_experience',
+    'conscientiousness',
+    'extraversion',
+    'agreeableness',
+    'neuroticism',
+]
+
+# Columnar pool of synthetic personas
+class PersonaPool:
+    """
+    Struct-of-arrays pool of synthetic personas. Every attribute is stored as a NumPy column
+    (categorical fields as small-integer codes into the option tables, 0-1 scales as
+    hundredths), and accounts are only materialized into the usual dict shape when indexed.
+
+    The pool behaves like a read-only sequence of personas: len(pool) and pool[i], where each
+    item is a Persona that can be used wherever an account dict is expected.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self._materialized = collections.OrderedDict()
+        self._catalog_id = None
+        self._id_order = None
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("persona index out of range")
+        return Persona(self, index)
+
+    @property
+    def catalog_id(self):
+        """
+        str: Content hash identifying this pool's persona catalog.
+        """
+        if self._catalog_id is None:
+            digest = hashlib.sha256()
+            for name in sorted(self.columns):
+                digest.update(name.encode('utf-8'))
+                digest.update(np.ascontiguousarray(self.columns[name]).tobytes())
+            self._catalog_id = digest.hexdigest()[:16]
+        return self._catalog_id
+
+    def index_of(self, persona_id):
+        """
+        Find the pool index of a persona by its ID.
+
+        Args:
+            persona_id (int): The persona ID.
+
+        Returns:
+            int: The pool index.
 
-    # Generate accounts
-    for i in range(num_accounts):
-        id = random.randint(1_000_000, 9_999_999)
-        account = {}
-        # ID
-        account['id'] = id
-        # E-mail
-        account['email'] = f"synthetic_user_{uuid.uuid4()}@example.com"
-        # First Name
-        account['first_name'] = f"FirstName-{id}"
-        # Last Name
-        account['last_name'] = f"LastName-{id}"
-
-        # Randomly choose species
-        if random.random() < 0.5:
-            # Human account
-            account['species'] = 'Human'
-            # Assign human roles
-            account['role_in_animal_advocacy'] = random.choice(human_roles)
-            # Assign human-specific attributes
-            account['advocate_for_animals'] = random.choice(advocate_options)
-            account['current_lifestyle_diet'] = random.choice(lifestyle_options)
-            account['age'] = random.randint(18, 90)
-            account['gender'] = random.choice(genders)
-            account['ethnicity'] = random.choice(ethnicities)
-            account['country'] = random.choice(countries)
-            account['education_level'] = random.choice(education_levels)
-            account['income_level'] = random.choice(income_levels)
-            account['political_affiliation'] = random.choice(political_affiliations)
-            account['religious_affiliation'] = random.choice(religious_affiliations)
-
-            # Approach to animal advocacy (Scales from 0 to 1)
-            account['incrementalist_vs_abolitionist'] = round(random.uniform(0,1),2)
-            account['individual_vs_institutional'] = round(random.uniform(0,1),2)
-            account['solely_on_animal_activism_vs_intersectional'] = round(random.uniform(0,1),2)
-            account['focus_on_welfare_vs_rights'] = round(random.uniform(0,1),2)
-            account['diplomatic_vs_confrontational'] = round(random.uniform(0,1),2)
-            account['intuitive_vs_empirical_effectiveness'] = round(random.uniform(0,1),2)
-
-            # Psychometrics (Scales from 0 to 1)
-            account['openness_to_experience'] = round(random.uniform(0, 1), 2)
-            account['conscientiousness'] = round(random.uniform(0, 1), 2)
-            account['extraversion'] = round(random.uniform(0, 1), 2)
-            account['agreeableness'] = round(random.uniform(0, 1), 2)
-            account['neuroticism'] = round(random.uniform(0, 1), 2)
+        Raises:
+            KeyError: If no persona in the pool has this ID.
+        """
+        if self._id_order is None:
+            self._id_order = np.argsort(self.columns['id'], kind='stable')
+        ids = self.columns['id']
+        position = np.searchsorted(ids, persona_id, sorter=self._id_order)
+        if position < len(ids) and ids[self._id_order[position]] == persona_id:
+            return int(self._id_order[position])
+        raise KeyError(persona_id)
+
+    def materialize(self, index):
+        """
+        Return the account dict for an index, memoizing recently used ones.
+
+        Args:
+            index (int): The persona index.
+
+        Returns:
+            dict: The synthetic account.
+        """
+        account = self._materialized.get(index)
+        if account is None:
+            account = self.account(index)
+            self._materialized[index] = account
+            if len(self._materialized) > PERSONA_MATERIALIZED_CACHE_SIZE:
+                self._materialized.popitem(last=False)
         else:
-            # Non-human account
-            account['species'] = random.choice(non_human_species)
-            # Assign non-human roles
-            account['role'] = random.choice(non_human_roles)
+            self._materialized.move_to_end(index)
+        return account
+
+    def is_human(self, index):
+        """
+        Check whether the persona at an index is human.
+
+        Args:
+            index (int): The persona index.
+
+        Returns:
+            bool: True for human personas.
+        """
+        return bool(self.columns['is_human'][index])
+
+    def account(self, index):
+        """
+        Materialize the persona at an index into an account dict.
+
+        Args:
+            index (int): The persona index.
+
+        Returns:
+            dict: The synthetic account, in the same shape as generate_synthetic_accounts returns.
+        """
+        columns = self.columns
+        id = int(columns['id'][index])
+        email_uuid = uuid.UUID(int=(int(columns['email_high'][index]) << 64) | int(columns['email_low'][index]),
+                               version=4)
+        account = {
+            'id': id,
+            'email': f"synthetic_user_{email_uuid}@example.com",
+            'first_name': f"FirstName-{id}",
+            'last_name': f"LastName-{id}",
+        }
+        if not columns['is_human'][index]:
+            account['species'] = NON_HUMAN_SPECIES[columns['species'][index]]
+            account['role'] = NON_HUMAN_ROLES[columns['role'][index]]
+            return account
+
+        account['species'] = 'Human'
+        for field, options in HUMAN_CATEGORICAL_FIELDS:
+            account[field] = options[columns[field][index]]
+            if field == 'current_lifestyle_diet':
+                account['age'] = int(columns['age'][index])
+        for field in ADVOCACY_SCALE_FIELDS + PSYCHOMETRIC_SCALE_FIELDS:
+            account[field] = int(columns[field][index]) / 100
+        return account
+
+# Compact reference to one persona in a PersonaPool
+class Persona(collections.abc.Mapping):
+    """
+    A persona stored as a (pool, index) pair. It reads like the account dict it represents
+    (persona['email'], dict(persona), str(persona)), but holds no per-persona data itself;
+    the attributes live as codes in the pool's columns.
+    """
+
+    __slots__ = ('pool', 'index')
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.pool.materialize(self.index)[key]
+
+    def __iter__(self):
+        return iter(self.pool.materialize(self.index))
+
+    def __len__(self):
+        return len(self.pool.materialize(self.index))
+
+    def __repr__(self):
+        return repr(self.pool.materialize(self.index))
+
+    @property
+    def id(self):
+        """
+        int: The persona ID.
+        """
+        return int(self.pool.columns['id'][self.index])
+
+    def reference(self):
+        """
+        Return a reference to this persona in the persona catalog.
+
+        Returns:
+            dict: The catalog ID and persona ID.
+        """
+        return {"catalog": self.pool.catalog_id, "id": self.id}
+
+# Function to serialize a persona pool into a catalog artifact
+def persona_catalog_bytes(pool):
+    """
+    Serialize a persona pool, including its option tables, as a compressed NumPy archive.
 
-        accounts.append(account)
-        print(f"Generated account {i+1}/{num_accounts}: {account['email']}")
+    Args:
+        pool (PersonaPool): The persona pool.
+
+    Returns:
+        bytes: The catalog archive.
+    """
+    option_tables = {field: options for field, options in HUMAN_CATEGORICAL_FIELDS}
+    option_tables['species'] = NON_HUMAN_SPECIES
+    option_tables['role'] = NON_HUMAN_ROLES
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, option_tables=np.array(json.dumps(option_tables)), **pool.columns)
+    return buffer.getvalue()
+
+# Function to load a persona pool from a catalog artifact
+def load_persona_catalog(data):
+    """
+    Load a persona pool from catalog bytes written by persona_catalog_bytes.
+
+    Args:
+        data (bytes): The catalog archive.
+
+    Returns:
+        PersonaPool: The persona pool.
+    """
+    with np.load(io.BytesIO(data)) as archive:
+        columns = {name: archive[name] for name in archive.files if name != 'option_tables'}
+    return PersonaPool(columns)
+
+# Function to write the persona catalog once so output records can reference personas by ID
+def write_persona_catalog(pool):
+    """
+    Upload the persona pool's catalog to the persona catalog bucket, unless it already exists.
+
+    Args:
+        pool (PersonaPool): The persona pool.
+
+    Returns:
+        str: The catalog's blob name.
+    """
+    catalog_name = f"{PERSONA_CATALOG_PREFIX}{pool.catalog_id}.npz"
+    if DRYRUN:
+        print(f"DRYRUN: Would write persona catalog {catalog_name}")
+        return catalog_name
+    catalog_blob = storage_client.bucket(PERSONA_CATALOG_BUCKET_NAME).blob(catalog_name)
+    if catalog_blob.exists():
+        print(f"Persona catalog {catalog_name} already exists.")
+    else:
+        catalog_blob.upload_from_string(persona_catalog_bytes(pool), content_type='application/octet-stream')
+        print(f"Wrote persona catalog {catalog_name} with {len(pool)} personas.")
+    return catalog_name
+
+# Function to generate a columnar pool of synthetic personas
+def generate_persona_pool(num_accounts, seed=PERSONA_POOL_SEED):
+    """
+    Generate a pool of synthetic personas, drawing every column at once with NumPy.
+
+    Args:
+        num_accounts (int): Number of personas to generate.
+        seed (int): Random seed; the same seed always produces the same pool.
+
+    Returns:
+        PersonaPool: The generated persona pool.
+    """
+    print(f"Generating a pool of {num_accounts} synthetic personas (seed={seed})...")
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    columns = {
+        # Unique IDs in the same 7-digit range as individually generated accounts
+        'id': rng.choice(9_000_000, size=num_accounts, replace=False).astype(np.int32) + 1_000_000,
+        'email_high': rng.integers(0, 2 ** 64, size=num_accounts, dtype=np.uint64),
+        'email_low': rng.integers(0, 2 ** 64, size=num_accounts, dtype=np.uint64),
+        'is_human': rng.random(num_accounts) < 0.5,
+        'species': rng.integers(0, len(NON_HUMAN_SPECIES), size=num_accounts, dtype=np.int16),
+        'role': rng.integers(0, len(NON_HUMAN_ROLES), size=num_accounts, dtype=np.int16),
+        'age': rng.integers(18, 91, size=num_accounts, dtype=np.int8),
+    }
+    for field, options in HUMAN_CATEGORICAL_FIELDS:
+        columns[field] = rng.integers(0, len(options), size=num_accounts, dtype=np.int16)
+    for field in ADVOCACY_SCALE_FIELDS + PSYCHOMETRIC_SCALE_FIELDS:
+        columns[field] = np.rint(rng.random(num_accounts) * 100).astype(np.uint8)
+    print(f"Generated {num_accounts} synthetic personas in {time.perf_counter() - start:.2f} seconds.")
+    return PersonaPool(columns)
+
+# Function to generate synthetic accounts
+def generate_synthetic_accounts(num_accounts):
+    """
+    Generate synthetic accounts with a mix of human and non-human species.
 
+    Args:
+        num_accounts (int): Number of accounts to generate.
+
+    Returns:
+        list: A list of dictionaries representing synthetic accounts.
+    """
+    print(f"Generating {num_accounts} synthetic accounts...")
+    pool = generate_persona_pool(num_accounts, seed=None)
+    accounts = [pool.account(index) for index in range(num_accounts)]
     print("Finished generating synthetic accounts.")
     return accounts
 
@@ -475,9 +742,107 @@ def map_scale_to_term(value, low_term, high_term):
     else:
         return f'Highly {high_term}'
 
+# Persona rendering settings
+PERSONA_RENDERING = 'natural'  # 'natural' renders readable persona text; 'dict' sends the raw account dict
+PERSONA_RENDER_CACHE_SIZE = 100000  # Rendered personas memoized by persona ID
+
+# Low/high descriptive terms for each 0-1 scale field
+PERSONA_SCALE_TERMS = {
+    'incrementalist_vs_abolitionist': ('incrementalist', 'abolitionist'),
+    'individual_vs_institutional': ('focused on individual change', 'focused on institutional change'),
+    'solely_on_animal_activism_vs_intersectional': ('single-issue', 'intersectional'),
+    'focus_on_welfare_vs_rights': ('welfare-focused', 'rights-focused'),
+    'diplomatic_vs_confrontational': ('diplomatic', 'confrontational'),
+    'intuitive_vs_empirical_effectiveness': ('intuitive', 'empirical'),
+    'openness_to_experience': ('closed to new experiences', 'open to new experiences'),
+    'conscientiousness': ('spontaneous', 'conscientious'),
+    'extraversion': ('introverted', 'extraverted'),
+    'agreeableness': ('challenging', 'agreeable'),
+    'neuroticism': ('emotionally stable', 'emotionally sensitive'),
+}
+
+RenderedPersona = collections.namedtuple('RenderedPersona', ['text', 'prompt', 'hash'])
+_RENDERED_PERSONAS = collections.OrderedDict()
+
+# Function to describe a persona in compact natural language
+def describe_persona(account):
+    """
+    Describe a synthetic account in compact natural language, using descriptive terms
+    instead of raw 0-1 scale values.
+
+    Args:
+        account (dict): The synthetic account data.
+
+    Returns:
+        str: The persona description.
+    """
+    if account['species'] != 'Human':
+        return f"A {account['species']} {account['role']}."
+    advocacy = "; ".join(
+        map_scale_to_term(account[field], *PERSONA_SCALE_TERMS[field]) for field in ADVOCACY_SCALE_FIELDS
+    )
+    personality = "; ".join(
+        map_scale_to_term(account[field], *PERSONA_SCALE_TERMS[field]) for field in PSYCHOMETRIC_SCALE_FIELDS
+    )
+    return (
+        f"A {account['age']}-year-old {account['gender']} human, {account['ethnicity']}, living in {account['country']}. "
+        f"Role: {account['role_in_animal_advocacy']}. Advocates for animals: {account['advocate_for_animals']}. "
+        f"Diet: {account['current_lifestyle_diet']}. Education: {account['education_level']}. "
+        f"Income: {account['income_level']}. Politics: {account['political_affiliation']}. "
+        f"Religion: {account['religious_affiliation']}.\n"
+        f"Advocacy approach: {advocacy}.\n"
+        f"Personality: {personality}."
+    )
+
+# Function to render a persona once and memoize it by persona ID
+def render_persona(account):
+    """
+    Render the persona block sent to the model, memoized per persona ID, together with a
+    stable hash of the rendered text that prompt and context caches can key on.
+
+    Args:
+        account (dict): The synthetic account data.
+
+    Returns:
+        RenderedPersona: The persona text, the full persona prompt and its hash.
+    """
+    rendered = _RENDERED_PERSONAS.get(account['id'])
+    if rendered is not None:
+        _RENDERED_PERSONAS.move_to_end(account['id'])
+        return rendered
+    text = describe_persona(account) if PERSONA_RENDERING == 'natural' else str(account)
+    rendered = RenderedPersona(text, f"Your synthetic persona details: {text}", hash_text(text)[:16])
+    _RENDERED_PERSONAS[account['id']] = rendered
+    if len(_RENDERED_PERSONAS) > PERSONA_RENDER_CACHE_SIZE:
+        _RENDERED_PERSONAS.popitem(last=False)
+    return rendered
+
+# Function to report the token savings of rendered personas over the raw dict dump
+def report_persona_rendering_savings(accounts, sample_size=1000):
+    """
+    Compare the estimated prompt tokens of rendered personas against the raw dict dump.
+
+    Args:
+        accounts (list): The synthetic accounts (or a PersonaPool).
+        sample_size (int): Maximum number of accounts to measure.
+
+    Returns:
+        dict: Average tokens per persona for both formats and the relative saving.
+    """
+    sample = [accounts[index] for index in range(min(sample_size, len(accounts)))]
+    dict_tokens = sum(estimate_tokens(f"Your synthetic persona details: {account}") for account in sample)
+    rendered_tokens = sum(
+        estimate_tokens(f"Your synthetic persona details: {describe_persona(account)}") for account in sample
+    )
+    count = max(1, len(sample))
+    saving = 1 - rendered_tokens / dict_tokens if dict_tokens else 0
+    print(f"Persona rendering: {dict_tokens / count:.0f} tokens per dict dump vs "
+          f"{rendered_tokens / count:.0f} rendered ({saving:.0%} saved over {len(sample)} personas).")
+    return {'dict_tokens': dict_tokens / count, 'rendered_tokens': rendered_tokens / count, 'saving': saving}
+
 def get_mime_type(url):
     """
-    Determine the MIME type based on the file extension.
+    Determine the MIME type based on the file extension of the URL's path.
 
     Args:
         url (str): The URL of the image file.
@@ -485,7 +850,7 @@ def get_mime_type(url):
     Returns:
         str: The corresponding MIME type.
     """
-    extension = url.lower().split('.')[-1]
+    extension = urllib.parse.urlsplit(url).path.lower().split('.')[-1]
     mime_types = {
         'png': 'image/png',
         'jpg': 'image/jpeg',
@@ -536,25 +901,32 @@ def process_input_data(input_data, account):
     if 'url' in input_data:
         # Handle URL data (could be image or website)
         url = input_data['url']
-        image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp', '.tiff', '.heic', '.heif')
-        if any(ext in url.lower() for ext in image_extensions):
-            # It's an image
+        if is_image_url(url):
+            # It's an image: send the prepared bytes, or the URL if they could not be fetched
             print(f"Processing image: {url}")
+            image_part = IMAGE_CACHE.part(url) if IMAGE_CACHE is not None else None
+            if image_part is None:
+                image_part = Part.from_uri(url, mime_type=get_mime_type(url))
+            if image_part is not False:
+                return [
+                    "Please evaluate the following image: ",
+                    image_part,
+                ], 'image'
+            print(f"{url} is not an image; processing it as a website.")
+
+        # It's a website
+        print(f"Processing website: {url}")
+        website_content = scrape_website(url)
+        if website_content:
+            # Compaction keeps pages below any context cache minimum, so cached runs send them whole
+            if CONTEXT_CACHE is None:
+                website_content = compact_website_content(website_content)
             return [
-                "Please evaluate the following image: ",
-                Part.from_uri(url, mime_type=get_mime_type(url)),
-            ], 'image'
+                "Please evaluate the content of this website: ",
+                website_content
+            ], 'html_content'
         else:
-            # It's a website
-            print(f"Processing website: {url}")
-            website_content = scrape_website(url)
-            if website_content:
-                return [
-                    "Please evaluate the content of this website: ",
-                    website_content
-                ], 'html_content'
-            else:
-                print("ERROR: Website content could not be retrieved.")
+            print("ERROR: Website content could not be retrieved.")
 
     # Unrecognized data format
     print(f"Error processing input data: {json.dumps(input_data)}")
@@ -563,270 +935,4986 @@ def process_input_data(input_data, account):
         json.dumps(input_data)
     ], 'text'
 
-# Function to scrape website content with truncation and relevance focus
-def scrape_website(url, max_chars=100000):
+# HTTP fetch settings
+FETCH_CONNECT_TIMEOUT_SECONDS = 5
+FETCH_READ_TIMEOUT_SECONDS = 15  # Maximum wait for each chunk of the response
+FETCH_TOTAL_TIMEOUT_SECONDS = 30  # Maximum time spent downloading one response body
+FETCH_MAX_BYTES = 5 * 1024 * 1024  # Response bodies are cut off after this many bytes
+FETCH_MAX_CONNECTIONS_PER_HOST = 4  # Concurrent requests (and pooled keep-alive connections) per host
+FETCH_POOLED_HOSTS = 64  # Number of per-host connection pools kept alive
+FETCH_BACKOFF_BASE_SECONDS = 30  # Backoff after a host's first failure; doubles with each further failure
+FETCH_BACKOFF_MAX_SECONDS = 60 * 60
+
+FetchedResponse = collections.namedtuple('FetchedResponse', ['status_code', 'headers', 'content', 'truncated'])
+
+# Shared HTTP client with connection pooling, per-host limits, timeouts and failure backoff
+class HttpFetcher:
+    """
+    Fetch URLs through a shared keep-alive session. Each host gets at most
+    max_connections_per_host concurrent requests, every request has connect/read timeouts
+    and bodies are streamed and cut off after max_bytes. Hosts that keep failing (connection
+    errors, timeouts, 429 or 5xx responses) are skipped with exponential backoff.
+    """
+
+    def __init__(self, max_connections_per_host=FETCH_MAX_CONNECTIONS_PER_HOST, max_bytes=FETCH_MAX_BYTES):
+        self.max_connections_per_host = max_connections_per_host
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=FETCH_POOLED_HOSTS, pool_maxsize=max_connections_per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._host_slots = {}
+        self._host_failures = {}
+
+    def _slots(self, host):
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._host_slots[host]
+
+    def backoff_remaining(self, host):
+        """
+        Return how many seconds a host is still being skipped for.
+
+        Args:
+            host (str): The host name.
+
+        Returns:
+            float: Remaining backoff in seconds (0 if the host may be contacted).
+        """
+        with self._lock:
+            failure = self._host_failures.get(host)
+        if failure is None:
+            return 0
+        return max(0, failure[1] - time.monotonic())
+
+    def _record_failure(self, host):
+        with self._lock:
+            failures = self._host_failures.get(host, (0, 0))[0] + 1
+            delay = min(FETCH_BACKOFF_MAX_SECONDS, FETCH_BACKOFF_BASE_SECONDS * 2 ** (failures - 1))
+            self._host_failures[host] = (failures, time.monotonic() + delay)
+        print(f"Host {host} failed {failures} time(s) in a row; backing off for {delay} seconds.")
+
+    def _record_success(self, host):
+        with self._lock:
+            self._host_failures.pop(host, None)
+
+    def fetch(self, url, headers=None):
+        """
+        Fetch a URL, streaming at most max_bytes of the body.
+
+        Args:
+            url (str): The URL to fetch.
+            headers (dict): Optional request headers.
+
+        Returns:
+            FetchedResponse: The response, or None if the host is backing off or the request failed.
+        """
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        remaining = self.backoff_remaining(host)
+        if remaining > 0:
+            print(f"Skipping {url}: host {host} is backing off for another {remaining:.0f} seconds.")
+            return None
+
+        with self._slots(host):
+            try:
+                with self.session.get(url, headers=headers, stream=True,
+                                      timeout=(FETCH_CONNECT_TIMEOUT_SECONDS, FETCH_READ_TIMEOUT_SECONDS)) as response:
+                    deadline = time.monotonic() + FETCH_TOTAL_TIMEOUT_SECONDS
+                    chunks = []
+                    received = 0
+                    truncated = False
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        chunks.append(chunk)
+                        received += len(chunk)
+                        # Reading past max_bytes tells a body cut off at the limit from one that ends there
+                        if received > self.max_bytes:
+                            truncated = True
+                            break
+                        if time.monotonic() > deadline:
+                            raise requests.Timeout(f"Download exceeded {FETCH_TOTAL_TIMEOUT_SECONDS} seconds")
+                    content = b''.join(chunks)[:self.max_bytes]
+            except requests.RequestException as e:
+                print(f"Request to {url} failed: {e}")
+                self._record_failure(host)
+                return None
+
+        if response.status_code == 429 or response.status_code >= 500:
+            self._record_failure(host)
+        else:
+            self._record_success(host)
+        if truncated:
+            print(f"Response from {url} truncated to {self.max_bytes} bytes.")
+        return FetchedResponse(response.status_code, response.headers, content, truncated)
+
+HTTP_FETCHER = HttpFetcher()
+
+# Website scrape cache settings
+SCRAPE_CACHE_ENABLED = True  # Set to False to always fetch and parse websites
+SCRAPE_CACHE_PATH = 'scrape_cache.sqlite3'
+SCRAPE_CACHE_TTL_SECONDS = 24 * 60 * 60  # Entries older than this are revalidated with a conditional GET
+SCRAPE_CACHE_MAX_BYTES = 200 * 1024 * 1024  # Least recently used entries are evicted beyond this size
+
+# On-disk cache of extracted website text with TTL and ETag/Last-Modified revalidation
+class ScrapeCache:
+    """
+    SQLite-backed cache of the text extracted from websites, keyed by URL. Only the extracted
+    text is stored (never the raw HTML), together with the response's ETag and Last-Modified
+    validators. Once the stored text exceeds max_bytes, the least recently used entries are evicted.
     """
-    Scrape text content from a website, focusing on the main content and truncating to a character limit.
+
+    def __init__(self, path=SCRAPE_CACHE_PATH, ttl_seconds=SCRAPE_CACHE_TTL_SECONDS,
+                 max_bytes=SCRAPE_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "url TEXT PRIMARY KEY, text TEXT NOT NULL, max_chars INTEGER NOT NULL, etag TEXT, "
+            "last_modified TEXT, fetched_at REAL NOT NULL, last_used REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        print(f"Opened scrape cache at {path} ({self._size} bytes).")
+
+    def get(self, url, max_chars):
+        """
+        Look up the cached text for a URL.
+
+        Args:
+            url (str): The URL of the website.
+            max_chars (int): The number of characters the caller needs.
+
+        Returns:
+            dict: The entry (text, etag, last_modified, fresh), or None if there is no usable entry.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT text, max_chars, etag, last_modified, fetched_at FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+            # A shorter truncation than requested cannot be reused
+            if row is None or (row[1] < max_chars and len(row[0]) >= row[1]):
+                return None
+            self._connection.execute("UPDATE pages SET last_used = ? WHERE url = ?", (time.time(), url))
+            self._connection.commit()
+        return {
+            'text': row[0][:max_chars],
+            'etag': row[2],
+            'last_modified': row[3],
+            'fresh': time.time() - row[4] < self.ttl_seconds,
+        }
+
+    def put(self, url, text, max_chars, etag=None, last_modified=None):
+        """
+        Store the extracted text for a URL, evicting least recently used entries if needed.
+
+        Args:
+            url (str): The URL of the website.
+            text (str): The extracted text.
+            max_chars (int): The truncation limit the text was extracted with.
+            etag (str): The response's ETag header, if any.
+            last_modified (str): The response's Last-Modified header, if any.
+        """
+        size = len(text.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            previous = self._connection.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages (url, text, max_chars, etag, last_modified, fetched_at, last_used, size) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, text, max_chars, etag, last_modified, now, now, size)
+            )
+            self._size += size - (previous[0] if previous else 0)
+            while self._size > self.max_bytes:
+                oldest = self._connection.execute(
+                    "SELECT url, size FROM pages ORDER BY last_used LIMIT 1"
+                ).fetchone()
+                if oldest is None:
+                    break
+                self._connection.execute("DELETE FROM pages WHERE url = ?", (oldest[0],))
+                self._size -= oldest[1]
+            self._connection.commit()
+
+    def refresh(self, url):
+        """
+        Mark a cached entry as revalidated (e.g. after a 304 Not Modified response).
+
+        Args:
+            url (str): The URL of the website.
+        """
+        with self._lock:
+            self._connection.execute("UPDATE pages SET fetched_at = ? WHERE url = ?", (time.time(), url))
+            self._connection.commit()
+
+    def report(self):
+        """
+        Print scrape cache statistics.
+        """
+        print(f"Scrape cache: {self.hits} fresh hits, {self.revalidations} revalidated, "
+              f"{self.misses} misses, {self._size} bytes.")
+
+SCRAPE_CACHE = ScrapeCache() if SCRAPE_CACHE_ENABLED else None
+
+# Image preparation settings
+IMAGE_PREPARATION_ENABLED = True  # Fetch, validate and downscale images instead of passing their URLs to the model
+IMAGE_CACHE_PATH = 'image_cache.sqlite3'
+IMAGE_CACHE_MAX_BYTES = 500 * 1024 * 1024  # Least recently used prepared images are evicted beyond this size
+IMAGE_FETCH_MAX_BYTES = 20 * 1024 * 1024  # Larger images are passed to the model by URL
+IMAGE_MAX_DIMENSION = 1536  # Longest side, in pixels, of the images sent to the model
+IMAGE_JPEG_QUALITY = 85
+IMAGE_DUPLICATE_MAX_PIXEL_DIFFERENCE = 4  # Mean grey-level difference (0-255) of thumbnails of merged images
+IMAGE_PARTS_IN_MEMORY = 256  # Prepared parts kept in memory so personas share one Part per image
+MODEL_IMAGE_MIME_TYPES = ('image/png', 'image/jpeg', 'image/webp', 'image/heic', 'image/heif')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp', '.tiff', '.tif', '.heic', '.heif')
+
+PreparedImage = collections.namedtuple('PreparedImage', ['data', 'mime_type', 'content_hash'])
+
+# Function to check whether a URL points to an image file
+def is_image_url(url):
+    """
+    Check whether a URL's path ends in an image file extension (the query string and host
+    name are ignored, so e.g. "https://example.png.org/page" is not an image).
 
     Args:
-        url (str): The URL of the website.
-        max_chars (int): Maximum number of characters to return.
+        url (str): The URL.
 
     Returns:
-        str: The scraped and truncated text content.
+        bool: True if the URL names an image file.
     """
-    print(f"Attempting to scrape website at URL: {url}")
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            print("Website content retrieved successfully.")
-            soup = BeautifulSoup(response.content, 'lxml')
+    return urllib.parse.urlsplit(url).path.lower().endswith(IMAGE_EXTENSIONS)
 
-            # Remove script, style, and irrelevant elements
-            for script in soup(["script", "style", "header", "footer", "nav", "aside"]):
-                script.decompose()
+# Function to determine an image's MIME type from its first bytes
+def sniff_image_mime_type(data):
+    """
+    Determine the MIME type of image data from its magic bytes.
 
-            # Extract text from relevant content tags
-            content = []
-            for tag in soup.find_all(['h1', 'h2', 'h3', 'p', 'li', 'blockquote']):
-                text = tag.get_text(separator=' ', strip=True)
-                if text:
-                    content.append(text)
+    Args:
+        data (bytes): The image data.
 
-            # Combine the extracted text and truncate it
-            combined_content = ' '.join(content)
-            truncated_content = combined_content[:max_chars]
+    Returns:
+        str: The MIME type, or None if the data is not a recognized image format.
+    """
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data.startswith((b'II*\x00', b'MM\x00*')):
+        return 'image/tiff'
+    if data.startswith(b'BM'):
+        return 'image/bmp'
+    if data[4:8] == b'ftyp':
+        brand = data[8:12]
+        if brand in (b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx'):
+            return 'image/heic'
+        if brand in (b'mif1', b'msf1', b'heif'):
+            return 'image/heif'
+    return None
 
-            print(f"Truncated website content to {len(truncated_content)} characters.")
-            return truncated_content
-        else:
-            print(f"Failed to retrieve website content. Status code: {response.status_code}")
-            return None
-    except Exception as e:
-        print(f"Exception occurred while scraping website: {e}")
-        return None
+# Function to compute a perceptual hash of an image
+def difference_hash(image):
+    """
+    Compute the 64-bit difference hash of an image: whether each pixel of a 9x8 grayscale
+    thumbnail is brighter than its right neighbour. Re-encoded or resized copies of the same
+    picture get the same hash.
 
-# Function to use Vertex AI for generating output
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def generate_output_ranking(input_task, account):
+    Args:
+        image (PIL.Image.Image): The decoded image.
+
+    Returns:
+        str: The hash as 16 hex digits.
     """
-    Use Vertex AI to generate an output based on the input task and account.
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):016x}"
+
+# Function to compute a small grayscale thumbnail for comparing images pixel by pixel
+def comparison_thumbnail(image):
+    """
+    Compute a 16x16 grayscale thumbnail used to confirm that images with the same difference
+    hash really show the same picture.
 
     Args:
-        input_task (list): The input task for the model.
-        account (dict): The synthetic account data.
+        image (PIL.Image.Image): The decoded image.
 
     Returns:
-        str: The generated JSON response from the model.
+        bytes: The 256 grey levels of the thumbnail.
+    """
+    return image.convert('L').resize((16, 16), Image.LANCZOS).tobytes()
+
+# Function to downscale and re-encode an image for the model
+def normalize_image(data, mime_type, max_dimension=IMAGE_MAX_DIMENSION):
+    """
+    Downscale an image so its longest side is at most max_dimension, and re-encode formats
+    the model does not accept (GIF, BMP, TIFF) as PNG or JPEG. Images that are already small
+    enough and in a supported format are returned unchanged.
+
+    Args:
+        data (bytes): The image data.
+        mime_type (str): The sniffed MIME type.
+        max_dimension (int): Longest side of the normalized image, in pixels.
+
+    Returns:
+        tuple(bytes, str, str, bytes): The normalized data, its MIME type, the perceptual hash
+        and the comparison thumbnail. The hash and thumbnail are None for HEIC/HEIF images
+        Pillow cannot read; everything is None for corrupt or truncated images.
     """
-    print("Generating output ranking using the Vertex AI model...")
     try:
-        # Construct the approach description
-        persona = f"Your synthetic persona details: {account}"
-        prompt = [persona] + input_task
+        image = Image.open(io.BytesIO(data))
+    except Image.UnidentifiedImageError as e:
+        if mime_type in ('image/heic', 'image/heif'):
+            # Pillow cannot decode HEIC/HEIF without a plugin; the model accepts them as they are
+            return data, mime_type, None, None
+        print(f"Could not decode {mime_type} image: {e}")
+        return None, None, None, None
+    try:
+        image.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Could not decode {mime_type} image, it is corrupt or truncated: {e}")
+        return None, None, None, None
+    image = ImageOps.exif_transpose(image)
+    perceptual_hash = difference_hash(image)
+    thumbnail = comparison_thumbnail(image)
+    if max(image.size) <= max_dimension and mime_type in MODEL_IMAGE_MIME_TYPES:
+        return data, mime_type, perceptual_hash, thumbnail
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    output = io.BytesIO()
+    if image.mode in ('RGBA', 'LA', 'P') or 'transparency' in image.info:
+        image.save(output, format='PNG', optimize=True)
+        return output.getvalue(), 'image/png', perceptual_hash, thumbnail
+    image.convert('RGB').save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return output.getvalue(), 'image/jpeg', perceptual_hash, thumbnail
 
-        # Generate the response.
-        response = GENERATIVE_MODEL.generate_content(prompt)
-        print("Model response generated.")
-        return response.text
-    except Exception as e:
-        print(f"An error occurred while generating the output: {e}")
-        return None
+# On-disk cache of prepared images, deduplicated by content and perceptual hash
+class ImageCache:
+    """
+    SQLite-backed cache of images fetched, validated and normalized for the model. URLs map
+    to prepared images; an image fetched under another URL, or re-encoded with the same
+    perceptual hash and nearly the same pixels, reuses the image already prepared. Once the stored images exceed
+    max_bytes, the least recently used are evicted. Prepared Parts are also kept in memory
+    so every persona evaluating an image shares one Part.
+    """
 
-# Main script
-if __name__ == "__main__":
-    # Number of synthetic accounts to generate
-    num_accounts = 5  # Adjust this number as needed to ensure manageability
-    print(f"Starting main script. Dryrun={DRYRUN}")
-    # Generate synthetic accounts
-    accounts = generate_synthetic_accounts(num_accounts)
-    account_index = 0  # Start from the first account
+    def __init__(self, path=IMAGE_CACHE_PATH, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.metrics = collections.Counter()
+        self.fetcher = HttpFetcher(max_bytes=IMAGE_FETCH_MAX_BYTES)
+        self._parts = collections.OrderedDict()
+        self._part_urls = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS images (content_hash TEXT PRIMARY KEY, perceptual_hash TEXT, thumbnail BLOB, "
+            "mime_type TEXT NOT NULL, data BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS images_perceptual_hash ON images (perceptual_hash);"
+            "CREATE INDEX IF NOT EXISTS images_last_used ON images (last_used);"
+            "CREATE TABLE IF NOT EXISTS image_urls (url TEXT PRIMARY KEY, content_hash TEXT NOT NULL);"
+            # Fetched content whose prepared image is another image's (a perceptual duplicate)
+            "CREATE TABLE IF NOT EXISTS image_aliases (content_hash TEXT PRIMARY KEY, image TEXT NOT NULL);"
+        )
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+        print(f"Opened image cache at {path} ({self._size} bytes).")
 
-    while True:
-        print("Checking for JSON files in the input bucket...")
-        # List all JSON files in the input bucket
-        if DRYRUN:
-          blobs = list(input_bucket.list_blobs(prefix='response-feedback-English/', max_results=100))
-        else:
-          blobs = list(input_bucket.list_blobs())
-        json_blobs = [blob for blob in blobs if blob.name.endswith('.json')]
-        if not json_blobs:
-            print("No JSON files found in the input bucket. Waiting for new files...")
-            time.sleep(60)  # Wait for 1 minute before checking again
-            continue
+    def _load(self, content_hash):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data, mime_type FROM images WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE images SET last_used = ? WHERE content_hash = ?", (time.time(), content_hash)
+            )
+            self._connection.commit()
+        return PreparedImage(row[0], row[1], content_hash)
 
-        # Randomize the order of the JSON blobs
-        random.shuffle(json_blobs)
-        print("Randomized the order of input files.")
+    def _resolve(self, content_hash):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT image FROM image_aliases WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+        return content_hash if row is None else row[0]
 
-        for blob in json_blobs:
-            try:
-                print(f"Processing file: {blob.name}")
-                # Download the JSON file
-                data = blob.download_as_bytes()
-                input_data = json.loads(data)
-                print("Input data loaded.")
-
-                # Get the current account
-                account = accounts[(account_index // 5) % len(accounts)]
-                account_index += 1
-                print(f"Using account {account_index}: {account['email']}")
-
-                # Process the input data to create an input task
-                input_task, task_type = process_input_data(input_data, account)
-
-                # Generate output ranking
-                response_text = generate_output_ranking(input_task, account)
-                if response_text is None:
-                    print(f"Failed to generate response for {blob.name}")
-                    continue
+    def _store(self, url, content_hash, perceptual_hash, thumbnail, data, mime_type):
+        now = time.time()
+        with self._lock:
+            if perceptual_hash is not None:
+                # Equal hashes are only candidates; the thumbnails confirm it is the same picture
+                pixels = np.frombuffer(thumbnail, dtype=np.uint8).astype(np.int16)
+                for candidate, candidate_thumbnail in self._connection.execute(
+                    "SELECT content_hash, thumbnail FROM images WHERE perceptual_hash = ?", (perceptual_hash,)
+                ).fetchall():
+                    difference = np.abs(np.frombuffer(candidate_thumbnail, dtype=np.uint8) - pixels).mean()
+                    if difference <= IMAGE_DUPLICATE_MAX_PIXEL_DIFFERENCE:
+                        # A re-encoded copy of an image already prepared
+                        self.metrics['perceptual_duplicates'] += 1
+                        self._connection.execute(
+                            "INSERT OR REPLACE INTO image_aliases (content_hash, image) VALUES (?, ?)",
+                            (content_hash, candidate)
+                        )
+                        content_hash = candidate
+                        break
+            inserted = self._connection.execute(
+                "INSERT OR IGNORE INTO images "
+                "(content_hash, perceptual_hash, thumbnail, mime_type, data, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (content_hash, perceptual_hash, thumbnail, mime_type, data, len(data), now)
+            ).rowcount
+            self._size += len(data) if inserted else 0
+            self._connection.execute(
+                "INSERT OR REPLACE INTO image_urls (url, content_hash) VALUES (?, ?)", (url, content_hash)
+            )
+            while self._size > self.max_bytes:
+                oldest = self._connection.execute(
+                    "SELECT content_hash, size FROM images ORDER BY last_used LIMIT 1"
+                ).fetchone()
+                if oldest is None:
+                    break
+                self._connection.execute("DELETE FROM images WHERE content_hash = ?", (oldest[0],))
+                self._connection.execute("DELETE FROM image_urls WHERE content_hash = ?", (oldest[0],))
+                self._connection.execute("DELETE FROM image_aliases WHERE image = ?", (oldest[0],))
+                self._size -= oldest[1]
+            self._connection.commit()
+        return content_hash
 
-                print(f"Generated response: {response_text}")
+    def prepare(self, url):
+        """
+        Get the prepared image for a URL, fetching and normalizing it on a cache miss.
 
-                # Parse the response text as JSON
-                try:
-                    response_json = json.loads(response_text)
-                    print("Model response parsed as JSON.")
-                except json.JSONDecodeError as e:
-                    print(f"Failed to parse response as JSON for {blob.name}: {e}")
-                    continue
+        Args:
+            url (str): The URL of the image.
 
-                # Prepare the output data matching the sample output structure
-                result = []
-                schema_to_label = {
-                    "is_content_harmful_to_animals": {
-                        "from_name": "is_content_harmful_to_animals",
-                        "type": "choices",
-                        "value": {"choices": [response_json.get("is_content_harmful_to_animals", "No")]}
-                    },
-                    "explanation": {
-                        "from_name": "explanation",
-                        "type": "textarea",
-                        "value": {"text": [response_json.get("explanation", "")]}
-                    },
-                    "rating_effect_on_animals": {
-                        "from_name": "rating_effect_on_animals",
-                        "type": "rating",
-                        "value": {"rating": response_json.get("rating_effect_on_animals", 3)}
-                    },
-                    "rating_cultural_sensitivity": {
-                        "from_name": "rating_cultural_sensitivity",
-                        "type": "rating",
-                        "value": {"rating": response_json.get("rating_cultural_sensitivity", 3)}
-                    },
-                    "rating_relevance": {
-                        "from_name": "rating_relevance",
-                        "type": "rating",
-                        "value": {"rating": response_json.get("rating_relevance", 3)}
-                    },
-                    "rating_insight": {
-                        "from_name": "rating_insight",
-                        "type": "rating",
-                        "value": {"rating": response_json.get("rating_insight", 3)}
-                    },
-                    "rating_trustworthiness": {
-                        "from_name": "rating_trustworthiness",
-                        "type": "rating",
-                        "value": {"rating": response_json.get("rating_trustworthiness", 3)}
-                    },
-                    "rating_emotional_impact": {
-                        "from_name": "rating_emotional_impact",
-                        "type": "rating",
-                        "value": {"rating": response_json.get("rating_emotional_impact", 3)}
-                    },
-                    "rating_rationality": {
-                        "from_name": "rating_rationality",
-                        "type": "rating",
-                        "value": {"rating": response_json.get("rating_rationality", 3)}
-                    },
-                    "rating_influence": {
-                        "from_name": "rating_influence",
-                        "type": "rating",
-                        "value": {"rating": response_json.get("rating_influence", 3)}
-                    },
-                    "rating_alignment": {
-                        "from_name": "rating_alignment",
-                        "type": "rating",
-                        "value": {"rating": response_json.get("rating_alignment", 3)}
-                    },
-                }
+        Returns:
+            PreparedImage: The prepared image, False if the URL does not serve an image the
+            model accepts, or None if it could not be fetched or decoded.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT content_hash FROM image_urls WHERE url = ?", (url,)).fetchone()
+        if row is not None:
+            prepared = self._load(row[0])
+            if prepared is not None:
+                self.metrics['url_hits'] += 1
+                return prepared
 
-                for key, mapping in schema_to_label.items():
-                    result.append({
-                        "id": str(uuid.uuid4()),
-                        "from_name": mapping["from_name"],
-                        "to_name": task_type,
-                        "type": mapping["type"],
-                        "value": mapping["value"],
-                        "origin": "manual"
-                    })
-                print("Result data prepared.")
-
-
-                # Prepare the output data
-                current_time = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z"
-                task = {
-                    "cancelled_annotations": 0,
-                    "comment_authors": [],
-                    "comment_count": 0,
-                    "created_at": current_time,
-                    "data": input_data,
-                    "file_upload": None,
-                    "id": random.randint(100000, 999999),
-                    "inner_id": random.randint(100000, 999999),
-                    "is_labeled": True,
-                    "last_comment_updated_at": None,
-                    "meta": {},
-                    "overlap": 1,
-                    "project": 2480,
-                    "total_annotations": 1,
-                    "total_predictions": 0,
-                    "unresolved_comment_count": 0,
-                    "updated_at": current_time,
-                    "updated_by": None
-                }
+        response = self.fetcher.fetch(url)
+        if response is None or response.status_code != 200 or response.truncated:
+            print(f"Could not fetch image {url}.")
+            self.metrics['fetch_failures'] += 1
+            return None
+        self.metrics['fetches'] += 1
+        self.metrics['bytes_fetched'] += len(response.content)
+        mime_type = sniff_image_mime_type(response.content)
+        if mime_type is None:
+            print(f"{url} does not contain a recognized image format.")
+            self.metrics['not_images'] += 1
+            return False
+        if mime_type != get_mime_type(url):
+            self.metrics['mislabeled'] += 1
 
-                output_data = {
-                    "id": random.randint(10000, 1000000),
-                    "created_username": f"{account['first_name']} {account['last_name']} {account['email']}, {account['id']}",
-                    "created_ago": "0 minutes",
-                    "completed_by": {
-                        "id": account['id'],
-                        "first_name": account['first_name'],
-                        "last_name": account['last_name'],
-                        "email": account['email'],
-                        "synthetic_account": account
-                    },
-                    "draft_created_at": current_time,
-                    "task": task,
-                    "project": 2480,
-                    "updated_by": account['id'],
-                    "result": result,
-                    "was_cancelled": False,
-                    "ground_truth": False,
-                    "created_at": current_time,
-                    "updated_at": current_time,
-                    "lead_time": random.uniform(1, 100),
-                    "import_id": None,
-                    "last_action": None,
-                    "parent_prediction": None,
-                    "parent_annotation": None,
-                    "last_created_by": None,
-                }
-                print("Output data assembled.")
+        content_hash = self._resolve(hashlib.sha256(response.content).hexdigest())
+        prepared = self._load(content_hash)
+        if prepared is not None:
+            # The same image (or a known perceptual duplicate) under another URL
+            self.metrics['content_duplicates'] += 1
+            with self._lock:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO image_urls (url, content_hash) VALUES (?, ?)", (url, content_hash)
+                )
+                self._connection.commit()
+            return prepared
 
-                # Save the output data to the output bucket
-                output_name = blob.name.replace('.json', '') + f"-synthetic-{str(uuid.uuid4())}.json"
-                if DRYRUN:
-                  print(f"DRYRUN: Processed {output_name}")
-                  print(json.dumps(output_data, indent=2))
-                else:
-                  output_blob = output_bucket.blob(output_name)
-                  output_blob.upload_from_string(json.dumps(output_data, indent=2), content_type='application/json')
-                  print(f"Processed and saved output for {output_name}")
+        data, prepared_mime_type, perceptual_hash, thumbnail = normalize_image(response.content, mime_type)
+        if data is None:
+            # Never send corrupt or truncated bytes inline; the model gets the URL instead
+            self.metrics['undecodable'] += 1
+            return None
+        self.metrics['bytes_prepared'] += len(data)
+        content_hash = self._store(url, content_hash, perceptual_hash, thumbnail, data, prepared_mime_type)
+        return self._load(content_hash)
 
-            except Exception as e:
-                print(f"An error occurred while processing {blob.name}: {e}")
-        # Sleep for a short while before checking for new files
-        print("Sleeping for 10 seconds before checking for new files...")
-        time.sleep(10)
+    def part(self, url):
+        """
+        Get the model part for an image URL, shared between all requests for the same image.
+
+        Args:
+            url (str): The URL of the image.
+
+        Returns:
+            Part: The image part, None if the image could not be fetched or decoded (the caller falls
+            back to passing the URL) or False if the URL does not serve a usable image.
+        """
+        with self._lock:
+            part = self._parts.get(self._part_urls.get(url))
+            if part is not None:
+                self.metrics['part_hits'] += 1
+                self._parts.move_to_end(self._part_urls[url])
+                return part
+        prepared = self.prepare(url)
+        if not prepared:
+            return prepared
+        with self._lock:
+            self._part_urls[url] = prepared.content_hash
+            if len(self._part_urls) > 4 * IMAGE_PARTS_IN_MEMORY:
+                self._part_urls.popitem(last=False)
+            part = self._parts.get(prepared.content_hash)
+            if part is not None:
+                self._parts.move_to_end(prepared.content_hash)
+                return part
+            part = Part.from_data(prepared.data, mime_type=prepared.mime_type)
+            self._parts[prepared.content_hash] = part
+            if len(self._parts) > IMAGE_PARTS_IN_MEMORY:
+                self._parts.popitem(last=False)
+        return part
+
+    def report(self):
+        """
+        Print image preparation statistics.
+        """
+        print(f"Image cache: {self.metrics['part_hits']} shared parts, {self.metrics['url_hits']} URL hits, "
+              f"{self.metrics['fetches']} fetches "
+              f"({self.metrics['fetch_failures']} failed, {self.metrics['not_images']} not images, "
+              f"{self.metrics['undecodable']} undecodable, "
+              f"{self.metrics['mislabeled']} mislabeled), {self.metrics['content_duplicates']} identical and "
+              f"{self.metrics['perceptual_duplicates']} perceptual duplicates; "
+              f"{self.metrics['bytes_fetched']} bytes fetched, {self.metrics['bytes_prepared']} bytes prepared, "
+              f"{self._size} bytes cached.")
+
+IMAGE_CACHE = ImageCache() if IMAGE_PREPARATION_ENABLED else None
+
+# HTML extraction settings
+STREAMING_HTML_EXTRACTION = True  # Use the incremental extractor instead of a full BeautifulSoup parse
+HTML_EXCLUDED_TAGS = ("script", "style", "header", "footer", "nav", "aside")
+HTML_CONTENT_TAGS = ('h1', 'h2', 'h3', 'p', 'li', 'blockquote')
+HTML_FEED_CHUNK_BYTES = 16 * 1024
+
+# Function to extract the relevant text from a website's HTML
+def extract_website_text(html, max_chars=100000):
+    """
+    Extract text from the main content tags of an HTML document and truncate it.
+
+    Args:
+        html (bytes): The raw HTML.
+        max_chars (int): Maximum number of characters to return.
+
+    Returns:
+        str: The extracted and truncated text content.
+    """
+    if STREAMING_HTML_EXTRACTION:
+        return extract_website_text_streaming(html, max_chars)
+    return extract_website_text_bs4(html, max_chars)
+
+# Function to extract website text with a full BeautifulSoup parse
+def extract_website_text_bs4(html, max_chars=100000):
+    """
+    Extract text from the main content tags of an HTML document by parsing the whole
+    document with BeautifulSoup, then truncate it.
+
+    Args:
+        html (bytes): The raw HTML.
+        max_chars (int): Maximum number of characters to return.
+
+    Returns:
+        str: The extracted and truncated text content.
+    """
+    soup = BeautifulSoup(html, 'lxml')
+
+    # Remove script, style, and irrelevant elements
+    for script in soup(list(HTML_EXCLUDED_TAGS)):
+        script.decompose()
+
+    # Extract text from relevant content tags
+    content = []
+    for tag in soup.find_all(list(HTML_CONTENT_TAGS)):
+        text = tag.get_text(separator=' ', strip=True)
+        if text:
+            content.append(text)
+
+    # Combine the extracted text and truncate it
+    combined_content = ' '.join(content)
+    return combined_content[:max_chars]
+
+# Function to collect the text of an element, skipping excluded subtrees
+def _element_text(element):
+    strings = []
+
+    def walk(node):
+        if node.text:
+            strings.append(node.text)
+        for child in node:
+            # Skip comments, processing instructions and excluded tags, but keep their tail text
+            if isinstance(child.tag, str) and child.tag not in HTML_EXCLUDED_TAGS:
+                walk(child)
+            if child.tail:
+                strings.append(child.tail)
+
+    walk(element)
+    return ' '.join(string.strip() for string in strings if string.strip())
+
+# Function to extract website text incrementally, stopping once max_chars are collected
+def extract_website_text_streaming(html, max_chars=100000):
+    """
+    Extract text from the main content tags of an HTML document with an incremental lxml
+    parser. Excluded subtrees (scripts, navigation, etc.) are skipped as they are parsed,
+    finished elements are discarded to keep memory flat, and parsing stops as soon as
+    max_chars of relevant text has been collected. The output matches extract_website_text_bs4.
+
+    Args:
+        html (bytes): The raw HTML.
+        max_chars (int): Maximum number of characters to return.
+
+    Returns:
+        str: The extracted and truncated text content.
+    """
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    content = []  # One slot per content tag, in document order of their opening tags
+    open_slots = {}  # Content elements that have started but not yet ended -> slot index
+    excluded_depth = 0
+    collected_chars = 0
+
+    def handle_events():
+        nonlocal excluded_depth, collected_chars
+        for event, element in parser.read_events():
+            tag = element.tag
+            if event == 'start':
+                if tag in HTML_EXCLUDED_TAGS:
+                    excluded_depth += 1
+                elif tag in HTML_CONTENT_TAGS and excluded_depth == 0:
+                    open_slots[element] = len(content)
+                    content.append('')
+                continue
+
+            if tag in HTML_EXCLUDED_TAGS:
+                excluded_depth -= 1
+            elif element in open_slots:
+                text = _element_text(element)
+                content[open_slots.pop(element)] = text
+                if text:
+                    collected_chars += len(text) + 1
+            # Once no content element is open, finished elements are no longer needed
+            if not open_slots:
+                element.clear(keep_tail=False)
+                parent = element.getparent()
+                if parent is not None:
+                    while element.getprevious() is not None:
+                        del parent[0]
+            if not open_slots and collected_chars >= max_chars:
+                return True
+        return False
+
+    done = False
+    for offset in range(0, len(html), HTML_FEED_CHUNK_BYTES):
+        parser.feed(html[offset:offset + HTML_FEED_CHUNK_BYTES])
+        if handle_events():
+            done = True
+            break
+    if not done:
+        try:
+            parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        handle_events()
+
+    combined_content = ' '.join(text for text in content if text)
+    return combined_content[:max_chars]
+
+# Function to benchmark the streaming HTML extractor against the BeautifulSoup one
+def benchmark_html_extraction(pages_dir, max_chars=100000, repeats=3):
+    """
+    Time both HTML extractors on a corpus of saved pages (*.html / *.htm files) and check
+    that they produce the same text.
+
+    Args:
+        pages_dir (str): Directory containing the saved pages.
+        max_chars (int): Maximum number of characters to extract per page.
+        repeats (int): Number of timed passes over the corpus per extractor.
+
+    Returns:
+        dict: Total seconds per extractor, the speedup and the number of mismatching pages.
+    """
+    pages = []
+    for name in sorted(os.listdir(pages_dir)):
+        if name.lower().endswith(('.html', '.htm')):
+            with open(os.path.join(pages_dir, name), 'rb') as page_file:
+                pages.append(page_file.read())
+    print(f"Benchmarking HTML extraction on {len(pages)} pages (max_chars={max_chars})...")
+
+    timings = {}
+    outputs = {}
+    for label, extractor in [('bs4', extract_website_text_bs4), ('streaming', extract_website_text_streaming)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            outputs[label] = [extractor(page, max_chars) for page in pages]
+        timings[label] = (time.perf_counter() - start) / repeats
+
+    mismatches = sum(1 for a, b in zip(outputs['bs4'], outputs['streaming']) if a != b)
+    speedup = timings['bs4'] / timings['streaming'] if timings['streaming'] else float('inf')
+    print(f"BeautifulSoup: {timings['bs4']:.3f}s, streaming: {timings['streaming']:.3f}s "
+          f"per pass ({speedup:.1f}x), {mismatches} mismatching pages.")
+    return {'bs4_seconds': timings['bs4'], 'streaming_seconds': timings['streaming'],
+            'speedup': speedup, 'mismatches': mismatches}
+
+# Function to scrape website content with truncation and relevance focus
+def scrape_website(url, max_chars=100000):
+    """
+    Scrape text content from a website, focusing on the main content and truncating to a character limit.
+
+    Extracted text is cached per URL; entries older than SCRAPE_CACHE_TTL_SECONDS are revalidated
+    with a conditional GET using the stored ETag/Last-Modified validators.
+
+    Args:
+        url (str): The URL of the website.
+        max_chars (int): Maximum number of characters to return.
+
+    Returns:
+        str: The scraped and truncated text content.
+    """
+    cached = SCRAPE_CACHE.get(url, max_chars) if SCRAPE_CACHE is not None else None
+    if cached is not None and cached['fresh']:
+        SCRAPE_CACHE.hits += 1
+        print(f"Using cached website content for URL: {url}")
+        return cached['text']
+
+    print(f"Attempting to scrape website at URL: {url}")
+    headers = {}
+    if cached is not None:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    try:
+        response = HTTP_FETCHER.fetch(url, headers=headers)
+        if response is None:
+            # Fall back to stale cached text while the host is unreachable
+            if cached is not None:
+                print("Using stale cached website content.")
+                return cached['text']
+            return None
+        if response.status_code == 304 and cached is not None:
+            print("Website content not modified since it was cached.")
+            SCRAPE_CACHE.revalidations += 1
+            SCRAPE_CACHE.refresh(url)
+            return cached['text']
+        if response.status_code == 200:
+            print("Website content retrieved successfully.")
+            truncated_content = extract_website_text(response.content, max_chars)
+            print(f"Truncated website content to {len(truncated_content)} characters.")
+            if SCRAPE_CACHE is not None:
+                SCRAPE_CACHE.misses += 1
+                SCRAPE_CACHE.put(url, truncated_content, max_chars,
+                                 response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            return truncated_content
+        else:
+            print(f"Failed to retrieve website content. Status code: {response.status_code}")
+            return None
+    except Exception as e:
+        print(f"Exception occurred while scraping website: {e}")
+        return None
+
+# Website content compaction settings
+WEBSITE_TOKEN_BUDGET = 8000  # Approximate tokens of website text sent to the model; 0 disables compaction (as does context caching)
+PASSAGE_TARGET_TOKENS = 150  # Approximate size of the passages that are scored and selected
+PASSAGE_SEPARATOR = ' [...] '  # Marks where non-adjacent passages were joined
+
+# Lexicon of animal and veganism topic terms with relevance weights
+RELEVANCE_LEXICON = {
+    'animal': 3.0, 'animals': 3.0, 'vegan': 4.0, 'veganism': 4.0, 'vegetarian': 3.0, 'plant-based': 3.5,
+    'cruelty': 3.5, 'cruelty-free': 3.5, 'welfare': 3.0, 'rights': 2.0, 'sentient': 3.5, 'sentience': 3.5,
+    'suffering': 2.5, 'slaughter': 3.5, 'slaughterhouse': 4.0, 'abattoir': 4.0, 'factory': 1.0,
+    'factory farm': 4.0, 'factory farming': 4.0, 'farmed': 2.5, 'livestock': 3.5, 'meat': 3.0, 'dairy': 3.0,
+    'milk': 2.0, 'egg': 2.0, 'eggs': 2.0, 'poultry': 3.0, 'cow': 2.5, 'cows': 2.5, 'cattle': 3.0,
+    'pig': 2.5, 'pigs': 2.5, 'chicken': 2.5, 'chickens': 2.5, 'hen': 2.5, 'hens': 2.5, 'fish': 2.0,
+    'fishing': 2.5, 'aquaculture': 3.0, 'wildlife': 3.0, 'species': 2.0, 'sanctuary': 3.0,
+    'rescue': 2.0, 'shelter': 1.5, 'zoo': 2.5, 'zoos': 2.5, 'circus': 2.0, 'captivity': 3.0, 'cage': 2.5,
+    'cages': 2.5, 'caged': 3.0, 'hunting': 3.0, 'trapping': 3.0, 'fur': 3.0, 'leather': 2.5, 'wool': 2.0,
+    'vivisection': 4.0, 'animal testing': 4.0, 'experiments': 1.5, 'pet': 1.5, 'pets': 1.5,
+    'companion animal': 3.0, 'exploitation': 2.0, 'activism': 2.0, 'activist': 2.0, 'advocacy': 2.0,
+    'abolition': 2.0, 'carnism': 4.0, 'speciesism': 4.0, 'ethics': 1.5, 'ethical': 1.5, 'diet': 1.5,
+    'protein': 1.0, 'climate': 1.0, 'deforestation': 1.5, 'biodiversity': 1.5, 'extinction': 1.5,
+}
+RELEVANCE_BM25_K1 = 1.2
+RELEVANCE_BM25_B = 0.75
+
+COMPACTION_STATS = {'tasks': 0, 'tokens_before': 0, 'tokens_after': 0}
+
+# Function to split text into passages of roughly equal size along sentence boundaries
+def split_into_passages(text, target_tokens=PASSAGE_TARGET_TOKENS):
+    """
+    Split text into passages of about target_tokens each, breaking between sentences.
+    Sentences longer than a passage (e.g. list items or headings without punctuation) are
+    broken between words, and words longer than a passage into character windows.
+
+    Args:
+        text (str): The text to split.
+        target_tokens (int): Approximate number of tokens per passage.
+
+    Returns:
+        list: The passages, in their original order.
+    """
+    passages = []
+    current = []
+    current_tokens = 0
+    for sentence in re.split(r'(?<=[.!?])\s+', text):
+        if not sentence:
+            continue
+        if estimate_tokens(sentence) > target_tokens:
+            if current:
+                passages.append(' '.join(current))
+                current = []
+                current_tokens = 0
+            passages.extend(_split_long_sentence(sentence, target_tokens))
+            continue
+        current.append(sentence)
+        current_tokens += estimate_tokens(sentence)
+        if current_tokens >= target_tokens:
+            passages.append(' '.join(current))
+            current = []
+            current_tokens = 0
+    if current:
+        passages.append(' '.join(current))
+    return passages
+
+# Function to break a sentence longer than a passage into word or character windows
+def _split_long_sentence(sentence, target_tokens):
+    max_chars = target_tokens * 4
+    windows = []
+    current = []
+    current_chars = 0
+    for word in sentence.split():
+        if len(word) > max_chars:
+            windows.extend(word[start:start + max_chars] for start in range(0, len(word), max_chars))
+            continue
+        if current and current_chars + len(word) + 1 > max_chars:
+            windows.append(' '.join(current))
+            current = []
+            current_chars = 0
+        current.append(word)
+        current_chars += len(word) + 1
+    if current:
+        windows.append(' '.join(current))
+    return windows
+
+# Function to score passages for relevance to animal and veganism topics
+def score_passages(passages):
+    """
+    Score passages with a BM25-style lexical model over RELEVANCE_LEXICON. Single words and
+    two-word phrases are matched; term frequency saturates and long passages are normalized.
+
+    Args:
+        passages (list): The passages to score.
+
+    Returns:
+        list: One relevance score per passage.
+    """
+    tokenized = [re.findall(r"[a-z]+(?:-[a-z]+)*", passage.lower()) for passage in passages]
+    average_length = max(1, sum(len(words) for words in tokenized) / max(1, len(tokenized)))
+    scores = []
+    for words in tokenized:
+        terms = collections.Counter(words)
+        terms.update(f"{first} {second}" for first, second in zip(words, words[1:]))
+        length_norm = 1 - RELEVANCE_BM25_B + RELEVANCE_BM25_B * len(words) / average_length
+        score = 0.0
+        for term, frequency in terms.items():
+            weight = RELEVANCE_LEXICON.get(term)
+            if weight:
+                score += weight * frequency * (RELEVANCE_BM25_K1 + 1) / (frequency + RELEVANCE_BM25_K1 * length_norm)
+        scores.append(score)
+    return scores
+
+# Function to compact website text to the most relevant passages within a token budget
+def compact_website_content(text, token_budget=WEBSITE_TOKEN_BUDGET):
+    """
+    Keep the most relevant passages of a website's text that fit into the token budget,
+    in their original order. Text that already fits is returned unchanged.
+
+    Args:
+        text (str): The scraped website text.
+        token_budget (int): Approximate number of tokens to keep; 0 disables compaction.
+
+    Returns:
+        str: The compacted text.
+    """
+    tokens_before = estimate_tokens(text)
+    if token_budget <= 0 or tokens_before <= token_budget:
+        return text
+
+    passages = split_into_passages(text)
+    scores = score_passages(passages)
+    passage_tokens = [estimate_tokens(passage) for passage in passages]
+
+    # Greedily take the best passages (earlier ones first on ties) while they fit
+    selected = set()
+    used_tokens = 0
+    for index in sorted(range(len(passages)), key=lambda i: (-scores[i], i)):
+        if used_tokens + passage_tokens[index] <= token_budget:
+            selected.add(index)
+            used_tokens += passage_tokens[index]
+
+    compacted = []
+    for index in sorted(selected):
+        if compacted and index - 1 not in selected:
+            compacted.append(PASSAGE_SEPARATOR.strip())
+        compacted.append(passages[index])
+    compacted_text = ' '.join(compacted)
+    if estimate_tokens(compacted_text) < token_budget // 2:
+        # Selection came up short (e.g. passages that still exceed the budget): keep a budget-sized prefix
+        compacted_text = text[:token_budget * 4]
+
+    tokens_after = estimate_tokens(compacted_text)
+    COMPACTION_STATS['tasks'] += 1
+    COMPACTION_STATS['tokens_before'] += tokens_before
+    COMPACTION_STATS['tokens_after'] += tokens_after
+    print(f"Compacted website content to {len(selected)} of {len(passages)} passages: "
+          f"{tokens_before} -> {tokens_after} tokens ({tokens_before - tokens_after} saved).")
+    return compacted_text
+
+# Function to print the token savings from website compaction
+def report_compaction():
+    """
+    Print the cumulative token savings from website compaction.
+    """
+    saved = COMPACTION_STATS['tokens_before'] - COMPACTION_STATS['tokens_after']
+    print(f"Website compaction: {COMPACTION_STATS['tasks']} tasks compacted, {saved} tokens saved "
+          f"({COMPACTION_STATS['tokens_before']} -> {COMPACTION_STATS['tokens_after']}).")
+
+# Model backend settings
+IMAGE_PART_TOKENS = 258  # Approximate input tokens billed for one image part
+
+# Function to estimate the input tokens of a list of prompt parts
+def estimate_prompt_tokens(parts):
+    """
+    Roughly estimate the input tokens of prompt parts (text and images).
+
+    Args:
+        parts (list): The prompt parts.
+
+    Returns:
+        int: The estimated token count.
+    """
+    return sum(estimate_tokens(part) if isinstance(part, str) else IMAGE_PART_TOKENS for part in parts)
+
+# Backend that sends requests to Vertex AI generative models
+class VertexModelBackend:
+    """
+    Model backend for Vertex AI. Requests go to the shared GenerativeModel, or to a model bound
+    to a server-side context cache when one is given.
+    """
+
+    def __init__(self, model=GENERATIVE_MODEL, model_name=MODEL_NAME, system_instruction=SYSTEM_INSTRUCTION):
+        self.model = model
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self._cached_models = {}
+
+    def _model_for(self, context_cache):
+        if context_cache is None:
+            return self.model
+        model = self._cached_models.get(context_cache.name)
+        if model is None:
+            model = GenerativeModel.from_cached_content(cached_content=context_cache)
+            self._cached_models[context_cache.name] = model
+        return model
+
+    def _generation_config(self, response_schema):
+        if response_schema is None:
+            return None
+        return GenerationConfig(response_mime_type="application/json", response_schema=response_schema)
+
+    async def generate(self, contents, context_cache=None, response_schema=None):
+        """
+        Generate a response with the model's async generate API.
+
+        Args:
+            contents (list): The prompt parts.
+            context_cache (CachedContent): Optional server-side context the prompt continues from.
+            response_schema (dict): Optional schema the JSON response is constrained to.
+
+        Returns:
+            GenerationResponse: The model response.
+        """
+        return await self._model_for(context_cache).generate_content_async(
+            contents, generation_config=self._generation_config(response_schema)
+        )
+
+    def create_context_cache(self, contents, ttl_seconds):
+        """
+        Register the system instruction plus optional contents as server-side cached context.
+
+        Args:
+            contents (list): Prompt parts to cache after the system instruction (may be empty).
+            ttl_seconds (int): Lifetime of the cached context.
+
+        Returns:
+            CachedContent: The cached context.
+        """
+        return caching.CachedContent.create(
+            model_name=self.model_name,
+            system_instruction=self.system_instruction,
+            contents=contents or None,
+            ttl=datetime.timedelta(seconds=ttl_seconds),
+        )
+
+    def delete_context_cache(self, context_cache):
+        """
+        Delete a server-side cached context.
+
+        Args:
+            context_cache (CachedContent): The cached context.
+        """
+        self._cached_models.pop(context_cache.name, None)
+        context_cache.delete()
+
+# Offline stand-in for a model backend that counts billed input tokens
+class StubModelBackend:
+    """
+    Local stand-in for VertexModelBackend, for offline tests and benchmarks. Responses come
+    from respond(contents), latency from latency() (seconds), and billed input tokens are
+    counted as the backend would charge them: cached context tokens at cached_token_rate.
+    Context caches smaller than min_cache_tokens are rejected, like the real service does.
+    """
+
+    def __init__(self, respond=None, latency=None, system_instruction=SYSTEM_INSTRUCTION,
+                 min_cache_tokens=0, cached_token_rate=0.25, model_name='stub'):
+        self.respond = respond or (lambda contents: json.dumps({"explanation": "stub"}))
+        self.latency = latency
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.min_cache_tokens = min_cache_tokens
+        self.cached_token_rate = cached_token_rate
+        self.requests = 0
+        self.billed_input_tokens = 0.0
+        self.context_caches = {}
+
+    def _bill(self, contents, context_cache):
+        self.requests += 1
+        if context_cache is None:
+            self.billed_input_tokens += estimate_tokens(self.system_instruction) + estimate_prompt_tokens(contents)
+        else:
+            if context_cache.name not in self.context_caches:
+                raise ValueError(f"Cached content {context_cache.name} not found")
+            self.billed_input_tokens += context_cache.tokens * self.cached_token_rate + estimate_prompt_tokens(contents)
+
+    async def generate(self, contents, context_cache=None, response_schema=None):
+        self._bill(contents, context_cache)
+        if self.latency is not None:
+            await asyncio.sleep(self.latency())
+        return collections.namedtuple('StubResponse', ['text'])(self.respond(contents))
+
+    def create_context_cache(self, contents, ttl_seconds):
+        tokens = estimate_tokens(self.system_instruction) + estimate_prompt_tokens(contents)
+        if tokens < self.min_cache_tokens:
+            raise ValueError(f"Cached content needs at least {self.min_cache_tokens} tokens, got {tokens}")
+        context_cache = collections.namedtuple('StubCachedContent', ['name', 'tokens'])(str(uuid.uuid4()), tokens)
+        self.context_caches[context_cache.name] = context_cache
+        return context_cache
+
+    def delete_context_cache(self, context_cache):
+        self.context_caches.pop(context_cache.name, None)
+
+MODEL_BACKEND = VertexModelBackend()
+
+# Server-side context caching settings
+CONTEXT_CACHING_ENABLED = False  # Cache the system instruction and reused content with the model backend; disables website compaction
+CONTEXT_CACHE_TTL_SECONDS = 60 * 60
+CONTEXT_CACHE_REFRESH_MARGIN_SECONDS = 60  # Caches this close to expiry are recreated instead of used
+CONTEXT_CACHE_MIN_REUSE = 2  # Content is cached once it has been requested this many times
+CONTEXT_CACHE_MAX_ENTRIES = 50  # Content caches kept alive; least recently used are deleted beyond this
+# Vertex AI rejects cached content smaller than the model's minimum; models are matched by name prefix.
+# Gemini 1.5's minimum is above any scraped page (at most 100000 characters, about 25000 tokens), so with
+# it only the largest text items can be cached.
+CONTEXT_CACHE_MIN_TOKENS_BY_MODEL = {
+    'gemini-1.5-pro': 32768,
+    'gemini-1.5-flash': 32768,
+    'gemini-2.0-flash': 4096,
+    'gemini-2.5-pro': 2048,
+    'gemini-2.5-flash': 2048,
+}
+CONTEXT_CACHE_MIN_TOKENS = 32768  # Minimum for models not listed above
+CONTEXT_CACHE_RETRY_SECONDS = 10 * 60  # Content whose cache could not be created is retried after this long
+CONTEXT_REFERENCE_PROMPT = "Please evaluate the content provided above."
+
+# Function to look up the minimum context cache size of a model
+def context_cache_min_tokens(model_name):
+    """
+    Look up the smallest context cache the backend accepts for a model.
+
+    Args:
+        model_name (str): The model name, possibly with a version suffix (e.g. gemini-1.5-pro-002).
+
+    Returns:
+        int: The minimum number of tokens in a context cache.
+    """
+    prefixes = [prefix for prefix in CONTEXT_CACHE_MIN_TOKENS_BY_MODEL if model_name.startswith(prefix)]
+    if not prefixes:
+        return CONTEXT_CACHE_MIN_TOKENS
+    return CONTEXT_CACHE_MIN_TOKENS_BY_MODEL[max(prefixes, key=len)]
+
+# Manages server-side cached context for the system instruction and reused content
+class ContextCacheManager:
+    """
+    Register the system instruction, and any content requested at least CONTEXT_CACHE_MIN_REUSE
+    times (e.g. a large page evaluated by several personas), as cached context with the model
+    backend. Requests then only send the persona plus a short reference. Caches are recreated
+    when they near expiry and deleted when evicted or on close(). Content below the minimum cache
+    size of the backend's model (min_tokens overrides it) is never cached. If the backend cannot create a cache, the content is
+    sent uncached for CONTEXT_CACHE_RETRY_SECONDS before caching is tried again; if a cached
+    request fails, the request is sent uncached instead.
+    """
+
+    def __init__(self, backend, ttl_seconds=CONTEXT_CACHE_TTL_SECONDS, min_reuse=CONTEXT_CACHE_MIN_REUSE,
+                 max_entries=CONTEXT_CACHE_MAX_ENTRIES, min_tokens=None):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.min_reuse = min_reuse
+        self.max_entries = max_entries
+        self.min_tokens = context_cache_min_tokens(backend.model_name) if min_tokens is None else min_tokens
+        self.cached_requests = 0
+        self.uncached_requests = 0
+        self._lock = threading.Lock()
+        self._caches = collections.OrderedDict()  # content key -> (cached context, expires_at)
+        self._request_counts = collections.OrderedDict()
+        self._unavailable = collections.OrderedDict()  # content key -> time caching may be retried
+
+    def _content_key(self, input_task):
+        return hash_text("\n".join(normalize_prompt_part(part) for part in input_task))
+
+    def _should_cache_content(self, key):
+        with self._lock:
+            count = self._request_counts.pop(key, 0) + 1
+            self._request_counts[key] = count
+            if len(self._request_counts) > 10 * self.max_entries:
+                self._request_counts.popitem(last=False)
+        return count >= self.min_reuse
+
+    def _get_or_create(self, key, contents):
+        now = time.time()
+        with self._lock:
+            retry_at = self._unavailable.get(key)
+            if retry_at is not None:
+                if retry_at > now:
+                    return None
+                del self._unavailable[key]
+        # Content too small to be cached would only fail at the backend
+        if estimate_tokens(SYSTEM_INSTRUCTION) + estimate_prompt_tokens(contents) < self.min_tokens:
+            return None
+        expired = None
+        with self._lock:
+            entry = self._caches.get(key)
+            if entry is not None:
+                if entry[1] - CONTEXT_CACHE_REFRESH_MARGIN_SECONDS > now:
+                    self._caches.move_to_end(key)
+                    return entry[0]
+                expired = self._caches.pop(key)[0]
+        if expired is not None:
+            self._delete(expired)
+        try:
+            context_cache = self.backend.create_context_cache(contents, self.ttl_seconds)
+        except Exception as e:
+            print(f"Context caching unavailable, sending requests uncached: {e}")
+            with self._lock:
+                self._unavailable[key] = now + CONTEXT_CACHE_RETRY_SECONDS
+                if len(self._unavailable) > 10 * self.max_entries:
+                    self._unavailable.popitem(last=False)
+            return None
+        evicted = []
+        with self._lock:
+            self._caches[key] = (context_cache, now + self.ttl_seconds)
+            while len(self._caches) > self.max_entries + 1:  # +1 for the shared system instruction cache
+                oldest_key = next(k for k in self._caches if k != 'system')
+                evicted.append(self._caches.pop(oldest_key)[0])
+        for context_cache_to_delete in evicted:
+            self._delete(context_cache_to_delete)
+        return context_cache
+
+    def _delete(self, context_cache):
+        try:
+            self.backend.delete_context_cache(context_cache)
+        except Exception as e:
+            print(f"Failed to delete cached context: {e}")
+
+    def _plan(self, persona, input_task):
+        key = self._content_key(input_task)
+        if self._should_cache_content(key):
+            context_cache = self._get_or_create(key, input_task)
+            if context_cache is not None:
+                return context_cache, [persona, CONTEXT_REFERENCE_PROMPT], key
+        context_cache = self._get_or_create('system', [])
+        return context_cache, [persona] + input_task, 'system'
+
+    def _drop(self, key):
+        with self._lock:
+            entry = self._caches.pop(key, None)
+        if entry is not None:
+            self._delete(entry[0])
+
+    async def generate(self, persona, input_task, response_schema=None):
+        """
+        Generate a response, using cached context where available. Creating and deleting
+        caches blocks, so it runs in a worker thread.
+
+        Args:
+            persona (str): The persona part of the prompt.
+            input_task (list): The input task for the model.
+            response_schema (dict): Optional schema the JSON response is constrained to.
+
+        Returns:
+            GenerationResponse: The model response.
+        """
+        context_cache, contents, key = await asyncio.to_thread(self._plan, persona, input_task)
+        if context_cache is not None:
+            try:
+                response = await self.backend.generate(contents, context_cache, response_schema)
+                self.cached_requests += 1
+                return response
+            except Exception as e:
+                print(f"Cached request failed, retrying uncached: {e}")
+                await asyncio.to_thread(self._drop, key)
+        self.uncached_requests += 1
+        return await self.backend.generate([persona] + input_task, response_schema=response_schema)
+
+    def close(self):
+        """
+        Delete all cached contexts held by this manager.
+        """
+        with self._lock:
+            entries = list(self._caches.values())
+            self._caches.clear()
+        for context_cache, _ in entries:
+            self._delete(context_cache)
+
+    def report(self):
+        """
+        Print context caching statistics.
+        """
+        print(f"Context caching: {self.cached_requests} cached requests, {self.uncached_requests} uncached, "
+              f"{len(self._caches)} live caches.")
+
+CONTEXT_CACHE = ContextCacheManager(MODEL_BACKEND) if CONTEXT_CACHING_ENABLED else None
+
+# Function to compare billed input tokens with and without context caching on a stand-in backend
+def benchmark_context_caching(num_personas=5, content_chars=160000, model_name=MODEL_NAME):
+    """
+    Evaluate one large content item for several personas against a StubModelBackend, with and
+    without context caching, and compare the billed input tokens. The stand-in backend enforces
+    the model's minimum cache size, so content below it shows no saving, as in production.
+
+    Args:
+        num_personas (int): Number of personas evaluating the same content.
+        content_chars (int): Size of the content item in characters.
+        model_name (str): The model whose minimum cache size applies.
+
+    Returns:
+        dict: Billed input tokens with and without caching.
+    """
+    content = ["Please evaluate the content of this website: ", "animal welfare " * (content_chars // 15)]
+    personas = [f"Your synthetic persona details: persona {index}" for index in range(num_personas)]
+
+    async def evaluate(generate):
+        for persona in personas:
+            await generate(persona)
+
+    min_cache_tokens = context_cache_min_tokens(model_name)
+    uncached_backend = StubModelBackend(min_cache_tokens=min_cache_tokens, model_name=model_name)
+    run_async(evaluate(lambda persona: uncached_backend.generate([persona] + content)))
+
+    cached_backend = StubModelBackend(min_cache_tokens=min_cache_tokens, model_name=model_name)
+    manager = ContextCacheManager(cached_backend, min_reuse=1)
+    run_async(evaluate(lambda persona: manager.generate(persona, content)))
+    manager.close()
+
+    print(f"Billed input tokens for {num_personas} personas: {uncached_backend.billed_input_tokens:.0f} uncached, "
+          f"{cached_backend.billed_input_tokens:.0f} with context caching.")
+    return {'uncached': uncached_backend.billed_input_tokens, 'cached': cached_backend.billed_input_tokens}
+
+# Model rate limiting settings
+MODEL_REQUESTS_PER_MINUTE = 60  # Client-side request quota
+MODEL_TOKENS_PER_MINUTE = 1_000_000  # Client-side input token quota
+MODEL_INITIAL_CONCURRENCY = 4  # Model calls in flight at start; adapted with AIMD between the bounds below
+MODEL_MIN_CONCURRENCY = 1
+MODEL_MAX_CONCURRENCY = 32
+MODEL_DECREASE_FACTOR = 0.5  # Multiplicative decrease of the concurrency limit on rate-limit errors
+MODEL_DECREASE_COOLDOWN_SECONDS = 5  # Rate-limit errors within this window only decrease the limit once
+MODEL_MAX_ATTEMPTS = 5  # Attempts per model request for rate-limit and transient errors
+MODEL_RETRY_MAX_WAIT_SECONDS = 60  # Upper bound of the jittered exponential backoff between attempts
+
+RATE_LIMIT_ERROR_NAMES = ('ResourceExhausted', 'TooManyRequests')
+TRANSIENT_ERROR_NAMES = ('ServiceUnavailable', 'DeadlineExceeded', 'InternalServerError', 'GatewayTimeout', 'Aborted')
+
+# Function to check whether an error is a rate-limit or quota error
+def is_rate_limit_error(error):
+    """
+    Check whether an exception signals rate limiting or quota exhaustion (HTTP 429).
+
+    Args:
+        error (Exception): The exception raised by the model call.
+
+    Returns:
+        bool: True for rate-limit errors.
+    """
+    return type(error).__name__ in RATE_LIMIT_ERROR_NAMES or getattr(error, 'code', None) == 429
+
+# Function to check whether a model call should be retried after an error
+def is_retryable_error(error):
+    """
+    Check whether an exception is a rate-limit or transient server error worth retrying.
+
+    Args:
+        error (Exception): The exception raised by the model call.
+
+    Returns:
+        bool: True if the call should be retried.
+    """
+    return is_rate_limit_error(error) or type(error).__name__ in TRANSIENT_ERROR_NAMES or \
+        getattr(error, 'code', None) in (500, 503, 504)
+
+# Client-side quota and adaptive concurrency control for model calls
+class ModelRateController:
+    """
+    Token-bucket limiter for requests and input tokens per minute, combined with AIMD
+    adaptive concurrency: every successful call raises the concurrency limit by 1/limit
+    (about +1 per round of calls), and a rate-limit error halves it (at most once per
+    cooldown window).
+    """
+
+    def __init__(self, requests_per_minute=MODEL_REQUESTS_PER_MINUTE, tokens_per_minute=MODEL_TOKENS_PER_MINUTE,
+                 initial_concurrency=MODEL_INITIAL_CONCURRENCY, min_concurrency=MODEL_MIN_CONCURRENCY,
+                 max_concurrency=MODEL_MAX_CONCURRENCY):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(initial_concurrency)
+        self.in_flight = 0
+        self.metrics = collections.Counter()
+        self._request_tokens = float(requests_per_minute)
+        self._input_tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._refilled_at
+            self._refilled_at = now
+            self._request_tokens = min(self.request_capacity,
+                                       self._request_tokens + elapsed * self.request_capacity / 60)
+            self._input_tokens = min(self.token_capacity, self._input_tokens + elapsed * self.token_capacity / 60)
+            if self.in_flight >= int(self.concurrency_limit):
+                return 0.05
+            if self._request_tokens < 1 or self._input_tokens < tokens:
+                request_wait = (1 - self._request_tokens) * 60 / self.request_capacity
+                token_wait = (tokens - self._input_tokens) * 60 / self.token_capacity
+                return max(0.01, request_wait, token_wait)
+            self._request_tokens -= 1
+            self._input_tokens -= tokens
+            self.in_flight += 1
+            return 0
+
+    async def acquire(self, tokens):
+        """
+        Wait until a request of the given size fits the quotas and the concurrency limit.
+
+        Args:
+            tokens (int): Estimated input tokens of the request.
+        """
+        tokens = min(tokens, self.token_capacity)
+        started = time.monotonic()
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+        self.metrics['throttled_seconds'] += time.monotonic() - started
+
+    def release(self, error=None):
+        """
+        Release a concurrency slot and adapt the concurrency limit to the call's outcome.
+
+        Args:
+            error (Exception): The exception the call raised, or None on success.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            self.metrics['requests'] += 1
+            if error is None:
+                self.metrics['successes'] += 1
+                self.concurrency_limit = min(self.max_concurrency,
+                                             self.concurrency_limit + 1 / self.concurrency_limit)
+            elif is_rate_limit_error(error):
+                self.metrics['rate_limited'] += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= MODEL_DECREASE_COOLDOWN_SECONDS:
+                    self._last_decrease = now
+                    self.concurrency_limit = max(self.min_concurrency,
+                                                 self.concurrency_limit * MODEL_DECREASE_FACTOR)
+            elif isinstance(error, asyncio.CancelledError):
+                self.metrics['cancelled'] += 1
+            else:
+                self.metrics['errors'] += 1
+
+    def report(self):
+        """
+        Print rate limiting metrics.
+        """
+        print(f"Model calls: {self.metrics['requests']} requests, {self.metrics['successes']} succeeded, "
+              f"{self.metrics['rate_limited']} rate-limited, {self.metrics['errors']} other errors, "
+              f"{self.metrics['retries']} retries, {self.metrics['throttled_seconds']:.1f}s throttled, "
+              f"concurrency limit {self.concurrency_limit:.1f}.")
+
+MODEL_RATE_CONTROLLER = ModelRateController()
+
+# Function to record a retry in the rate controller's metrics
+def _record_model_retry(retry_state):
+    MODEL_RATE_CONTROLLER.metrics['retries'] += 1
+    print(f"Model call failed ({retry_state.outcome.exception()}); retry {retry_state.attempt_number} "
+          f"of {MODEL_MAX_ATTEMPTS - 1}...")
+
+MODEL_RETRY_POLICY = dict(
+    retry=retry_if_exception(is_retryable_error),
+    wait=wait_random_exponential(multiplier=1, max=MODEL_RETRY_MAX_WAIT_SECONDS),
+    stop=stop_after_attempt(MODEL_MAX_ATTEMPTS),
+    before_sleep=_record_model_retry,
+    reraise=True,
+)
+
+# Function to send one rate-limited request to the model backend
+async def send_model_request(persona, input_task, backend=None, response_schema=None, on_granted=None):
+    """
+    Send a single request to the model backend (through the context cache when enabled),
+    within the client-side quotas and adaptive concurrency limit.
+
+    Args:
+        persona (str): The persona part of the prompt.
+        input_task (list): The input task for the model.
+        backend: Optional backend to use instead of MODEL_BACKEND, e.g. a cascade tier.
+        response_schema (dict): Optional schema the JSON response is constrained to.
+        on_granted (callable): Optional callback run once the rate controller lets the request through.
+
+    Returns:
+        GenerationResponse: The model response.
+    """
+    await MODEL_RATE_CONTROLLER.acquire(
+        estimate_tokens(SYSTEM_INSTRUCTION) + estimate_prompt_tokens([persona] + input_task)
+    )
+    if on_granted is not None:
+        on_granted()
+    try:
+        if backend is not None:
+            response = await backend.generate([persona] + input_task, response_schema=response_schema)
+        elif CONTEXT_CACHE is not None:
+            response = await CONTEXT_CACHE.generate(persona, input_task, response_schema)
+        else:
+            response = await MODEL_BACKEND.generate([persona] + input_task, response_schema=response_schema)
+    except BaseException as e:
+        # Cancelled hedges release their slot too
+        MODEL_RATE_CONTROLLER.release(e)
+        raise
+    MODEL_RATE_CONTROLLER.release()
+    return response
+
+# Hedged request settings
+HEDGING_ENABLED = False  # Send a duplicate request when a model call runs past the hedge percentile
+HEDGE_PERCENTILE = 95  # Live latency percentile after which a call is hedged
+HEDGE_MAX_EXTRA_FRACTION = 0.05  # Cap on hedges as a fraction of all requests
+HEDGE_MIN_SAMPLES = 20  # Latencies observed before hedging starts
+HEDGE_LATENCY_WINDOW = 500  # Recent latencies the percentile is computed over
+
+# Hedges slow requests with a duplicate once they run past a live latency percentile
+class RequestHedger:
+    """
+    Tracks the latency of recent requests and, once a request has run longer than the
+    configured percentile, starts a duplicate. Requests report when the rate controller lets
+    them through (the granted callback they are called with), and both the latency samples and
+    the hedge delay start from then, so time queued behind client-side throttling never
+    triggers hedges; the first to succeed wins and the other is cancelled. Hedges are capped
+    at max_extra_fraction of all requests so they cannot amplify an overload.
+    """
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, max_extra_fraction=HEDGE_MAX_EXTRA_FRACTION,
+                 min_samples=HEDGE_MIN_SAMPLES, window=HEDGE_LATENCY_WINDOW):
+        self.percentile = percentile
+        self.max_extra_fraction = max_extra_fraction
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=window)
+        self.metrics = collections.Counter()
+        self._lock = threading.Lock()
+
+    def hedge_delay(self):
+        """
+        Get the current hedge delay: the configured percentile of recent request latencies.
+
+        Returns:
+            float: Seconds after which a request is hedged, or None while there are too few samples.
+        """
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return float(np.percentile(self.latencies, self.percentile))
+
+    def _start_hedge(self):
+        # Reserve a hedge within the extra request budget
+        with self._lock:
+            if self.metrics['hedges'] + 1 > self.max_extra_fraction * self.metrics['requests']:
+                self.metrics['hedges_skipped'] += 1
+                return False
+            self.metrics['hedges'] += 1
+            return True
+
+    async def _timed(self, request_factory, granted=None):
+        started = []
+
+        def on_granted():
+            started.append(time.monotonic())
+            if granted is not None:
+                granted.set()
+        try:
+            response = await request_factory(on_granted)
+        finally:
+            # Also release a caller waiting for the grant if the request failed before it
+            if granted is not None:
+                granted.set()
+        if started:
+            with self._lock:
+                self.latencies.append(time.monotonic() - started[0])
+        return response
+
+    async def run(self, request_factory):
+        """
+        Run a request, hedging it if it runs past the hedge delay.
+
+        Args:
+            request_factory (callable): Function returning a new coroutine that sends the request;
+                it is called with a callback to run once the rate controller has granted the request.
+
+        Returns:
+            The response of whichever attempt succeeded first.
+        """
+        self.metrics['requests'] += 1
+        delay = self.hedge_delay()
+        granted = asyncio.Event()
+        primary = asyncio.ensure_future(self._timed(request_factory, granted))
+        if delay is None:
+            return await primary
+        # The hedge delay runs from the moment the rate controller lets the primary through
+        await granted.wait()
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self._start_hedge():
+            return await primary
+        hedge = asyncio.ensure_future(self._timed(request_factory))
+        pending = {primary, hedge}
+        first_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.metrics['hedge_wins'] += 1
+                        return task.result()
+                    first_error = first_error or task.exception()
+            raise first_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def report(self):
+        """
+        Print hedging metrics.
+        """
+        delay = self.hedge_delay()
+        delay_text = f"{delay:.2f}s" if delay is not None else "not yet measured"
+        print(f"Request hedging: {self.metrics['hedges']} hedges for {self.metrics['requests']} requests "
+              f"({self.metrics['hedge_wins']} won, {self.metrics['hedges_skipped']} skipped by the cap), "
+              f"p{self.percentile} hedge delay {delay_text}.")
+
+REQUEST_HEDGER = RequestHedger() if HEDGING_ENABLED else None
+
+# Function to report latency percentiles
+def latency_percentiles(latencies):
+    """
+    Compute the p50, p95 and p99 of a list of latencies.
+
+    Args:
+        latencies (list): Latencies in seconds.
+
+    Returns:
+        dict: Latency in seconds for each percentile.
+    """
+    return {f"p{q}": float(np.percentile(latencies, q)) for q in (50, 95, 99)}
+
+# Function to benchmark request latency with and without hedging against a stub backend
+def benchmark_hedging(num_requests=400, concurrency=16, base_latency=0.05, slow_fraction=0.02, slow_factor=10,
+                      seed=0):
+    """
+    Send requests to a StubModelBackend with an injected latency distribution (log-normal
+    around base_latency, with slow_fraction of requests slow_factor times slower) and compare
+    end-to-end latency percentiles with and without hedging.
+
+    Args:
+        num_requests (int): Requests sent per run.
+        concurrency (int): Requests in flight at once.
+        base_latency (float): Median latency of a normal request in seconds.
+        slow_fraction (float): Fraction of requests in the slow tail.
+        slow_factor (float): How much slower tail requests are.
+        seed (int): Seed of the latency distribution.
+
+    Returns:
+        dict: Latency percentiles for each mode, and the hedges sent.
+    """
+    rng = np.random.default_rng(seed)
+
+    def latency():
+        value = base_latency * rng.lognormal(0, 0.25)
+        return value * slow_factor if rng.random() < slow_fraction else value
+
+    backend = StubModelBackend(latency=latency)
+    contents = ["Your synthetic persona details: benchmark", "Please evaluate this text: benchmark"]
+
+    def request(granted):
+        # The stand-in backend has no rate controller in front of it, so requests are granted at once
+        granted()
+        return backend.generate(contents)
+
+    async def run(hedger):
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def one():
+            async with semaphore:
+                started = time.monotonic()
+                if hedger is None:
+                    await backend.generate(contents)
+                else:
+                    await hedger.run(request)
+                latencies.append(time.monotonic() - started)
+
+        # Warm up the hedger's latency window before measuring
+        if hedger is not None:
+            for _ in range(hedger.min_samples):
+                await hedger.run(request)
+            hedger.metrics.clear()
+        await asyncio.gather(*(one() for _ in range(num_requests)))
+        return latencies
+
+    results = {'unhedged': latency_percentiles(run_async(run(None)))}
+    hedger = RequestHedger()
+    results['hedged'] = latency_percentiles(run_async(run(hedger)))
+    results['hedges'] = hedger.metrics['hedges']
+    for mode in ('unhedged', 'hedged'):
+        percentiles = ", ".join(f"{name} {value * 1000:.0f} ms" for name, value in results[mode].items())
+        print(f"{mode.capitalize()} latency over {num_requests} requests: {percentiles}.")
+    print(f"Hedging sent {results['hedges']} extra requests ({results['hedges'] / num_requests:.1%}).")
+    return results
+
+# Function to send one model request, hedging slow calls and retrying transient failures
+@retry(**MODEL_RETRY_POLICY)
+async def call_model(persona, input_task, backend=None, response_schema=None):
+    """
+    Send a request to the model backend within the client-side quotas and adaptive concurrency
+    limit. Slow calls are hedged when hedging is enabled, and rate-limit and transient errors
+    are retried with jittered exponential backoff.
+
+    Args:
+        persona (str): The persona part of the prompt.
+        input_task (list): The input task for the model.
+        backend: Optional backend to use instead of MODEL_BACKEND.
+        response_schema (dict): Optional schema the JSON response is constrained to.
+
+    Returns:
+        GenerationResponse: The model response.
+    """
+    if REQUEST_HEDGER is not None:
+        return await REQUEST_HEDGER.run(
+            lambda granted: send_model_request(persona, input_task, backend, response_schema, granted)
+        )
+    return await send_model_request(persona, input_task, backend, response_schema)
+
+# Response cache settings
+RESPONSE_CACHE_ENABLED = True  # Set to False to neither store nor replay model responses
+# Replaying a cached response would upload a byte-identical annotation as if it were a new sample,
+# so production runs only store responses; dry runs and benchmarks replay them
+RESPONSE_CACHE_REPLAY = DRYRUN
+RESPONSE_CACHE_PATH = 'response_cache.sqlite3'
+RESPONSE_CACHE_MAX_ENTRIES = 100000  # Least recently used entries are evicted beyond this size
+
+# Function to hash a piece of text for use in cache keys
+def hash_text(text):
+    """
+    Return the SHA-256 hex digest of a text.
+
+    Args:
+        text (str): The text to hash.
+
+    Returns:
+        str: The hex digest.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# Function to normalize one prompt part for content addressing
+def normalize_prompt_part(part):
+    """
+    Normalize a prompt part so that equivalent content hashes identically. Text is
+    whitespace-collapsed; non-text parts (e.g. images) are serialized to JSON.
+
+    Args:
+        part (str or Part): The prompt part.
+
+    Returns:
+        str: The normalized representation.
+    """
+    if isinstance(part, str):
+        return " ".join(part.split())
+    to_dict = getattr(part, 'to_dict', None)
+    if to_dict is not None:
+        return json.dumps(to_dict(), sort_keys=True, default=str)
+    return repr(part)
+
+# Function to build the content-addressed cache key for a model request
+def response_cache_key(persona, input_task, model_name=MODEL_NAME):
+    """
+    Build a cache key from the model name, the system instruction, the persona and the
+    normalized content of the request.
+
+    Args:
+        persona (str): The persona part of the prompt.
+        input_task (list): The input task for the model.
+        model_name (str): The model the request is sent to.
+
+    Returns:
+        str: The cache key.
+    """
+    content = "\n".join(normalize_prompt_part(part) for part in input_task)
+    return ":".join([model_name, hash_text(SYSTEM_INSTRUCTION), hash_text(persona), hash_text(content)])
+
+# On-disk cache of model responses with least-recently-used eviction
+class ResponseCache:
+    """
+    SQLite-backed cache mapping request keys (see response_cache_key) to model response text.
+    Once more than max_entries responses are stored, the least recently used are evicted.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        print(f"Opened response cache at {path} with {self._size} entries.")
+
+    def get(self, key):
+        """
+        Look up a cached response and mark it as recently used.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            str: The cached response text, or None on a miss.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            return row[0]
+
+    def put(self, key, response_text):
+        """
+        Store a response, evicting the least recently used entries if the cache is full.
+
+        Args:
+            key (str): The cache key.
+            response_text (str): The model response text.
+        """
+        with self._lock:
+            inserted = self._connection.execute(
+                "INSERT OR IGNORE INTO responses (key, response, last_used) VALUES (?, ?, ?)",
+                (key, response_text, time.time())
+            ).rowcount
+            self._size += inserted
+            if self._size > self.max_entries:
+                excess = self._size - self.max_entries
+                self._connection.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,)
+                )
+                self._size -= excess
+            self._connection.commit()
+
+    def report(self):
+        """
+        Print cache hit/miss statistics.
+        """
+        print(f"Response cache: {self.hits} hits, {self.misses} misses, {self._size} entries.")
+
+RESPONSE_CACHE = ResponseCache() if RESPONSE_CACHE_ENABLED else None
+
+# Function to store a response in the cache if it is usable
+def cache_response(key, response_text):
+    """
+    Store a model response in the response cache if JSON can be recovered from it, so that
+    failed generations are retried rather than replayed.
+
+    Args:
+        key (str): The cache key.
+        response_text (str): The model response text.
+    """
+    try:
+        parse_model_json(response_text, (dict, list))
+    except (TypeError, ValueError):
+        return
+    RESPONSE_CACHE.put(key, response_text)
+
+# Function to send a request to the model, consulting the response cache first
+async def generate_response(persona, input_task, use_cache=True, backend=None, response_schema=None):
+    """
+    Generate a model response for a persona and input task. Responses are stored in the
+    response cache, and served from it when an identical request has been answered before
+    and RESPONSE_CACHE_REPLAY is set.
+
+    Args:
+        persona (str): The persona part of the prompt.
+        input_task (list): The input task for the model.
+        use_cache (bool): Set to False to bypass the response cache.
+        backend: Optional backend to use instead of MODEL_BACKEND, e.g. a cascade tier.
+        response_schema (dict): Optional schema the JSON response is constrained to.
+
+    Returns:
+        str: The model response text.
+    """
+    use_cache = use_cache and RESPONSE_CACHE is not None
+    if use_cache:
+        key = response_cache_key(persona, input_task, MODEL_NAME if backend is None else backend.model_name)
+    if use_cache and RESPONSE_CACHE_REPLAY:
+        cached = await asyncio.to_thread(RESPONSE_CACHE.get, key)
+        if cached is not None:
+            print("Using cached model response.")
+            return cached
+    response = await call_model(persona, input_task, backend, response_schema)
+    if use_cache:
+        await asyncio.to_thread(cache_response, key, response.text)
+    return response.text
+
+# Structured output settings
+STRUCTURED_OUTPUT_ENABLED = True  # Constrain model responses to the evaluation schema
+# Rating fields are taken from the system instruction so the schema cannot drift from the prompt
+RATING_FIELDS = tuple(re.findall(r'^- (rating_\w+): 1-5 scale', SYSTEM_INSTRUCTION, flags=re.M))
+RATING_MIN = 1
+RATING_MAX = 5
+REASK_PROMPT = '''
+A previous response to this request {problem}. That response was:
+{response}
+Respond again with only the raw JSON object (no ```json or ``` tags) containing every required field.
+'''
+
+# Function to build the response schema of one evaluation
+def build_evaluation_schema(index_field=None):
+    """
+    Build the JSON schema of an evaluation object from the fields in SYSTEM_INSTRUCTION.
+
+    Args:
+        index_field (str): Optional integer field added to each evaluation, e.g. "item_index".
+
+    Returns:
+        dict: The OpenAPI-style schema accepted by the model's response_schema option.
+    """
+    properties = {
+        "is_content_harmful_to_animals": {"type": "string", "enum": ["Yes", "No"]},
+        "explanation": {"type": "string"},
+    }
+    for field in RATING_FIELDS:
+        properties[field] = {"type": "integer", "description": f"{RATING_MIN}-{RATING_MAX} scale"}
+    if index_field is not None:
+        properties[index_field] = {"type": "integer"}
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+# Function to build the response schema of an array of indexed evaluations
+def build_indexed_evaluations_schema(index_field):
+    """
+    Build the JSON schema of an array of evaluations addressed by an index field.
+
+    Args:
+        index_field (str): The field holding each evaluation's index, e.g. "persona_index".
+
+    Returns:
+        dict: The schema of the evaluation array, or None if structured output is disabled.
+    """
+    if not STRUCTURED_OUTPUT_ENABLED:
+        return None
+    return {"type": "array", "items": build_evaluation_schema(index_field)}
+
+EVALUATION_SCHEMA = build_evaluation_schema() if STRUCTURED_OUTPUT_ENABLED else None
+
+PARSE_STATS = collections.Counter()
+
+# Function to scan a JSON value and find where it ends
+def _scan_json(text):
+    # Returns the end of the first balanced value starting at text[0] (or None if it is truncated),
+    # plus the closers still open and whether the text ends inside a string
+    closers = []
+    in_string = escaped = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if not closers or closers.pop() != char:
+                raise ValueError("Unbalanced JSON brackets.")
+            if not closers:
+                return index + 1, closers, False, False
+    return None, closers, in_string, escaped
+
+# Function to complete a truncated JSON value
+def repair_truncated_json(text):
+    """
+    Complete a truncated JSON object or array: close the open string and brackets, dropping
+    trailing members until the result parses.
+
+    Args:
+        text (str): The truncated JSON text, starting at its opening bracket.
+
+    Returns:
+        The parsed JSON value.
+
+    Raises:
+        ValueError: If no prefix of the text can be completed into valid JSON.
+    """
+    while text:
+        _, closers, in_string, escaped = _scan_json(text)
+        closed = text[:-1] if escaped else text
+        closed = closed + ('"' if in_string else '') + ''.join(reversed(closers))
+        try:
+            return json.loads(closed)
+        except json.JSONDecodeError:
+            cut = text.rfind(',')
+            text = text[:cut] if cut > 0 else ''
+    raise ValueError("Truncated JSON could not be repaired.")
+
+# Function to parse a model response as JSON, tolerating common formatting problems
+def parse_model_json(response_text, expected=dict, stats=None):
+    """
+    Parse a model response as JSON. If it does not parse as is, strip code fences, extract the
+    first balanced JSON object (or array) and repair truncated output.
+
+    Args:
+        response_text (str): The model response text.
+        expected (type): The expected JSON type, dict or list (or a tuple of both).
+        stats (collections.Counter): Optional counter of strict and recovered parses.
+
+    Returns:
+        The parsed JSON value.
+
+    Raises:
+        ValueError: If no JSON value of the expected type can be recovered.
+    """
+    try:
+        value = json.loads(response_text)
+        if isinstance(value, expected):
+            if stats is not None:
+                stats['strict'] += 1
+            return value
+    except json.JSONDecodeError:
+        pass
+    text = re.sub(r'```(?:json)?', '', response_text)
+    openers = [opener for opener, kind in (('{', dict), ('[', list))
+               if kind is expected or (isinstance(expected, tuple) and kind in expected)]
+    starts = [index for index in (text.find(opener) for opener in openers) if index >= 0]
+    if not starts:
+        if stats is not None:
+            stats['unrecoverable'] += 1
+        raise ValueError("No JSON value found in the response.")
+    text = text[min(starts):]
+    try:
+        end = _scan_json(text)[0]
+        value = json.loads(text[:end]) if end is not None else repair_truncated_json(text)
+        if stats is not None and end is None:
+            stats['repaired_truncation'] += 1
+    except ValueError:
+        if stats is not None:
+            stats['unrecoverable'] += 1
+        raise
+    if stats is not None:
+        stats['recovered'] += 1
+    return value
+
+# Function to coerce a rating to an integer within the rating scale
+def coerce_rating(value):
+    """
+    Coerce a rating such as 4, 4.6, "4" or "4/5" to an integer clamped to the rating scale.
+
+    Args:
+        value: The rating from the model response.
+
+    Returns:
+        int: The rating, or None if it is not a number.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        match = re.search(r'-?\d+(?:\.\d+)?', value)
+        if match is None:
+            return None
+        value = float(match.group())
+    if not isinstance(value, (int, float)) or math.isnan(value):
+        return None
+    return min(RATING_MAX, max(RATING_MIN, int(round(value))))
+
+# Function to normalize the field types of one evaluation
+def normalize_evaluation(evaluation, stats=None):
+    """
+    Coerce the ratings of an evaluation to integers on the rating scale and normalize the
+    harmfulness answer and explanation. Ratings that cannot be coerced are removed.
+
+    Args:
+        evaluation (dict): The parsed evaluation.
+        stats (collections.Counter): Optional counter of coerced fields.
+
+    Returns:
+        dict: The normalized evaluation.
+    """
+    for field in RATING_FIELDS:
+        if field not in evaluation:
+            continue
+        rating = coerce_rating(evaluation[field])
+        if rating != evaluation[field] or type(rating) is not type(evaluation[field]):
+            if stats is not None:
+                stats['coerced_fields'] += 1
+            if rating is None:
+                del evaluation[field]
+                continue
+            evaluation[field] = rating
+    harmful = evaluation.get("is_content_harmful_to_animals")
+    if harmful is not None and harmful not in ("Yes", "No"):
+        evaluation["is_content_harmful_to_animals"] = \
+            "Yes" if harmful is True or str(harmful).strip().lower().startswith(("yes", "true")) else "No"
+    if "explanation" in evaluation and not isinstance(evaluation["explanation"], str):
+        evaluation["explanation"] = json.dumps(evaluation["explanation"])
+    return evaluation
+
+# Function to parse a single evaluation response
+def parse_evaluation(response_text):
+    """
+    Parse and normalize a single evaluation response with the tolerant parser.
+
+    Args:
+        response_text (str): The model response text.
+
+    Returns:
+        dict: The normalized evaluation.
+
+    Raises:
+        ValueError: If the response cannot be recovered.
+    """
+    PARSE_STATS['responses'] += 1
+    return normalize_evaluation(parse_model_json(response_text, dict, PARSE_STATS), PARSE_STATS)
+
+# Function to describe what a re-ask has to fix, or None if the evaluation is usable
+def _reask_problem(evaluation, error):
+    if evaluation is None and error is None:
+        return "did not include an evaluation for this persona"
+    if evaluation is None:
+        return f"could not be parsed as JSON ({str(error).rstrip('.')})"
+    missing = [field for field in RATING_FIELDS if field not in evaluation]
+    if missing:
+        return f"was missing these fields or gave them no numeric value: {', '.join(missing)}"
+    return None
+
+# Function to merge a re-asked evaluation into a partially usable one
+def _merge_reask(evaluation, reasked):
+    if reasked is None:
+        return evaluation
+    if evaluation is None:
+        return reasked
+    for field, value in reasked.items():
+        evaluation.setdefault(field, value)
+    return evaluation
+
+# Function to re-ask the model for an evaluation that is missing or incomplete
+async def complete_evaluation(evaluation, error, response_text, input_task, account, task_type=None):
+    """
+    Return an evaluation if every rating is present. Otherwise (it could not be parsed, was
+    missing from the response, or lacks ratings) re-ask the model once, quoting the previous
+    response and naming the problem, and merge the answer into the usable part. Evaluations
+    that are still incomplete after the re-ask are discarded rather than filled with defaults.
+
+    Args:
+        evaluation (dict): The parsed evaluation, or None if there is none.
+        error (Exception): Why the response could not be parsed, or None.
+        response_text (str): The model response the evaluation was taken from.
+        input_task (list): The input task of a single evaluation for the account.
+        account (dict): The synthetic account data.
+        task_type (str): The task type.
+
+    Returns:
+        dict: The complete evaluation, or None if it could not be recovered.
+    """
+    problem = _reask_problem(evaluation, error)
+    if problem is None:
+        return evaluation
+    print(f"Re-asking the model because its response {problem}.")
+    PARSE_STATS['reasked'] += 1
+    # Quote the persona's own partial evaluation where there is one, not a whole multi-evaluation response
+    previous = json.dumps(evaluation) if evaluation is not None else response_text
+    reask_text = await generate_output_ranking(
+        input_task + [REASK_PROMPT.format(problem=problem, response=previous)], account, task_type=task_type
+    )
+    try:
+        reasked = parse_evaluation(reask_text) if reask_text is not None else None
+    except ValueError:
+        reasked = None
+    evaluation = _merge_reask(evaluation, reasked)
+    if evaluation is None or _reask_problem(evaluation, None) is not None:
+        PARSE_STATS['failed'] += 1
+        return None
+    PARSE_STATS['reask_fixed'] += 1
+    return evaluation
+
+# Function to parse an evaluation, re-asking the model only if the response is unrecoverable
+async def recover_evaluation(response_text, input_task, account, task_type=None):
+    """
+    Parse an evaluation with the tolerant parser. If it cannot be recovered, or ratings are
+    missing, re-ask the model once (see complete_evaluation).
+
+    Args:
+        response_text (str): The model response text.
+        input_task (list): The input task the response answers.
+        account (dict): The synthetic account data.
+        task_type (str): The task type.
+
+    Returns:
+        dict: The evaluation, or None if it could not be recovered.
+    """
+    evaluation = error = None
+    try:
+        evaluation = parse_evaluation(response_text)
+    except ValueError as e:
+        error = e
+    return await complete_evaluation(evaluation, error, response_text, input_task, account, task_type)
+
+# Function to report response parsing statistics
+def report_parsing():
+    """
+    Print how many responses parsed strictly, were recovered by the tolerant parser (each one
+    a paid call that is no longer thrown away), needed a re-ask, or could not be used.
+    """
+    responses = PARSE_STATS['responses']
+    if not responses:
+        return
+    failure_rate = 1 - PARSE_STATS['strict'] / responses
+    print(f"Response parsing: {responses} responses, {failure_rate:.1%} failed strict JSON parsing; "
+          f"{PARSE_STATS['recovered']} recovered by the tolerant parser "
+          f"({PARSE_STATS['repaired_truncation']} truncated), {PARSE_STATS['coerced_fields']} fields coerced, "
+          f"{PARSE_STATS['reasked']} re-asks ({PARSE_STATS['reask_fixed']} fixed), "
+          f"{PARSE_STATS['failed']} unusable. Calls saved: {PARSE_STATS['recovered']}.")
+
+# Model cascade settings
+MODEL_CASCADE_ENABLED = False  # Try the fast model first and escalate to MODEL_NAME only when needed
+FAST_MODEL_NAME = "gemini-1.5-flash"
+CASCADE_HARD_TASK_TYPES = ('image', 'html_content')  # Task types that always go to the large model
+CASCADE_LATENCY_WINDOW = 1000  # Recent latencies kept per tier and task type
+
+# Function to check a single evaluation response before it is accepted
+def validate_evaluation(response_text):
+    """
+    Check that a model response is a JSON evaluation object with every rating present and
+    within range.
+
+    Args:
+        response_text (str): The model response text.
+
+    Returns:
+        str: The reason the response is unusable ('invalid_json', 'not_object', 'missing_ratings'
+        or 'out_of_range'), or None if it is valid.
+    """
+    try:
+        response_json = parse_model_json(response_text, (dict, list))
+    except (TypeError, ValueError):
+        return 'invalid_json'
+    if not isinstance(response_json, dict):
+        return 'not_object'
+    ratings = [response_json.get(field) for field in RATING_FIELDS]
+    if any(rating is None for rating in ratings):
+        return 'missing_ratings'
+    if not all(isinstance(rating, (int, float)) and not isinstance(rating, bool) and
+               RATING_MIN <= rating <= RATING_MAX for rating in ratings):
+        return 'out_of_range'
+    return None
+
+# Evaluates with a fast model first and escalates to the large model when needed
+class ModelCascade:
+    """
+    Two-tier evaluator. Each evaluation goes to the fast backend first and is escalated to
+    the large model (MODEL_BACKEND, through the context cache when enabled) when the fast
+    response fails validation or the fast call errors. Task types in hard_task_types skip the
+    fast tier. Calls, escalations and latency are tracked per tier and per task type.
+    """
+
+    def __init__(self, fast_backend, hard_task_types=CASCADE_HARD_TASK_TYPES):
+        self.fast_backend = fast_backend
+        self.hard_task_types = hard_task_types
+        self.counts = collections.defaultdict(collections.Counter)
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=CASCADE_LATENCY_WINDOW))
+
+    def _record(self, tier, task_type, started):
+        self.counts[task_type][tier] += 1
+        self.latencies[(tier, task_type)].append(time.monotonic() - started)
+
+    def _escalate(self, task_type, reason):
+        print(f"Escalating {task_type} evaluation to {MODEL_NAME} ({reason}).")
+        self.counts[task_type]['escalated'] += 1
+        self.counts[task_type][f'escalated_{reason}'] += 1
+
+    async def generate(self, persona, input_task, task_type, use_cache=True, response_schema=None):
+        """
+        Generate an evaluation, escalating from the fast to the large model when needed.
+
+        Args:
+            persona (str): The persona part of the prompt.
+            input_task (list): The input task for the model.
+            task_type (str): The task type.
+            use_cache (bool): Set to False to bypass the response cache.
+            response_schema (dict): Optional schema the JSON response is constrained to.
+
+        Returns:
+            str: The model response text.
+        """
+        if task_type in self.hard_task_types:
+            self.counts[task_type]['hard'] += 1
+        else:
+            started = time.monotonic()
+            try:
+                response_text = await generate_response(persona, input_task, use_cache, self.fast_backend,
+                                                        response_schema)
+                reason = validate_evaluation(response_text)
+            except Exception as e:
+                print(f"Fast model call failed: {e}")
+                reason = 'error'
+            self._record('fast', task_type, started)
+            if reason is None:
+                return response_text
+            self._escalate(task_type, reason)
+        started = time.monotonic()
+        response_text = await generate_response(persona, input_task, use_cache, response_schema=response_schema)
+        self._record('large', task_type, started)
+        return response_text
+
+    def report(self):
+        """
+        Print escalation rates and latency per task type and tier.
+        """
+        for task_type, counts in sorted(self.counts.items()):
+            fast_calls = counts['fast']
+            rate = counts['escalated'] / fast_calls if fast_calls else 0.0
+            reasons = ", ".join(f"{name[len('escalated_'):]} {count}" for name, count in sorted(counts.items())
+                                if name.startswith('escalated_'))
+            tiers = []
+            for tier in ('fast', 'large'):
+                latencies = self.latencies.get((tier, task_type))
+                if latencies:
+                    percentiles = latency_percentiles(list(latencies))
+                    tiers.append(f"{tier} {counts[tier]} calls, p50 {percentiles['p50']:.2f}s, "
+                                 f"p95 {percentiles['p95']:.2f}s")
+            print(f"Cascade [{task_type}]: {counts['escalated']} of {fast_calls} fast evaluations escalated "
+                  f"({rate:.1%}{': ' + reasons if reasons else ''}), {counts['hard']} sent straight to the "
+                  f"large model; {'; '.join(tiers)}.")
+
+MODEL_CASCADE = ModelCascade(
+    VertexModelBackend(GenerativeModel(FAST_MODEL_NAME, system_instruction=SYSTEM_INSTRUCTION), FAST_MODEL_NAME)
+) if MODEL_CASCADE_ENABLED else None
+
+# Function to use Vertex AI for generating output
+async def generate_output_ranking(input_task, account, use_cache=True, task_type=None,
+                                  response_schema=EVALUATION_SCHEMA):
+    """
+    Use Vertex AI to generate an output based on the input task and account.
+
+    Args:
+        input_task (list): The input task for the model.
+        account (dict): The synthetic account data.
+        use_cache (bool): Set to False to bypass the response cache.
+        task_type (str): The task type, used by the model cascade.
+        response_schema (dict): Schema the JSON response is constrained to; defaults to one evaluation.
+
+    Returns:
+        str: The generated JSON response from the model.
+    """
+    print("Generating output ranking using the Vertex AI model...")
+    try:
+        # Construct the approach description
+        persona = render_persona(account).prompt
+
+        # Generate the response, through the model cascade for single evaluations of a known task type
+        if MODEL_CASCADE is not None and task_type is not None:
+            response_text = await MODEL_CASCADE.generate(persona, input_task, task_type, use_cache,
+                                                         response_schema)
+        else:
+            response_text = await generate_response(persona, input_task, use_cache,
+                                                    response_schema=response_schema)
+        print("Model response generated.")
+        return response_text
+    except Exception as e:
+        print(f"An error occurred while generating the output: {e}")
+        return None
+
+# Function to convert a parsed model response into Label Studio result entries
+def build_annotation_result(response_json, task_type):
+    """
+    Map the model's JSON evaluation onto Label Studio result entries.
+
+    Args:
+        response_json (dict): The parsed model response.
+        task_type (str): The task type, used as the Label Studio `to_name`.
+
+    Returns:
+        list: The Label Studio result entries.
+    """
+    result = []
+    schema_to_label = {
+        "is_content_harmful_to_animals": {
+            "from_name": "is_content_harmful_to_animals",
+            "type": "choices",
+            "value": {"choices": [response_json.get("is_content_harmful_to_animals", "No")]}
+        },
+        "explanation": {
+            "from_name": "explanation",
+            "type": "textarea",
+            "value": {"text": [response_json.get("explanation", "")]}
+        },
+        "rating_effect_on_animals": {
+            "from_name": "rating_effect_on_animals",
+            "type": "rating",
+            "value": {"rating": response_json.get("rating_effect_on_animals", 3)}
+        },
+        "rating_cultural_sensitivity": {
+            "from_name": "rating_cultural_sensitivity",
+            "type": "rating",
+            "value": {"rating": response_json.get("rating_cultural_sensitivity", 3)}
+        },
+        "rating_relevance": {
+            "from_name": "rating_relevance",
+            "type": "rating",
+            "value": {"rating": response_json.get("rating_relevance", 3)}
+        },
+        "rating_insight": {
+            "from_name": "rating_insight",
+            "type": "rating",
+            "value": {"rating": response_json.get("rating_insight", 3)}
+        },
+        "rating_trustworthiness": {
+            "from_name": "rating_trustworthiness",
+            "type": "rating",
+            "value": {"rating": response_json.get("rating_trustworthiness", 3)}
+        },
+        "rating_emotional_impact": {
+            "from_name": "rating_emotional_impact",
+            "type": "rating",
+            "value": {"rating": response_json.get("rating_emotional_impact", 3)}
+        },
+        "rating_rationality": {
+            "from_name": "rating_rationality",
+            "type": "rating",
+            "value": {"rating": response_json.get("rating_rationality", 3)}
+        },
+        "rating_influence": {
+            "from_name": "rating_influence",
+            "type": "rating",
+            "value": {"rating": response_json.get("rating_influence", 3)}
+        },
+        "rating_alignment": {
+            "from_name": "rating_alignment",
+            "type": "rating",
+            "value": {"rating": response_json.get("rating_alignment", 3)}
+        },
+    }
+
+    for key, mapping in schema_to_label.items():
+        result.append({
+            "id": str(uuid.uuid4()),
+            "from_name": mapping["from_name"],
+            "to_name": task_type,
+            "type": mapping["type"],
+            "value": mapping["value"],
+            "origin": "manual"
+        })
+    print("Result data prepared.")
+    return result
+
+# Function to assemble a Label Studio annotation record
+def build_output_data(input_data, result, account):
+    """
+    Assemble the Label Studio annotation record for one evaluation.
+
+    Args:
+        input_data (dict): The input data from the JSON file.
+        result (list): The Label Studio result entries.
+        account (dict): The synthetic account data.
+
+    Returns:
+        dict: The annotation record matching the sample output structure.
+    """
+    current_time = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z"
+    task = {
+        "cancelled_annotations": 0,
+        "comment_authors": [],
+        "comment_count": 0,
+        "created_at": current_time,
+        "data": input_data,
+        "file_upload": None,
+        "id": random.randint(100000, 999999),
+        "inner_id": random.randint(100000, 999999),
+        "is_labeled": True,
+        "last_comment_updated_at": None,
+        "meta": {},
+        "overlap": 1,
+        "project": 2480,
+        "total_annotations": 1,
+        "total_predictions": 0,
+        "unresolved_comment_count": 0,
+        "updated_at": current_time,
+        "updated_by": None
+    }
+
+    # Reference pooled personas by ID unless the full account should be embedded
+    if EMBED_PERSONA_IN_OUTPUT or not isinstance(account, Persona):
+        persona_details = {"synthetic_account": dict(account)}
+    else:
+        persona_details = {"persona_ref": account.reference()}
+
+    output_data = {
+        "id": random.randint(10000, 1000000),
+        "created_username": f"{account['first_name']} {account['last_name']} {account['email']}, {account['id']}",
+        "created_ago": "0 minutes",
+        "completed_by": {
+            "id": account['id'],
+            "first_name": account['first_name'],
+            "last_name": account['last_name'],
+            "email": account['email'],
+            **persona_details
+        },
+        "draft_created_at": current_time,
+        "task": task,
+        "project": 2480,
+        "updated_by": account['id'],
+        "result": result,
+        "was_cancelled": False,
+        "ground_truth": False,
+        "created_at": current_time,
+        "updated_at": current_time,
+        "lead_time": random.uniform(1, 100),
+        "import_id": None,
+        "last_action": None,
+        "parent_prediction": None,
+        "parent_annotation": None,
+        "last_created_by": None,
+    }
+    print("Output data assembled.")
+    return output_data
+
+# Function to build the output file name for an input blob
+def build_output_name(blob_name):
+    """
+    Build a unique output file name derived from the input blob name.
+
+    Args:
+        blob_name (str): The name of the input blob.
+
+    Returns:
+        str: The output file name.
+    """
+    return blob_name.replace('.json', '') + f"-synthetic-{str(uuid.uuid4())}.json"
+
+# Reads and writes files in a bucket or a local directory
+class FileStore:
+    """
+    Minimal file store for batch prediction and export files. Names are paths relative to the
+    bucket root (or to local_dir when given), so the same names work for both.
+    """
+
+    def __init__(self, bucket=None, local_dir=None):
+        self.bucket = bucket
+        self.local_dir = local_dir
+
+    def write(self, name, data, content_type='application/jsonl'):
+        """
+        Write a file, replacing any file of the same name.
+
+        Args:
+            name (str): The file name.
+            data (str or bytes): The file contents.
+            content_type (str): The content type set on uploaded objects.
+        """
+        if self.local_dir is not None:
+            path = os.path.join(self.local_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb' if isinstance(data, bytes) else 'w') as file:
+                file.write(data)
+        else:
+            self.bucket.blob(name).upload_from_string(data, content_type=content_type)
+
+    def read(self, name):
+        """
+        Read a text file.
+
+        Args:
+            name (str): The file name.
+
+        Returns:
+            str: The file contents.
+        """
+        if self.local_dir is not None:
+            with open(os.path.join(self.local_dir, name)) as file:
+                return file.read()
+        return self.bucket.blob(name).download_as_text()
+
+    def list(self, prefix):
+        """
+        List the files whose names start with a prefix.
+
+        Args:
+            prefix (str): The name prefix, usually a directory such as "batch-prediction/job/".
+
+        Returns:
+            list: The sorted file names.
+        """
+        if self.local_dir is not None:
+            root = os.path.join(self.local_dir, prefix)
+            return sorted(
+                os.path.relpath(os.path.join(directory, file_name), self.local_dir)
+                for directory, _, file_names in os.walk(root) for file_name in file_names
+            )
+        return sorted(blob.name for blob in self.bucket.list_blobs(prefix=prefix))
+
+    def uri(self, name):
+        """
+        Build the URI of a file, as passed to batch prediction jobs.
+
+        Args:
+            name (str): The file name.
+
+        Returns:
+            str: A gs:// URI, or an absolute path for local stores.
+        """
+        if self.local_dir is not None:
+            return os.path.abspath(os.path.join(self.local_dir, name))
+        return f"gs://{self.bucket.name}/{name}"
+
+    def name_of(self, uri):
+        """
+        Convert a URI returned by uri() (or by a batch job) back to a file name.
+
+        Args:
+            uri (str): The gs:// URI or absolute path.
+
+        Returns:
+            str: The file name, or the URI unchanged if it lies outside this store.
+        """
+        prefix = f"gs://{self.bucket.name}/" if self.local_dir is None else os.path.abspath(self.local_dir) + os.sep
+        return uri[len(prefix):] if uri.startswith(prefix) else uri
+
+# Output sink settings
+OUTPUT_FORMAT = 'json'  # 'json' uploads one Label Studio file each; 'jsonl' buffers records into compressed JSONL shards
+OUTPUT_SINK_PATH = 'output_sink.sqlite3'  # Local journal of records not yet uploaded; persists across restarts
+OUTPUT_SHARD_PREFIX = 'synthetic-shards/'
+OUTPUT_SHARD_MAX_BYTES = 8 * 1024 * 1024  # Uncompressed size at which a shard is flushed
+OUTPUT_SHARD_MAX_SECONDS = 60  # Maximum time a record waits in the buffer
+
+# Buffered writer that uploads annotation records as compressed JSONL shards
+class OutputSink:
+    """
+    Buffer annotation records in a local SQLite journal and upload them as gzip-compressed
+    JSONL shards once the buffer reaches max_bytes or its oldest record is max_seconds old.
+
+    A record is durable once put() returns. Flushing first seals the buffered records into a
+    named shard in the journal, then uploads the shard with an only-if-absent precondition,
+    then deletes its records. After a crash, sealed shards are uploaded again under the same
+    name with identical bytes, and an upload that had already landed is detected by the
+    precondition, so records are neither lost nor duplicated.
+    """
+
+    def __init__(self, bucket, path=OUTPUT_SINK_PATH, prefix=OUTPUT_SHARD_PREFIX, max_bytes=OUTPUT_SHARD_MAX_BYTES,
+                 max_seconds=OUTPUT_SHARD_MAX_SECONDS):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.metrics = collections.Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, shard TEXT, record TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'sink_id'").fetchone()
+        if row is None:
+            row = (uuid.uuid4().hex[:12],)
+            self._connection.execute("INSERT INTO meta (key, value) VALUES ('sink_id', ?)", row)
+        self._connection.commit()
+        self.sink_id = row[0]
+        self._buffered_bytes, self._oldest = self._connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(record)), 0), MIN(created_at) FROM records WHERE shard IS NULL"
+        ).fetchone()
+        print(f"Opened output sink at {path} with {self._buffered_bytes} buffered bytes.")
+        # Upload shards that were sealed but not confirmed before a restart
+        self._upload_sealed()
+
+    def put(self, record):
+        """
+        Durably buffer one annotation record, flushing if the buffer is full or old enough.
+
+        Args:
+            record (dict): The annotation record.
+        """
+        line = json.dumps(record, separators=(',', ':'))
+        now = time.time()
+        with self._lock:
+            self._connection.execute("INSERT INTO records (record, created_at) VALUES (?, ?)", (line, now))
+            self._connection.commit()
+            self._buffered_bytes += len(line)
+            self._oldest = self._oldest or now
+            due = self._buffered_bytes >= self.max_bytes or now - self._oldest >= self.max_seconds
+        self.metrics['records'] += 1
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Seal all buffered records into a shard and upload every sealed shard.
+        """
+        with self._flush_lock:
+            with self._lock:
+                first, last = self._connection.execute(
+                    "SELECT MIN(seq), MAX(seq) FROM records WHERE shard IS NULL"
+                ).fetchone()
+                if first is not None:
+                    shard = f"{self.prefix}{self.sink_id}-{first:012d}-{last:012d}.jsonl.gz"
+                    self._connection.execute(
+                        "UPDATE records SET shard = ? WHERE shard IS NULL AND seq <= ?", (shard, last)
+                    )
+                    self._connection.commit()
+                    self._buffered_bytes, self._oldest = self._connection.execute(
+                        "SELECT COALESCE(SUM(LENGTH(record)), 0), MIN(created_at) FROM records WHERE shard IS NULL"
+                    ).fetchone()
+            self._upload_sealed()
+
+    def _upload_sealed(self):
+        with self._lock:
+            shards = [row[0] for row in self._connection.execute(
+                "SELECT shard FROM records WHERE shard IS NOT NULL GROUP BY shard ORDER BY MIN(seq)"
+            )]
+        for shard in shards:
+            with self._lock:
+                lines = [row[0] for row in self._connection.execute(
+                    "SELECT record FROM records WHERE shard = ? ORDER BY seq", (shard,)
+                )]
+            # mtime=0 keeps the compressed bytes identical when a shard is re-uploaded
+            data = gzip.compress(("\n".join(lines) + "\n").encode(), mtime=0)
+            try:
+                self.bucket.blob(shard).upload_from_string(data, content_type='application/jsonl',
+                                                           if_generation_match=0)
+                self.metrics['uploaded_bytes'] += len(data)
+                self.metrics['uploaded_records'] += len(lines)
+                self.metrics['shards'] += 1
+                print(f"Uploaded output shard {shard} with {len(lines)} records.")
+            except Exception as e:
+                if type(e).__name__ != 'PreconditionFailed' and getattr(e, 'code', None) != 412:
+                    print(f"Failed to upload output shard {shard}, will retry on the next flush: {e}")
+                    return
+                print(f"Output shard {shard} was already uploaded.")
+            with self._lock:
+                self._connection.execute("DELETE FROM records WHERE shard = ?", (shard,))
+                self._connection.commit()
+
+    def report(self):
+        """
+        Print output sink statistics.
+        """
+        print(f"Output sink: {self.metrics['uploaded_records']} records uploaded in {self.metrics['shards']} shards "
+              f"({self.metrics['uploaded_bytes'] / 1024:.0f} KiB compressed), "
+              f"{self._buffered_bytes / 1024:.0f} KiB buffered.")
+
+OUTPUT_SINK = OutputSink(output_bucket) if OUTPUT_FORMAT == 'jsonl' and not DRYRUN else None
+
+# Columnar ratings export settings
+RATINGS_EXPORT_ENABLED = True  # Also write every evaluation as a row of partitioned Parquet/Arrow files
+RATINGS_EXPORT_FORMAT = 'parquet'  # 'parquet' or 'arrow' (Arrow IPC files)
+RATINGS_EXPORT_BUCKET_NAME = 'label-studio-ratings-export'  # Kept apart from the Label Studio output bucket
+RATINGS_EXPORT_PREFIX = 'ratings/'
+RATINGS_EXPORT_LOCAL_DIR = 'ratings-export-local'  # Dry runs write export files to this local directory
+RATINGS_EXPORT_ROWS_PER_FILE = 100000  # Rows buffered per partition before a file is written
+RATINGS_EXPORT_MAX_SECONDS = 600  # Maximum time rows stay buffered
+
+PERSONA_CODE_COLUMNS = ['persona_species', 'persona_role'] + \
+    [f"persona_{field}" for field, _ in HUMAN_CATEGORICAL_FIELDS] + ['persona_age'] + \
+    [f"persona_{field}" for field in ADVOCACY_SCALE_FIELDS + PSYCHOMETRIC_SCALE_FIELDS]
+
+# One row per (item, persona): typed ratings plus persona codes (indexes into the option tables,
+# scales in hundredths), so training jobs can read them without parsing annotation JSON
+RATINGS_SCHEMA = pa.schema(
+    [
+        ('task_hash', pa.string()),
+        ('task_type', pa.string()),
+        ('created_at', pa.timestamp('us', tz='UTC')),
+        ('persona_catalog', pa.string()),
+        ('persona_id', pa.int64()),
+        ('is_content_harmful_to_animals', pa.bool_()),
+    ]
+    + [(field, pa.int8()) for field in RATING_FIELDS]
+    + [('explanation', pa.string()), ('persona_is_human', pa.bool_())]
+    + [(column, pa.int16()) for column in PERSONA_CODE_COLUMNS]
+)
+
+# Function to encode a persona's attributes as option-table codes
+def persona_codes(account):
+    """
+    Encode a persona as the code columns of the ratings export: categorical attributes as
+    indexes into their option tables and 0-1 scales as hundredths. Pooled personas are read
+    straight from the pool's columns.
+
+    Args:
+        account (dict): The synthetic account data (or a Persona).
+
+    Returns:
+        dict: The persona code columns; attributes that do not apply to the persona are None.
+    """
+    codes = dict.fromkeys(PERSONA_CODE_COLUMNS)
+    if isinstance(account, Persona):
+        columns, index = account.pool.columns, account.index
+        codes['persona_is_human'] = bool(columns['is_human'][index])
+        if not codes['persona_is_human']:
+            codes['persona_species'] = int(columns['species'][index])
+            codes['persona_role'] = int(columns['role'][index])
+        else:
+            for field in [field for field, _ in HUMAN_CATEGORICAL_FIELDS] + ['age'] + \
+                    ADVOCACY_SCALE_FIELDS + PSYCHOMETRIC_SCALE_FIELDS:
+                codes[f"persona_{field}"] = int(columns[field][index])
+        return codes
+
+    def code(options, value):
+        return options.index(value) if value in options else None
+
+    codes['persona_is_human'] = account.get('species') == 'Human'
+    if not codes['persona_is_human']:
+        codes['persona_species'] = code(NON_HUMAN_SPECIES, account.get('species'))
+        codes['persona_role'] = code(NON_HUMAN_ROLES, account.get('role'))
+        return codes
+    for field, options in HUMAN_CATEGORICAL_FIELDS:
+        codes[f"persona_{field}"] = code(options, account.get(field))
+    codes['persona_age'] = account.get('age')
+    for field in ADVOCACY_SCALE_FIELDS + PSYCHOMETRIC_SCALE_FIELDS:
+        if account.get(field) is not None:
+            codes[f"persona_{field}"] = int(round(account[field] * 100))
+    return codes
+
+# Function to flatten an annotation record into one ratings row
+def ratings_row(output_data, account=None):
+    """
+    Flatten a Label Studio annotation record into one row of the ratings export.
+
+    Args:
+        output_data (dict): The annotation record.
+        account (dict): The persona the record belongs to, if known; otherwise the persona
+            embedded in the record is used, and only its ID is kept for persona references.
+
+    Returns:
+        dict: The row, keyed by RATINGS_SCHEMA column names, or None if a rating is not a number.
+    """
+    completed_by = output_data['completed_by']
+    reference = completed_by.get('persona_ref', {})
+    row = {
+        'task_hash': hash_text(json.dumps(output_data['task']['data'], sort_keys=True)),
+        'task_type': None,
+        'created_at': datetime.datetime.strptime(output_data['created_at'], "%Y-%m-%dT%H:%M:%S.%fZ").replace(
+            tzinfo=datetime.timezone.utc),
+        'persona_catalog': reference.get('catalog'),
+        'persona_id': completed_by['id'],
+    }
+    for entry in output_data['result']:
+        row['task_type'] = entry['to_name']
+        value = entry['value']
+        if entry['type'] == 'rating':
+            # Legacy records may hold ratings such as "4" or 4.5
+            row[entry['from_name']] = coerce_rating(value['rating'])
+            if row[entry['from_name']] is None:
+                return None
+        elif entry['type'] == 'choices':
+            row[entry['from_name']] = value['choices'][0] == 'Yes'
+        elif entry['type'] == 'textarea':
+            row[entry['from_name']] = value['text'][0]
+    if account is None:
+        account = completed_by.get('synthetic_account')
+    if account is not None:
+        row.update(persona_codes(account))
+    return row
+
+# Writes ratings rows to date- and task-type-partitioned Parquet or Arrow files
+class RatingsExporter:
+    """
+    Buffer ratings rows per partition (date=YYYY-MM-DD/task_type=...) and write each partition
+    as a Parquet (or Arrow IPC) file once it holds rows_per_file rows, its oldest row is
+    max_seconds old, or flush() is called. Persona codes of records that reference pooled
+    personas are resolved through registered pools, or the persona catalog in the bucket.
+
+    The main script flushes buffered rows when it is interrupted; rows lost to a crash can be
+    rebuilt from the annotation records with convert_outputs_to_columnar().
+    """
+
+    def __init__(self, store, prefix=RATINGS_EXPORT_PREFIX, export_format=RATINGS_EXPORT_FORMAT,
+                 rows_per_file=RATINGS_EXPORT_ROWS_PER_FILE, max_seconds=RATINGS_EXPORT_MAX_SECONDS):
+        self.store = store
+        self.prefix = prefix
+        self.export_format = export_format
+        self.rows_per_file = rows_per_file
+        self.max_seconds = max_seconds
+        self.pools = {}
+        self.rows_written = 0
+        self.files_written = 0
+        self._writer_id = uuid.uuid4().hex[:12]
+        self._partitions = {}
+        self._writing = set()
+        self._oldest = None
+        self.rows_skipped = 0
+        self._lock = threading.Lock()
+
+    def register_pool(self, pool):
+        """
+        Make a persona pool available for resolving persona references.
+
+        Args:
+            pool (PersonaPool): The persona pool.
+        """
+        self.pools[pool.catalog_id] = pool
+
+    def _account_for(self, output_data):
+        reference = output_data['completed_by'].get('persona_ref')
+        if reference is None:
+            return None
+        pool = self.pools.get(reference['catalog'])
+        if pool is None and not DRYRUN:
+            catalog_blob = storage_client.bucket(PERSONA_CATALOG_BUCKET_NAME).blob(
+                f"{PERSONA_CATALOG_PREFIX}{reference['catalog']}.npz")
+            pool = load_persona_catalog(catalog_blob.download_as_bytes())
+            self.pools[reference['catalog']] = pool
+        return pool[pool.index_of(reference['id'])] if pool is not None else None
+
+    def add(self, output_data, account=None):
+        """
+        Add the ratings row of an annotation record.
+
+        Args:
+            output_data (dict): The annotation record.
+            account (dict): The persona the record belongs to, if known.
+
+        Returns:
+            bool: False if the record was skipped because a rating is not a number.
+        """
+        if account is None:
+            account = self._account_for(output_data)
+        row = ratings_row(output_data, account)
+        if row is None:
+            print("Skipping an annotation record with a rating that is not a number.")
+            self.rows_skipped += 1
+            return False
+        key = (row['created_at'].strftime("%Y-%m-%d"), row['task_type'])
+        now = time.time()
+        with self._lock:
+            rows = self._partitions.setdefault(key, [])
+            rows.append(row)
+            self._oldest = self._oldest or now
+            full = [key] if len(rows) >= self.rows_per_file else []
+            if now - self._oldest >= self.max_seconds:
+                full = list(self._partitions)
+        for key in full:
+            self._write_partition(key)
+        return True
+
+    def _write_partition(self, key):
+        # Rows stay buffered until their file is written, so a failed write loses nothing
+        with self._lock:
+            rows = list(self._partitions.get(key, ()))
+            if not rows or key in self._writing:
+                return
+            self._writing.add(key)
+        try:
+            try:
+                self._write_rows(key, rows)
+            except Exception as e:
+                print(f"Could not write ratings partition {'/'.join(key)}; {len(rows)} rows stay buffered: {e}")
+                return
+            with self._lock:
+                remaining = self._partitions[key][len(rows):]
+                if remaining:
+                    self._partitions[key] = remaining
+                else:
+                    del self._partitions[key]
+                if not self._partitions:
+                    self._oldest = None
+        finally:
+            with self._lock:
+                self._writing.discard(key)
+
+    def _write_rows(self, key, rows):
+        # task_type is carried by the partition path, as Hive-partitioned readers expect
+        table = pa.Table.from_pylist(rows, schema=RATINGS_SCHEMA).drop_columns(['task_type'])
+        buffer = io.BytesIO()
+        if self.export_format == 'arrow':
+            with pa.ipc.new_file(buffer, table.schema, options=pa.ipc.IpcWriteOptions(compression='zstd')) as writer:
+                writer.write_table(table)
+            extension = 'arrow'
+        else:
+            pq.write_table(table, buffer, compression='zstd')
+            extension = 'parquet'
+        date, task_type = key
+        with self._lock:
+            self.files_written += 1
+            name = (f"{self.prefix}date={date}/task_type={task_type}/"
+                    f"part-{self._writer_id}-{self.files_written:06d}.{extension}")
+        self.store.write(name, buffer.getvalue(), content_type='application/octet-stream')
+        self.rows_written += len(rows)
+        print(f"Wrote {len(rows)} ratings rows to {name}.")
+
+    def flush(self):
+        """
+        Write every buffered partition.
+        """
+        with self._lock:
+            keys = list(self._partitions)
+        for key in keys:
+            self._write_partition(key)
+
+    def report(self):
+        """
+        Print export statistics.
+        """
+        buffered = sum(len(rows) for rows in self._partitions.values())
+        print(f"Ratings export: {self.rows_written} rows in {self.files_written} files, {buffered} rows buffered, "
+              f"{self.rows_skipped} records skipped.")
+
+RATINGS_EXPORTER = RatingsExporter(
+    FileStore(local_dir=RATINGS_EXPORT_LOCAL_DIR) if DRYRUN else
+    FileStore(bucket=storage_client.bucket(RATINGS_EXPORT_BUCKET_NAME))
+) if RATINGS_EXPORT_ENABLED else None
+
+# Function to read the annotation records stored in one output blob
+def read_output_records(blob):
+    """
+    Read the annotation records of an output blob: an individual Label Studio file or an
+    output sink shard.
+
+    Args:
+        blob (google.cloud.storage.Blob): The output blob.
+
+    Returns:
+        list: The annotation records.
+    """
+    data = blob.download_as_bytes()
+    if blob.name.endswith('.jsonl.gz'):
+        return [json.loads(line) for line in gzip.decompress(data).decode('utf-8').splitlines() if line]
+    return [json.loads(data)]
+
+# Function to convert existing annotation records into the columnar ratings layout in bulk
+def convert_outputs_to_columnar(exporter=None, prefix=None, workers=16):
+    """
+    Read every annotation record in the output bucket (individual files and sink shards) and
+    write them to the ratings export. Records are downloaded concurrently, one listing page
+    at a time.
+
+    Args:
+        exporter (RatingsExporter): The exporter to write to (RATINGS_EXPORTER by default).
+        prefix (str): Optional prefix of the output blobs to convert.
+        workers (int): Concurrent downloads.
+
+    Returns:
+        int: The number of records converted.
+    """
+    exporter = exporter or RATINGS_EXPORTER
+    converted = 0
+    iterator = output_bucket.list_blobs(prefix=prefix, page_size=LISTING_PAGE_SIZE)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for page in iterator.pages:
+            blobs = [blob for blob in page if blob.name.endswith(('.json', '.jsonl.gz'))]
+            for blob, records in zip(blobs, executor.map(read_output_records, blobs)):
+                for record in records:
+                    try:
+                        converted += int(exporter.add(record))
+                    except (KeyError, TypeError, ValueError) as e:
+                        print(f"Skipping a record in {blob.name} that is not an annotation: {e}")
+            print(f"Converted {converted} annotation records so far.")
+    exporter.flush()
+    return converted
+
+# Function to save an annotation record to the output bucket
+def save_output_data(output_name, output_data):
+    """
+    Upload an annotation record to the output bucket, through the output sink when records
+    are batched into shards (or print it in dry-run mode).
+
+    Args:
+        output_name (str): The output file name, used when records are uploaded as individual files.
+        output_data (dict): The annotation record.
+    """
+    if DRYRUN:
+      print(f"DRYRUN: Processed {output_name}")
+      print(json.dumps(output_data, indent=2))
+    elif OUTPUT_SINK is not None:
+      OUTPUT_SINK.put(output_data)
+      print(f"Processed and buffered output for {output_name}")
+    else:
+      output_blob = output_bucket.blob(output_name)
+      output_blob.upload_from_string(json.dumps(output_data, indent=2), content_type='application/json')
+      print(f"Processed and saved output for {output_name}")
+    if RATINGS_EXPORTER is not None:
+      RATINGS_EXPORTER.add(output_data)
+
+# Offline stand-in for a storage bucket with a fixed round-trip time per upload
+class StubBucket:
+    """
+    In-memory stand-in for a Cloud Storage bucket, for offline benchmarks. Each upload takes
+    round_trip_seconds plus its size divided by bytes_per_second, and honours the
+    if_generation_match=0 (only if absent) precondition.
+    """
+
+    class PreconditionFailed(Exception):
+        code = 412
+
+    def __init__(self, round_trip_seconds=0.05, bytes_per_second=50 * 1024 * 1024):
+        self.round_trip_seconds = round_trip_seconds
+        self.bytes_per_second = bytes_per_second
+        self.objects = {}
+        self.uploads = 0
+
+    def blob(self, name):
+        bucket = self
+
+        class StubBlob:
+            def upload_from_string(self, data, content_type=None, if_generation_match=None):
+                data = data.encode() if isinstance(data, str) else data
+                time.sleep(bucket.round_trip_seconds + len(data) / bucket.bytes_per_second)
+                bucket.uploads += 1
+                if if_generation_match == 0 and name in bucket.objects:
+                    raise StubBucket.PreconditionFailed(name)
+                bucket.objects[name] = data
+
+        return StubBlob()
+
+# Function to compare upload throughput of individual files against the output sink
+def benchmark_output_sink(num_records=500, round_trip_seconds=0.05, max_bytes=OUTPUT_SHARD_MAX_BYTES):
+    """
+    Upload the same annotation records as individual pretty-printed files and through an
+    OutputSink, both to a StubBucket with a fixed round-trip time, and compare throughput.
+
+    Args:
+        num_records (int): Number of annotation records.
+        round_trip_seconds (float): Simulated time of one upload request.
+        max_bytes (int): Shard size of the output sink.
+
+    Returns:
+        dict: Records per second and bytes uploaded for each path.
+    """
+    account = generate_persona_pool(1, seed=0)[0]
+    response_json = {"explanation": "Benchmark evaluation. " * 20, **{field: 3 for field in RATING_FIELDS}}
+    records = [build_output_data({"text": f"Benchmark item {index}"}, build_annotation_result(response_json, 'text'),
+                                 account) for index in range(num_records)]
+
+    files_bucket = StubBucket(round_trip_seconds)
+    started = time.monotonic()
+    for record in records:
+        files_bucket.blob(str(uuid.uuid4())).upload_from_string(json.dumps(record, indent=2),
+                                                               content_type='application/json')
+    files_seconds = time.monotonic() - started
+
+    sink_bucket = StubBucket(round_trip_seconds)
+    with tempfile.TemporaryDirectory() as directory:
+        sink = OutputSink(sink_bucket, path=os.path.join(directory, 'sink.sqlite3'), max_bytes=max_bytes,
+                          max_seconds=float('inf'))
+        started = time.monotonic()
+        for record in records:
+            sink.put(record)
+        sink.flush()
+        sink_seconds = time.monotonic() - started
+        sink._connection.close()
+
+    results = {
+        'files': {'records_per_second': num_records / files_seconds, 'uploads': files_bucket.uploads,
+                  'bytes': sum(len(data) for data in files_bucket.objects.values())},
+        'sink': {'records_per_second': num_records / sink_seconds, 'uploads': sink_bucket.uploads,
+                 'bytes': sum(len(data) for data in sink_bucket.objects.values())},
+    }
+    for mode, result in results.items():
+        print(f"{mode.capitalize()}: {result['records_per_second']:.0f} records/s, {result['uploads']} uploads, "
+              f"{result['bytes'] / 1024:.0f} KiB uploaded.")
+    return results
+
+# Duplicate detection settings
+DUPLICATE_DETECTION_ENABLED = False  # Share evaluations between identical and nearly identical input items
+DUPLICATE_INDEX_PATH = 'duplicate_index.sqlite3'  # Local file that persists across restarts
+MINHASH_PERMUTATIONS = 128  # Signature length; more permutations estimate similarity more precisely
+MINHASH_BANDS = 16  # LSH bands of MINHASH_PERMUTATIONS // MINHASH_BANDS rows each
+MINHASH_SHINGLE_WORDS = 3  # Words per shingle
+NEAR_DUPLICATE_THRESHOLD = 0.8  # Estimated Jaccard similarity above which items are near duplicates
+MINHASH_SEED = 1
+
+# Universal hash functions (a * x + b) mod p, one per signature position
+MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = np.random.default_rng(MINHASH_SEED)
+MINHASH_A = _minhash_rng.integers(1, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64)
+MINHASH_B = _minhash_rng.integers(0, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+# Function to normalize the content of an input task for duplicate detection
+def normalize_task_content(input_task):
+    """
+    Normalize an input task so that reposts differing only in case, punctuation or
+    whitespace compare equal. Non-text parts (e.g. images) are kept as their serialized form.
+
+    Args:
+        input_task (list): The input task for the model.
+
+    Returns:
+        str: The normalized content.
+    """
+    normalized = []
+    for part in input_task:
+        if isinstance(part, str):
+            normalized.append(" ".join(re.sub(r'[^\w\s]', ' ', part.lower()).split()))
+        else:
+            normalized.append(normalize_prompt_part(part))
+    return "\n".join(normalized)
+
+# Function to compute the MinHash signature of a normalized text
+def minhash_signature(text, shingle_words=MINHASH_SHINGLE_WORDS):
+    """
+    Compute the MinHash signature of a text's word shingles. The fraction of positions at
+    which two signatures agree estimates the Jaccard similarity of their shingle sets.
+
+    Args:
+        text (str): The normalized text.
+        shingle_words (int): Words per shingle.
+
+    Returns:
+        numpy.ndarray: The signature, MINHASH_PERMUTATIONS unsigned 32-bit values.
+    """
+    words = text.split()
+    shingles = {" ".join(words[i:i + shingle_words]) for i in range(max(1, len(words) - shingle_words + 1))}
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'little')
+         for shingle in shingles], dtype=np.uint64
+    )
+    values = (MINHASH_A[:, None] * hashes[None, :] + MINHASH_B[:, None]) % np.uint64(MINHASH_PRIME)
+    return (values.min(axis=1) & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+
+# Function to split a MinHash signature into LSH band keys
+def lsh_band_keys(signature, bands=MINHASH_BANDS):
+    """
+    Hash each band of a signature. Items sharing any band key are candidate near duplicates.
+
+    Args:
+        signature (numpy.ndarray): The MinHash signature.
+        bands (int): Number of bands.
+
+    Returns:
+        list: One key per band.
+    """
+    return [hashlib.blake2b(band.tobytes(), digest_size=8).hexdigest() for band in np.split(signature, bands)]
+
+# Persistent index of duplicate clusters and the evaluations their members share
+class DuplicateIndex:
+    """
+    SQLite-backed index that assigns every input item to a cluster of identical or nearly
+    identical items: by an exact hash of the normalized content first, then by MinHash/LSH
+    candidates whose estimated Jaccard similarity reaches the threshold.
+
+    Evaluations saved for any member of a cluster are kept per persona, so when a persona is
+    assigned another member, its evaluation is reused instead of calling the model again.
+    """
+
+    def __init__(self, path=DUPLICATE_INDEX_PATH, threshold=NEAR_DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.metrics = collections.Counter()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS clusters (cluster INTEGER PRIMARY KEY AUTOINCREMENT, signature BLOB);"
+            "CREATE TABLE IF NOT EXISTS fingerprints (content_hash TEXT PRIMARY KEY, cluster INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS bands (band INTEGER NOT NULL, key TEXT NOT NULL, cluster INTEGER NOT NULL, "
+            "PRIMARY KEY (band, key, cluster));"
+            "CREATE TABLE IF NOT EXISTS items (name TEXT PRIMARY KEY, generation INTEGER, cluster INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS evaluations (cluster INTEGER NOT NULL, persona TEXT NOT NULL, "
+            "evaluation TEXT NOT NULL, PRIMARY KEY (cluster, persona));"
+            "CREATE TABLE IF NOT EXISTS uses (name TEXT NOT NULL, generation INTEGER, persona TEXT NOT NULL, "
+            "PRIMARY KEY (name, generation, persona));"
+        )
+        self._connection.commit()
+        print(f"Opened duplicate index at {path}.")
+
+    def _near_duplicate(self, signature):
+        candidates = set()
+        for band, key in enumerate(lsh_band_keys(signature)):
+            candidates.update(row[0] for row in self._connection.execute(
+                "SELECT cluster FROM bands WHERE band = ? AND key = ?", (band, key)
+            ))
+        best, best_similarity = None, self.threshold
+        for cluster in candidates:
+            stored = self._connection.execute("SELECT signature FROM clusters WHERE cluster = ?", (cluster,)).fetchone()[0]
+            similarity = float(np.mean(np.frombuffer(stored, dtype=np.uint32) == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = cluster, similarity
+        return best
+
+    def cluster_of(self, blob, input_task):
+        """
+        Find or create the duplicate cluster of an input item.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob.
+            input_task (list): The input task built from the blob.
+
+        Returns:
+            int: The cluster ID.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT generation, cluster FROM items WHERE name = ?", (blob.name,)).fetchone()
+            if row is not None and row[0] == blob.generation:
+                return row[1]
+            self.metrics['items'] += 1
+            content = normalize_task_content(input_task)
+            content_hash = hash_text(content)
+            found = self._connection.execute(
+                "SELECT cluster FROM fingerprints WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+            if found is not None:
+                cluster = found[0]
+                self.metrics['exact_duplicates'] += 1
+            else:
+                # Only text content is compared for near duplicates; other parts must match exactly.
+                # The task instruction is left out so it cannot make short, unrelated items look alike
+                text_only = all(isinstance(part, str) for part in input_task)
+                signature = minhash_signature(normalize_task_content(input_task[1:])) if text_only else None
+                cluster = self._near_duplicate(signature) if text_only else None
+                if cluster is not None:
+                    self.metrics['near_duplicates'] += 1
+                else:
+                    cluster = self._connection.execute(
+                        "INSERT INTO clusters (signature) VALUES (?)",
+                        (signature.tobytes() if text_only else None,)
+                    ).lastrowid
+                    if text_only:
+                        self._connection.executemany(
+                            "INSERT OR IGNORE INTO bands (band, key, cluster) VALUES (?, ?, ?)",
+                            [(band, key, cluster) for band, key in enumerate(lsh_band_keys(signature))]
+                        )
+                self._connection.execute(
+                    "INSERT OR IGNORE INTO fingerprints (content_hash, cluster) VALUES (?, ?)", (content_hash, cluster)
+                )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO items (name, generation, cluster) VALUES (?, ?, ?)",
+                (blob.name, blob.generation, cluster)
+            )
+            self._connection.commit()
+            return cluster
+
+    def shared_evaluation(self, blob, account):
+        """
+        Find the assigned persona's evaluation of another member of the blob's cluster, if it
+        has not been applied to this blob yet. Evaluations are only ever reused for the persona
+        that made them.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob (already assigned to a cluster).
+            account (dict): The persona assigned to the blob.
+
+        Returns:
+            tuple(dict, dict): The persona and its evaluation, or None if the model has to be called.
+        """
+        persona = str(account['id'])
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT e.evaluation FROM evaluations e "
+                "JOIN items i ON i.cluster = e.cluster WHERE i.name = ? AND i.generation IS ? AND e.persona = ? "
+                "AND NOT EXISTS (SELECT 1 FROM uses u WHERE u.name = i.name AND u.generation IS i.generation "
+                "AND u.persona = e.persona)",
+                (blob.name, blob.generation, persona)
+            ).fetchone()
+        return None if row is None else (account, json.loads(row[0]))
+
+    def share(self, blob, account, response_json, reused=False):
+        """
+        Record that a persona's evaluation was applied to a blob and make it available to the
+        rest of the blob's cluster.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob.
+            account (dict): The persona that evaluated it.
+            response_json (dict): The parsed evaluation.
+            reused (bool): True if the evaluation came from another cluster member.
+        """
+        persona = str(account['id'])
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT cluster FROM items WHERE name = ? AND generation IS ?", (blob.name, blob.generation)
+            ).fetchone()
+            if row is None:
+                return
+            self._connection.execute(
+                "INSERT OR IGNORE INTO evaluations (cluster, persona, evaluation) VALUES (?, ?, ?)",
+                (row[0], persona, json.dumps(response_json))
+            )
+            self._connection.execute(
+                "INSERT OR IGNORE INTO uses (name, generation, persona) VALUES (?, ?, ?)",
+                (blob.name, blob.generation, persona)
+            )
+            self._connection.commit()
+            self.metrics['calls_avoided' if reused else 'evaluations'] += 1
+
+    def report(self):
+        """
+        Print duplicate detection and evaluation sharing statistics.
+        """
+        with self._lock:
+            clusters = self._connection.execute("SELECT COUNT(*) FROM clusters").fetchone()[0]
+        print(f"Duplicate detection: {self.metrics['items']} items fingerprinted, "
+              f"{self.metrics['exact_duplicates']} exact and {self.metrics['near_duplicates']} near duplicates "
+              f"({clusters} clusters); {self.metrics['calls_avoided']} model calls avoided by shared evaluations.")
+
+# Dry runs do not upload anything, so their clusters are only kept in memory
+DUPLICATE_INDEX = DuplicateIndex(':memory:' if DRYRUN else DUPLICATE_INDEX_PATH) if DUPLICATE_DETECTION_ENABLED else None
+
+# Function to find an evaluation of a duplicate item that can be reused instead of calling the model
+def find_shared_evaluation(blob, input_task, account):
+    """
+    Assign a blob to its duplicate cluster and look up a reusable evaluation from the cluster.
+
+    Args:
+        blob (google.cloud.storage.Blob): The input blob.
+        input_task (list): The input task built from the blob.
+        account (dict): The persona assigned to the blob.
+
+    Returns:
+        tuple(dict, dict): The persona and its evaluation, or None if the model has to be called.
+    """
+    if DUPLICATE_INDEX is None:
+        return None
+    DUPLICATE_INDEX.cluster_of(blob, input_task)
+    shared = DUPLICATE_INDEX.shared_evaluation(blob, account)
+    if shared is not None:
+        print(f"Reusing the evaluation of a duplicate item by persona {shared[0]['id']} for {blob.name}.")
+    return shared
+
+# Pipelined evaluation settings
+PIPELINE_CONCURRENCY = 32  # Number of blobs evaluated concurrently; set to 1 to evaluate one blob at a time
+
+# Function to evaluate one input blob end-to-end inside the async pipeline
+async def process_blob(blob, account, packer=None):
+    """
+    Download, evaluate and upload the annotation for a single input blob. Blocking storage,
+    scraping and index calls run in worker threads so that downloads, scrapes, model calls and
+    uploads overlap across blobs.
+
+    Args:
+        blob (google.cloud.storage.Blob): The input JSON blob.
+        account (dict): The synthetic account data.
+        packer (ItemPacker): Optional packer that evaluates short items together.
+
+    Returns:
+        bool: True if an annotation was saved.
+    """
+    try:
+        print(f"Processing file: {blob.name}")
+        # Download the JSON file
+        data = await asyncio.to_thread(blob.download_as_bytes)
+        input_data = json.loads(data)
+        print("Input data loaded.")
+
+        # Process the input data to create an input task (may scrape a website)
+        input_task, task_type = await asyncio.to_thread(process_input_data, input_data, account)
+
+        # Reuse a persona's evaluation of an identical or nearly identical item if there is one
+        shared = await asyncio.to_thread(find_shared_evaluation, blob, input_task, account)
+        if shared is not None:
+            account, response_json = shared
+        else:
+            # Generate output ranking, packed together with other short items where possible
+            if packer is not None and packer.accepts(input_task, task_type):
+                response_text = await packer.evaluate(input_task, account, task_type)
+            else:
+                response_text = await generate_output_ranking(input_task, account, task_type=task_type)
+            if response_text is None:
+                print(f"Failed to generate response for {blob.name}")
+                return False
+
+            print(f"Generated response: {response_text}")
+
+            # Parse the response text as JSON, re-asking only if it cannot be recovered
+            response_json = await recover_evaluation(response_text, input_task, account, task_type)
+            if response_json is None:
+                print(f"Failed to parse response as JSON for {blob.name}")
+                return False
+            print("Model response parsed as JSON.")
+
+        result = build_annotation_result(response_json, task_type)
+        output_data = build_output_data(input_data, result, account)
+
+        # Save the output data to the output bucket
+        await asyncio.to_thread(save_output_data, build_output_name(blob.name), output_data)
+        await asyncio.to_thread(record_evaluation, blob, account, response_json, shared is not None)
+        return True
+
+    except Exception as e:
+        print(f"An error occurred while processing {blob.name}: {e}")
+        return False
+
+# Multi-persona fan-out settings
+PERSONAS_PER_REQUEST = 1  # Personas evaluated per model call; values above 1 enable fan-out
+
+MULTI_PERSONA_INSTRUCTION = '''
+Evaluate the content below separately for each of the {count} synthetic personas listed.
+Fully embody each persona in turn, independently of the others.
+Respond with a raw JSON array (no ```json or ``` tags) containing exactly {count} evaluation objects,
+one per persona and in the order the personas are listed. Each object must contain all fields of a
+single evaluation, plus "persona_index" set to the number of the persona it belongs to.
+'''
+
+# Function to select the accounts that evaluate one blob in fan-out mode
+def select_accounts(accounts, account_index, count=PERSONAS_PER_REQUEST):
+    """
+    Select distinct consecutive accounts from the rotation for a single blob.
+
+    Args:
+        accounts (list): The synthetic accounts to rotate through.
+        account_index (int): The current position in the account rotation.
+        count (int): Number of accounts to select.
+
+    Returns:
+        list: The selected accounts.
+    """
+    count = min(count, len(accounts))
+    return [accounts[(account_index + offset) % len(accounts)] for offset in range(count)]
+
+# Function to build the persona and task parts that ask for several persona evaluations at once
+def build_multi_persona_prompt(input_task, accounts):
+    """
+    Build the persona block and input task that evaluate one item for several personas in a
+    single call.
+
+    Args:
+        input_task (list): The input task for the model.
+        accounts (list): The synthetic accounts to evaluate for.
+
+    Returns:
+        tuple(str, list)
+        str: The numbered persona details.
+        list: The input task, prefixed with the multi-persona instruction.
+    """
+    personas = "\n".join(
+        f"Persona {index}: {render_persona(account).text}" for index, account in enumerate(accounts)
+    )
+    return (
+        f"Your synthetic persona details:\n{personas}",
+        [MULTI_PERSONA_INSTRUCTION.format(count=len(accounts))] + input_task,
+    )
+
+# Function to split a multi-persona response back into per-persona evaluations
+def split_multi_persona_response(response_text, accounts):
+    """
+    Parse a JSON array of evaluations and assign each one to its persona.
+
+    Args:
+        response_text (str): The raw model response.
+        accounts (list): The synthetic accounts the prompt was built for.
+
+    Returns:
+        list: One evaluation dict per account, or None where the model omitted a persona.
+
+    Raises:
+        ValueError: If no JSON array can be recovered from the response.
+    """
+    return split_indexed_evaluations(response_text, len(accounts), "persona_index")
+
+# Function to split a JSON array response into evaluations addressed by an index field
+def split_indexed_evaluations(response_text, count, index_field):
+    """
+    Parse a JSON array of evaluations and place each one at the position named by its
+    index field (falling back to its position in the array).
+
+    Args:
+        response_text (str): The raw model response.
+        count (int): The number of evaluations requested.
+        index_field (str): The field holding each evaluation's index, e.g. "persona_index".
+
+    Returns:
+        list: One evaluation dict per requested index, or None where the model omitted one.
+
+    Raises:
+        ValueError: If no JSON array can be recovered from the response.
+    """
+    PARSE_STATS['responses'] += 1
+    evaluations = parse_model_json(response_text, list, PARSE_STATS)
+    by_index = [None] * count
+    for position, evaluation in enumerate(evaluations):
+        if not isinstance(evaluation, dict):
+            continue
+        index = evaluation.pop(index_field, position)
+        if isinstance(index, str) and index.strip().isdigit():
+            index = int(index)
+        evaluation = normalize_evaluation(evaluation, PARSE_STATS)
+        if isinstance(index, int) and 0 <= index < count and by_index[index] is None:
+            by_index[index] = evaluation
+    missing = by_index.count(None)
+    if missing:
+        print(f"Model response is missing {missing} of {count} evaluations.")
+    return by_index
+
+# Function to use Vertex AI for evaluating one input task for several personas
+async def generate_output_rankings(input_task, accounts):
+    """
+    Use Vertex AI to evaluate an input task for several accounts in a single call.
+
+    Args:
+        input_task (list): The input task for the model.
+        accounts (list): The synthetic accounts data.
+
+    Returns:
+        str: The generated JSON array response from the model.
+    """
+    print(f"Generating output rankings for {len(accounts)} personas using the Vertex AI model...")
+    try:
+        response_text = await generate_response(
+            *build_multi_persona_prompt(input_task, accounts),
+            response_schema=build_indexed_evaluations_schema("persona_index")
+        )
+        print("Model response generated.")
+        return response_text
+    except Exception as e:
+        print(f"An error occurred while generating the output: {e}")
+        return None
+
+# Function to evaluate one input blob for several personas inside the async pipeline
+async def process_blob_multi(blob, accounts):
+    """
+    Download a blob, evaluate it for several accounts in one model call and upload one
+    Label Studio annotation per account.
+
+    Args:
+        blob (google.cloud.storage.Blob): The input JSON blob.
+        accounts (list): The synthetic accounts data.
+
+    Returns:
+        int: The number of annotations saved.
+    """
+    try:
+        print(f"Processing file: {blob.name}")
+        # Download the JSON file
+        data = await asyncio.to_thread(blob.download_as_bytes)
+        input_data = json.loads(data)
+        print("Input data loaded.")
+
+        # Process the input data to create an input task (may scrape a website)
+        input_task, task_type = await asyncio.to_thread(process_input_data, input_data, accounts[0])
+        if DUPLICATE_INDEX is not None:
+            await asyncio.to_thread(DUPLICATE_INDEX.cluster_of, blob, input_task)
+
+        # Generate output rankings for all personas at once
+        response_text = await generate_output_rankings(input_task, accounts)
+        if response_text is None:
+            print(f"Failed to generate response for {blob.name}")
+            return 0
+
+        print(f"Generated response: {response_text}")
+
+        # Parse the response text and split it into per-persona evaluations
+        error = None
+        try:
+            evaluations = split_multi_persona_response(response_text, accounts)
+            print("Model response parsed as JSON.")
+        except ValueError as e:
+            print(f"Failed to parse response as JSON for {blob.name}: {e}")
+            evaluations, error = [None] * len(accounts), e
+
+        # Re-ask the model, per persona, for evaluations that are unparseable, missing or incomplete
+        evaluations = await asyncio.gather(*(
+            complete_evaluation(evaluation, error, response_text, input_task, account, task_type)
+            for account, evaluation in zip(accounts, evaluations)
+        ))
+
+        saved = 0
+        for account, response_json in zip(accounts, evaluations):
+            if response_json is None:
+                continue
+            try:
+                result = build_annotation_result(response_json, task_type)
+                output_data = build_output_data(input_data, result, account)
+                # Save the output data to the output bucket
+                await asyncio.to_thread(save_output_data, build_output_name(blob.name), output_data)
+            except Exception as e:
+                # Annotations already uploaded for other personas still count
+                print(f"Failed to save the annotation of {blob.name} for persona {account['id']}: {e}")
+                continue
+            await asyncio.to_thread(record_evaluation, blob, account, response_json)
+            saved += 1
+        return saved
+
+    except Exception as e:
+        print(f"An error occurred while processing {blob.name}: {e}")
+        return 0
+
+# Multi-item packing settings
+PACKING_TOKEN_BUDGET = 4000  # Approximate content tokens per packed request (pipelined mode, coverage planner off); 0 disables packing
+PACKING_MAX_ITEM_TOKENS = 500  # Only items at or below this size are packed
+PACKING_MAX_ITEMS = 10  # Maximum number of items per packed request
+PACKING_MAX_WAIT_SECONDS = 2.0  # How long a partially filled pack waits for more items
+PACKABLE_TASK_TYPES = ('text', 'chat')
+
+PACKED_ITEMS_INSTRUCTION = '''
+Evaluate each of the {count} numbered items below separately, as independent pieces of content.
+Respond with a raw JSON array (no ```json or ``` tags) containing exactly {count} evaluation objects,
+one per item and in the order the items are listed. Each object must contain all fields of a
+single evaluation, plus "item_index" set to the number of the item it belongs to.
+'''
+
+# Function to estimate the number of tokens in a piece of text
+def estimate_tokens(text):
+    """
+    Roughly estimate the number of model tokens in a text (about four characters per token).
+
+    Args:
+        text (str): The text to measure.
+
+    Returns:
+        int: The estimated token count.
+    """
+    return max(1, len(text) // 4)
+
+# Function to build the input task that evaluates several items in one request
+def build_packed_task(input_tasks):
+    """
+    Combine several text input tasks into one numbered, packed input task.
+
+    Args:
+        input_tasks (list): The individual input tasks.
+
+    Returns:
+        list: The packed input task.
+    """
+    packed_task = [PACKED_ITEMS_INSTRUCTION.format(count=len(input_tasks))]
+    for index, input_task in enumerate(input_tasks):
+        packed_task.append(f"\nItem {index}: {input_task[0]}")
+        packed_task.extend(input_task[1:])
+    return packed_task
+
+# Groups short items for the same persona into shared model requests
+class ItemPacker:
+    """
+    Collect short text and chat items per persona and evaluate each group in one model call.
+
+    Each caller awaits the evaluation of its own item. A pack is sent once it reaches the token
+    budget or item limit, or after PACKING_MAX_WAIT_SECONDS. Items that are missing from a packed
+    response, or whose pack failed to parse, fall back to individual model calls; incomplete
+    evaluations are returned as they are, for the caller to re-ask like any other response.
+    """
+
+    def __init__(self, token_budget=PACKING_TOKEN_BUDGET, max_items=PACKING_MAX_ITEMS,
+                 max_wait=PACKING_MAX_WAIT_SECONDS):
+        self.token_budget = token_budget
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self.packed_calls = 0
+        self.packed_items = 0
+        self.fallback_items = 0
+        self._packs = {}
+        self._flushes = set()
+
+    def accepts(self, input_task, task_type):
+        """
+        Check whether an input task is small enough to be packed.
+
+        Args:
+            input_task (list): The input task for the model.
+            task_type (str): The task type.
+
+        Returns:
+            bool: True if the item should go through the packer.
+        """
+        if task_type not in PACKABLE_TASK_TYPES:
+            return False
+        return all(isinstance(part, str) for part in input_task) and \
+            estimate_tokens("".join(input_task)) <= PACKING_MAX_ITEM_TOKENS
+
+    async def evaluate(self, input_task, account, task_type=None):
+        """
+        Add an item to the persona's current pack and wait for its evaluation.
+
+        Args:
+            input_task (list): The input task for the model.
+            account (dict): The synthetic account data.
+            task_type (str): The task type, used by the model cascade if the item falls back to a single call.
+
+        Returns:
+            str: The JSON evaluation for this item, or None if it could not be generated.
+        """
+        loop = asyncio.get_running_loop()
+        tokens = estimate_tokens("".join(input_task))
+        pack = self._packs.get(account['id'])
+        if pack is not None and pack['tokens'] + tokens > self.token_budget:
+            self._flush(account['id'])
+            pack = None
+        if pack is None:
+            pack = {'account': account, 'items': [], 'tokens': 0}
+            pack['timer'] = loop.call_later(self.max_wait, self._flush, account['id'])
+            self._packs[account['id']] = pack
+        future = loop.create_future()
+        pack['items'].append((input_task, task_type, future))
+        pack['tokens'] += tokens
+        if pack['tokens'] >= self.token_budget or len(pack['items']) >= self.max_items:
+            self._flush(account['id'])
+        return await future
+
+    def _flush(self, account_id):
+        pack = self._packs.pop(account_id, None)
+        if pack is None:
+            return
+        pack['timer'].cancel()
+        flush = asyncio.ensure_future(self._evaluate_pack(pack['account'], pack['items']))
+        self._flushes.add(flush)
+        flush.add_done_callback(self._flushes.discard)
+
+    async def _evaluate_pack(self, account, items):
+        evaluations = [None] * len(items)
+        try:
+            if len(items) > 1:
+                print(f"Evaluating a pack of {len(items)} items for account {account['id']}...")
+                self.packed_calls += 1
+                response_text = await generate_output_ranking(
+                    build_packed_task([input_task for input_task, _, _ in items]), account,
+                    response_schema=build_indexed_evaluations_schema("item_index")
+                )
+                if response_text is not None:
+                    evaluations = split_indexed_evaluations(response_text, len(items), "item_index")
+        except (json.JSONDecodeError, ValueError) as e:
+            print(f"Packed response was malformed, falling back to single-item calls: {e}")
+
+        async def resolve(input_task, task_type, future, evaluation):
+            try:
+                if evaluation is not None:
+                    self.packed_items += 1
+                    future.set_result(json.dumps(evaluation))
+                    return
+                if len(items) > 1:
+                    self.fallback_items += 1
+                future.set_result(await generate_output_ranking(input_task, account, task_type=task_type))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+        await asyncio.gather(*(
+            resolve(input_task, task_type, future, evaluation)
+            for (input_task, task_type, future), evaluation in zip(items, evaluations)
+        ))
+
+    def report(self):
+        """
+        Print packing statistics.
+        """
+        print(f"Packing: {self.packed_items} items answered by {self.packed_calls} packed calls, "
+              f"{self.fallback_items} items fell back to single-item calls.")
+
+# Function to evaluate a batch of blobs with a bounded pool of async workers
+async def run_pipeline(blobs, accounts, account_index, ledger=None, concurrency=PIPELINE_CONCURRENCY,
+                       personas_per_request=PERSONAS_PER_REQUEST):
+    """
+    Evaluate blobs with a bounded number of concurrent workers. With a concurrency of 1, blobs
+    are evaluated one at a time, in dispatch order.
+
+    Accounts are assigned in dispatch order.
+
+    Args:
+        blobs (iterable): The input JSON blobs.
+        accounts (list): The synthetic accounts to rotate through.
+        account_index (int): The current position in the account rotation.
+        ledger (BlobLedger): Optional ledger in which successful annotations are recorded.
+        concurrency (int): Maximum number of blobs in flight at once.
+        personas_per_request (int): Personas evaluated per model call; above 1 enables fan-out.
+
+    Returns:
+        int: The updated account index.
+    """
+    print(f"Starting pipeline with concurrency {concurrency}...")
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=concurrency * 2)
+    )
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    # Short items are only packed when each blob is evaluated for a single persona, and when
+    # several blobs are in flight (a single worker would wait out every pack's timer alone).
+    # Packs are keyed by persona, and the coverage planner picks a new persona almost every item,
+    # so packing is also off while the planner is active
+    packer = ItemPacker() if PACKING_TOKEN_BUDGET > 0 and personas_per_request == 1 \
+        and concurrency > 1 and COVERAGE_PLANNER is None else None
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                blob, item_accounts = item
+                if personas_per_request > 1:
+                    saved = await process_blob_multi(blob, item_accounts)
+                else:
+                    saved = int(await process_blob(blob, item_accounts[0], packer))
+                if saved and ledger is not None:
+                    await asyncio.to_thread(ledger.record_annotation, blob, saved)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    # Advance the blob iterator in a worker thread, since streamed listings fetch pages lazily
+    blob_iterator = iter(blobs)
+    while (blob := await asyncio.to_thread(next, blob_iterator, None)) is not None:
+        if personas_per_request > 1:
+            # Get the accounts that evaluate this blob together
+            item_accounts = assign_accounts(blob, accounts, account_index, personas_per_request)
+            account_index += 1
+            print(f"Using {len(item_accounts)} accounts from rotation position {account_index}.")
+        else:
+            # Get the current account
+            item_accounts = assign_accounts(blob, accounts, account_index)
+            account_index += 1
+            print(f"Using account {account_index}: {item_accounts[0]['email']}")
+        await queue.put((blob, item_accounts))
+
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+    if packer is not None:
+        packer.report()
+    print("Pipeline batch finished.")
+    return account_index
+
+# Function to run a coroutine from synchronous code
+def run_async(coroutine):
+    """
+    Run a coroutine to completion, also when an event loop is already running
+    (as it is inside Colab/Jupyter), by running it on a separate thread.
+
+    Args:
+        coroutine (coroutine): The coroutine to run.
+
+    Returns:
+        The coroutine's return value.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+# Processed-blob ledger settings
+LEDGER_PATH = 'processed_blobs_ledger.sqlite3'  # Local file that persists across restarts
+ANNOTATIONS_PER_BLOB = 5  # Blobs with fewer synthetic annotations than this are (re)processed
+
+# Persistent record of which input blobs have been annotated and how often
+class BlobLedger:
+    """
+    File-backed ledger of input blobs, keyed by blob name, that stores each blob's generation
+    and how many synthetic annotations have been uploaded for it. A blob whose generation
+    changes (i.e. the object was overwritten) starts again from zero annotations.
+    """
+
+    def __init__(self, path=LEDGER_PATH, annotations_per_blob=ANNOTATIONS_PER_BLOB):
+        self.path = path
+        self.annotations_per_blob = annotations_per_blob
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "name TEXT PRIMARY KEY, generation INTEGER, annotation_count INTEGER NOT NULL, "
+            "last_annotated_at TEXT)"
+        )
+        self._connection.commit()
+        print(f"Opened blob ledger at {path}.")
+
+    def annotation_count(self, blob):
+        """
+        Return how many annotations have been recorded for the current generation of a blob.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob.
+
+        Returns:
+            int: The number of recorded annotations.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT generation, annotation_count FROM blobs WHERE name = ?", (blob.name,)
+            ).fetchone()
+        if row is None or row[0] != blob.generation:
+            return 0
+        return row[1]
+
+    def needs_annotation(self, blob):
+        """
+        Check whether a blob is new or still under-annotated.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob.
+
+        Returns:
+            bool: True if the blob should be processed.
+        """
+        return self.annotation_count(blob) < self.annotations_per_blob
+
+    def record_annotation(self, blob, count=1):
+        """
+        Record successfully uploaded annotations for a blob.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob.
+            count (int): Number of annotations uploaded.
+        """
+        current_time = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z"
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO blobs (name, generation, annotation_count, last_annotated_at) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET "
+                "annotation_count = CASE WHEN generation IS excluded.generation "
+                "THEN annotation_count + excluded.annotation_count ELSE excluded.annotation_count END, "
+                "generation = excluded.generation, last_annotated_at = excluded.last_annotated_at",
+                (blob.name, blob.generation, count, current_time)
+            )
+            self._connection.commit()
+
+# Rating aggregation and early stopping settings
+EARLY_STOPPING_ENABLED = False  # Stop scheduling items whose ratings have converged
+AGGREGATES_PATH = 'rating_aggregates.sqlite3'  # Local file that persists across restarts
+MIN_EVALUATIONS_PER_GROUP = 2  # Human and non-human evaluations needed before an item can converge
+# Items that never converge stop after this many evaluations. Raising it above ANNOTATIONS_PER_BLOB
+# spends more than the baseline budget: with 1-5 integer ratings, a small group only reaches the
+# half-width below when its ratings (nearly) agree.
+MAX_EVALUATIONS_PER_ITEM = ANNOTATIONS_PER_BLOB
+CONVERGENCE_HALF_WIDTH = 0.5  # Largest 95% confidence interval half-width (rating points) of a converged item
+PERSONA_GROUPS = ('human', 'non_human')
+
+# Two-sided 95% Student t critical values by degrees of freedom (1.96 beyond the table)
+T_CRITICAL_95 = {1: 12.71, 2: 4.30, 3: 3.18, 4: 2.78, 5: 2.57, 6: 2.45, 7: 2.36, 8: 2.31, 9: 2.26, 10: 2.23,
+                 12: 2.18, 15: 2.13, 20: 2.09, 30: 2.04, 60: 2.00, 120: 1.98}
+
+# Function to look up the 95% t critical value, rounding the degrees of freedom down
+def t_critical_95(degrees_of_freedom):
+    """
+    Look up the two-sided 95% Student t critical value, using the nearest tabulated degrees
+    of freedom at or below the given value (which errs towards wider intervals).
+
+    Args:
+        degrees_of_freedom (int): The degrees of freedom (at least 1).
+
+    Returns:
+        float: The critical value.
+    """
+    if degrees_of_freedom > max(T_CRITICAL_95):
+        return 1.96
+    return T_CRITICAL_95[max(df for df in T_CRITICAL_95 if df <= degrees_of_freedom)]
+
+# Running per-item rating statistics with a sequential stopping rule
+class RatingAggregator:
+    """
+    File-backed running statistics of each item's ratings: per input blob, persona group
+    (human / non-human) and rating dimension, the count, mean and sum of squared deviations
+    (Welford's algorithm), updated as each evaluation is saved.
+
+    An item has converged once both persona groups have at least MIN_EVALUATIONS_PER_GROUP
+    evaluations and the 95% confidence interval of every dimension's mean is at most
+    CONVERGENCE_HALF_WIDTH wide on each side. Like the ledger, statistics restart when a
+    blob's generation changes.
+    """
+
+    def __init__(self, path=AGGREGATES_PATH, min_per_group=MIN_EVALUATIONS_PER_GROUP,
+                 half_width=CONVERGENCE_HALF_WIDTH):
+        self.min_per_group = min_per_group
+        self.half_width = half_width
+        self.metrics = collections.Counter()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS aggregates ("
+            "name TEXT NOT NULL, grp TEXT NOT NULL, generation INTEGER, counts BLOB NOT NULL, "
+            "means BLOB NOT NULL, m2 BLOB NOT NULL, PRIMARY KEY (name, grp))"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS converged (name TEXT PRIMARY KEY, generation INTEGER, evaluations INTEGER)"
+        )
+        self._connection.commit()
+        print(f"Opened rating aggregates at {path}.")
+
+    def _load(self, blob):
+        rows = self._connection.execute(
+            "SELECT grp, generation, counts, means, m2 FROM aggregates WHERE name = ?", (blob.name,)
+        ).fetchall()
+        stats = {}
+        for group, generation, counts, means, m2 in rows:
+            if generation == blob.generation:
+                stats[group] = (np.frombuffer(counts, dtype=np.int64).copy(),
+                                np.frombuffer(means, dtype=np.float64).copy(),
+                                np.frombuffer(m2, dtype=np.float64).copy())
+        return stats
+
+    def add(self, blob, account, response_json):
+        """
+        Add one evaluation of an item to its running statistics.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob the evaluation belongs to.
+            account (dict): The persona that evaluated it.
+            response_json (dict): The parsed evaluation.
+        """
+        group = 'human' if account.get('species') == 'Human' else 'non_human'
+        ratings = np.array([response_json.get(field, np.nan) for field in RATING_FIELDS], dtype=np.float64)
+        present = ~np.isnan(ratings)
+        with self._lock:
+            counts, means, m2 = self._load(blob).get(group, (
+                np.zeros(len(RATING_FIELDS), dtype=np.int64), np.zeros(len(RATING_FIELDS)),
+                np.zeros(len(RATING_FIELDS))))
+            # Welford's update, only for the dimensions present in this evaluation
+            counts[present] += 1
+            delta = np.where(present, ratings - means, 0.0)
+            means += np.where(present, delta / np.maximum(counts, 1), 0.0)
+            m2 += np.where(present, delta * (np.nan_to_num(ratings) - means), 0.0)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO aggregates (name, grp, generation, counts, means, m2) VALUES (?, ?, ?, ?, ?, ?)",
+                (blob.name, group, blob.generation, counts.tobytes(), means.tobytes(), m2.tobytes())
+            )
+            stats = self._load(blob)
+            converged = self._connection.execute(
+                "SELECT 1 FROM converged WHERE name = ? AND generation = ?", (blob.name, blob.generation)
+            ).fetchone()
+            if converged is None and self._has_converged(stats):
+                evaluations = sum(int(stats[group][0].max()) for group in stats)
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO converged (name, generation, evaluations) VALUES (?, ?, ?)",
+                    (blob.name, blob.generation, evaluations)
+                )
+                self.metrics['converged'] += 1
+                print(f"Ratings for {blob.name} converged after {evaluations} evaluations.")
+            self._connection.commit()
+        self.metrics['evaluations'] += 1
+
+    def _has_converged(self, stats):
+        for group in PERSONA_GROUPS:
+            if group not in stats:
+                return False
+            counts, _, m2 = stats[group]
+            if counts.min() < self.min_per_group:
+                return False
+            half_widths = [t_critical_95(count - 1) * math.sqrt(squares / (count - 1) / count)
+                           for count, squares in zip(counts, m2)]
+            if max(half_widths) > self.half_width:
+                return False
+        return True
+
+    def is_converged(self, blob):
+        """
+        Check whether the current generation of a blob has converged and needs no more evaluations.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob.
+
+        Returns:
+            bool: True if the item should no longer be scheduled.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT generation FROM converged WHERE name = ?", (blob.name,)
+            ).fetchone()
+        return row is not None and row[0] == blob.generation
+
+    def summary(self, blob):
+        """
+        Summarize an item's ratings per persona group.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob.
+
+        Returns:
+            dict: Per group and rating dimension, the count, mean and 95% confidence half-width.
+        """
+        with self._lock:
+            stats = self._load(blob)
+        summary = {}
+        for group, (counts, means, m2) in stats.items():
+            summary[group] = {
+                field: {
+                    'count': int(count),
+                    'mean': float(mean),
+                    'half_width': t_critical_95(count - 1) * math.sqrt(squares / (count - 1) / count)
+                    if count > 1 else None,
+                }
+                for field, count, mean, squares in zip(RATING_FIELDS, counts, means, m2)
+            }
+        return summary
+
+    def report(self):
+        """
+        Print aggregation statistics.
+        """
+        with self._lock:
+            items, converged, evaluations = self._connection.execute(
+                "SELECT (SELECT COUNT(DISTINCT name) FROM aggregates), COUNT(*), COALESCE(SUM(evaluations), 0) "
+                "FROM converged"
+            ).fetchone()
+        average = f", {evaluations / converged:.1f} evaluations each" if converged else ""
+        print(f"Rating aggregation: {converged} of {items} items converged{average}; "
+              f"{self.metrics['evaluations']} evaluations added this session.")
+
+# Dry runs do not upload anything, so their evaluations are only aggregated in memory
+RATING_AGGREGATOR = RatingAggregator(':memory:' if DRYRUN else AGGREGATES_PATH) if EARLY_STOPPING_ENABLED else None
+
+# Function to add a saved evaluation to the item's running statistics, persona coverage and duplicate cluster
+def record_evaluation(blob, account, response_json, reused=False):
+    """
+    Add a saved evaluation to the rating aggregator, the coverage index and the duplicate
+    index, where enabled.
+
+    Args:
+        blob (google.cloud.storage.Blob): The input blob.
+        account (dict): The persona that evaluated it.
+        response_json (dict): The parsed evaluation.
+        reused (bool): True if the evaluation was shared from a duplicate item.
+    """
+    if RATING_AGGREGATOR is not None:
+        RATING_AGGREGATOR.add(blob, account, response_json)
+    if COVERAGE_PLANNER is not None:
+        COVERAGE_PLANNER.record(blob, account)
+    if DUPLICATE_INDEX is not None:
+        DUPLICATE_INDEX.share(blob, account, response_json, reused)
+
+# Coverage planner settings
+COVERAGE_PLANNER_ENABLED = False  # Choose personas that fill each item's coverage gaps instead of rotating
+COVERAGE_PERSONA_POOL_SIZE = 100000  # Pool size when the planner is enabled (the rotation uses a handful)
+COVERAGE_INDEX_PATH = 'coverage_index.sqlite3'  # Local file that persists across restarts
+COVERAGE_STANCE_BINS = 3  # Advocacy scales are covered as low / middle / high stances
+COVERAGE_MAX_DRAWS = 16  # Alias-table draws before an attribute is considered covered
+COVERAGE_CANDIDATES = 8  # Personas compared when filling a gap
+
+# Attributes whose option distribution each item should cover, with their target weights.
+# Humans and non-humans follow the pool's 50/50 split; other options are weighted uniformly.
+COVERAGE_TARGETS = {
+    'human': [0.5, 0.5],
+    'species': [1 / len(NON_HUMAN_SPECIES)] * len(NON_HUMAN_SPECIES),
+    'role': [1 / (len(HUMAN_ROLES) + len(NON_HUMAN_ROLES))] * (len(HUMAN_ROLES) + len(NON_HUMAN_ROLES)),
+    'country': [1 / len(COUNTRIES)] * len(COUNTRIES),
+    **{field: [1 / COVERAGE_STANCE_BINS] * COVERAGE_STANCE_BINS for field in ADVOCACY_SCALE_FIELDS},
+}
+
+# Constant-time sampling from a discrete distribution
+class AliasTable:
+    """
+    Walker/Vose alias table: built once in O(n) from a list of weights, after which each
+    draw takes one uniform index and one coin flip, in O(1) regardless of the number of options.
+    """
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+        scaled = [weight * count / total for weight in weights]
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+        small = [index for index, weight in enumerate(scaled) if weight < 1]
+        large = [index for index, weight in enumerate(scaled) if weight >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+
+    def sample(self):
+        """
+        Draw one option index.
+
+        Returns:
+            int: The option index.
+        """
+        index = random.randrange(len(self.probability))
+        return index if random.random() < self.probability[index] else self.alias[index]
+
+# Function to encode every persona of a pool on the coverage attributes
+def coverage_codes(pool):
+    """
+    Encode each persona of a pool as its option index on every coverage attribute (-1 where
+    the attribute does not apply, e.g. the country of a non-human persona).
+
+    Args:
+        pool (PersonaPool): The persona pool.
+
+    Returns:
+        dict: Attribute name to an array of option indexes, one per persona.
+    """
+    columns = pool.columns
+    human = columns['is_human']
+    codes = {
+        'human': human.astype(np.int64),
+        'species': np.where(human, -1, columns['species'].astype(np.int64)),
+        'role': np.where(human, columns['role_in_animal_advocacy'],
+                         columns['role'].astype(np.int64) + len(HUMAN_ROLES)),
+        'country': np.where(human, columns['country'], -1),
+    }
+    for field in ADVOCACY_SCALE_FIELDS:
+        stance = np.minimum(columns[field].astype(np.int64) * COVERAGE_STANCE_BINS // 100, COVERAGE_STANCE_BINS - 1)
+        codes[field] = np.where(human, stance, -1)
+    return codes
+
+# Plans which personas evaluate each item so its persona attributes are covered evenly
+class CoveragePlanner:
+    """
+    Persistent coverage index of how often each option of each coverage attribute has
+    evaluated each item, and a planner that uses it to pick the persona that fills an
+    item's biggest gap.
+
+    For an item, the attribute whose most under-covered option is furthest short of its
+    target share is filled first: an under-covered option is drawn from the
+    attribute's alias table, and of a few personas with that option the one that also fills
+    the most other gaps is chosen.
+    """
+
+    def __init__(self, pool, path=COVERAGE_INDEX_PATH, targets=COVERAGE_TARGETS):
+        self.pool = pool
+        self.targets = targets
+        self.alias_tables = {attribute: AliasTable(weights) for attribute, weights in targets.items()}
+        self.codes = coverage_codes(pool)
+        # Inverted index: attribute -> option -> indexes of the personas with that option
+        self.personas_by_option = {}
+        for attribute, codes in self.codes.items():
+            order = np.argsort(codes, kind='stable')
+            options, starts = np.unique(codes[order], return_index=True)
+            self.personas_by_option[attribute] = {
+                int(option): group for option, group in zip(options, np.split(order, starts[1:])) if option >= 0
+            }
+        self.metrics = collections.Counter()
+        self.gaps = collections.defaultdict(float)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS coverage ("
+            "name TEXT NOT NULL, generation INTEGER, attribute TEXT NOT NULL, option INTEGER NOT NULL, "
+            "count INTEGER NOT NULL, PRIMARY KEY (name, attribute, option))"
+        )
+        self._connection.commit()
+        print(f"Opened coverage index at {path}.")
+
+    def coverage(self, blob):
+        """
+        Get an item's coverage counts.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob.
+
+        Returns:
+            dict: Attribute name to a Counter of evaluations per option.
+        """
+        counts = {attribute: collections.Counter() for attribute in self.targets}
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT generation, attribute, option, count FROM coverage WHERE name = ?", (blob.name,)
+            ).fetchall()
+        for generation, attribute, option, count in rows:
+            if generation == blob.generation and attribute in counts:
+                counts[attribute][option] = count
+        return counts
+
+    def record(self, blob, account):
+        """
+        Add an evaluation by a pooled persona to the item's coverage.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob.
+            account (Persona): The persona that evaluated it.
+        """
+        if not isinstance(account, Persona) or account.pool is not self.pool:
+            return
+        with self._lock:
+            # Coverage restarts when the blob is overwritten
+            self._connection.execute(
+                "DELETE FROM coverage WHERE name = ? AND generation IS NOT ?", (blob.name, blob.generation)
+            )
+            for attribute, codes in self.codes.items():
+                option = int(codes[account.index])
+                if option < 0:
+                    continue
+                self._connection.execute(
+                    "INSERT INTO coverage (name, generation, attribute, option, count) VALUES (?, ?, ?, ?, 1) "
+                    "ON CONFLICT(name, attribute, option) DO UPDATE SET count = count + 1",
+                    (blob.name, blob.generation, attribute, option)
+                )
+            self._connection.commit()
+
+    def _distance(self, attribute, counts):
+        # Total variation distance between the observed and target distributions
+        total = sum(counts.values())
+        if total == 0:
+            return 1.0
+        weights = self.targets[attribute]
+        observed = sum(abs(count / total - weights[option]) for option, count in counts.items())
+        return 0.5 * (observed + 1 - sum(weights[option] for option in counts))
+
+    def _shortfall(self, attribute, counts):
+        # Evaluations the most under-covered option is short of its target share
+        total = sum(counts.values()) + 1
+        return max(weight * total - counts[option] for option, weight in enumerate(self.targets[attribute]))
+
+    def _under_target(self, attribute, counts, option):
+        return counts[option] < self.targets[attribute][option] * (sum(counts.values()) + 1)
+
+    def _gaps_filled(self, index, coverage):
+        # Share of the persona's applicable attributes that it fills, so humans (who have more
+        # attributes) are not favoured over non-humans
+        applicable = filled = 0
+        for attribute, codes in self.codes.items():
+            option = int(codes[index])
+            if option >= 0:
+                applicable += 1
+                filled += self._under_target(attribute, coverage[attribute], option)
+        return filled / applicable
+
+    def _choose_one(self, coverage, exclude):
+        attributes = sorted(self.targets, key=lambda attribute: -self._shortfall(attribute, coverage[attribute]))
+        for attribute in attributes:
+            for _ in range(COVERAGE_MAX_DRAWS):
+                option = self.alias_tables[attribute].sample()
+                personas = self.personas_by_option[attribute].get(option)
+                if personas is None or not self._under_target(attribute, coverage[attribute], option):
+                    continue
+                candidates = [int(personas[random.randrange(len(personas))]) for _ in range(COVERAGE_CANDIDATES)]
+                candidates = [index for index in candidates if index not in exclude]
+                if candidates:
+                    self.gaps[attribute] += self._distance(attribute, coverage[attribute])
+                    self.metrics[f'filled_{attribute}'] += 1
+                    return max(candidates, key=lambda index: self._gaps_filled(index, coverage))
+        self.metrics['fallbacks'] += 1
+        return random.randrange(len(self.pool))
+
+    def choose(self, blob, count=1):
+        """
+        Choose the personas that evaluate an item next.
+
+        Args:
+            blob (google.cloud.storage.Blob): The input blob.
+            count (int): Number of distinct personas to choose.
+
+        Returns:
+            list: The chosen personas.
+        """
+        coverage = self.coverage(blob)
+        chosen = []
+        for _ in range(min(count, len(self.pool))):
+            index = self._choose_one(coverage, set(chosen))
+            chosen.append(index)
+            self.metrics['choices'] += 1
+            # Count the pick as planned coverage so the next persona fills a different gap
+            for attribute, codes in self.codes.items():
+                if codes[index] >= 0:
+                    coverage[attribute][int(codes[index])] += 1
+        return [self.pool[index] for index in chosen]
+
+    def report(self):
+        """
+        Print how the planner's choices were spread over the coverage attributes.
+        """
+        filled = ", ".join(
+            f"{attribute} {self.metrics[f'filled_{attribute}']} (mean gap {self.gaps[attribute] / count:.2f})"
+            for attribute in self.targets if (count := self.metrics[f'filled_{attribute}'])
+        )
+        print(f"Coverage planner: {self.metrics['choices']} personas chosen, {self.metrics['fallbacks']} at random; "
+              f"gaps filled: {filled or 'none'}.")
+
+COVERAGE_PLANNER = None  # Created by the main script once the persona pool exists
+
+# Function to choose the accounts that evaluate a blob
+def assign_accounts(blob, accounts, account_index, count=1):
+    """
+    Choose the accounts that evaluate a blob: with the coverage planner when it is enabled,
+    otherwise from the rotation.
+
+    Args:
+        blob (google.cloud.storage.Blob): The input blob.
+        accounts (list): The synthetic accounts to rotate through.
+        account_index (int): The current position in the account rotation.
+        count (int): Number of accounts to choose.
+
+    Returns:
+        list: The chosen accounts.
+    """
+    if COVERAGE_PLANNER is not None:
+        return COVERAGE_PLANNER.choose(blob, count)
+    if count > 1:
+        return select_accounts(accounts, account_index, count)
+    return [accounts[(account_index // 5) % len(accounts)]]
+
+# Function to compare persona coverage of the rotation and the planner
+def benchmark_coverage(num_items=50, evaluations_per_item=10, pool_size=10000):
+    """
+    Simulate evaluating items with the account rotation and with the coverage planner, and
+    compare how far each item's persona distribution ends up from the coverage targets.
+
+    Args:
+        num_items (int): Number of simulated items.
+        evaluations_per_item (int): Evaluations per item.
+        pool_size (int): Number of personas in the pool.
+
+    Returns:
+        dict: Mean total variation distance to the targets per attribute, for each strategy.
+    """
+    pool = generate_persona_pool(pool_size, seed=0)
+    Item = collections.namedtuple('Item', ['name', 'generation'])
+    results = {}
+    for strategy in ('rotation', 'planner'):
+        planner = CoveragePlanner(pool, path=':memory:')
+        account_index = 0
+        for item_number in range(num_items):
+            item = Item(f"item-{item_number}.json", 1)
+            for _ in range(evaluations_per_item):
+                if strategy == 'planner':
+                    account = planner.choose(item)[0]
+                else:
+                    account = pool[(account_index // 5) % len(pool)]
+                    account_index += 1
+                planner.record(item, account)
+        results[strategy] = {
+            attribute: float(np.mean([
+                planner._distance(attribute, planner.coverage(Item(f"item-{item_number}.json", 1))[attribute])
+                for item_number in range(num_items)
+            ]))
+            for attribute in ('human', 'role', 'country', ADVOCACY_SCALE_FIELDS[0])
+        }
+        distances = ", ".join(f"{attribute} {distance:.2f}" for attribute, distance in results[strategy].items())
+        print(f"{strategy.capitalize()}: mean distance to coverage targets after {evaluations_per_item} "
+              f"evaluations per item: {distances}.")
+    return results
+
+# Streaming ingestion settings
+STREAMING_INGESTION = True  # Dispatch work while the bucket listing is still being paged through
+LISTING_PAGE_SIZE = 1000  # Number of blobs requested per listing page
+SHUFFLE_BUFFER_SIZE = 100  # Blobs buffered to randomize the streamed order; dispatch starts once it fills, so keep it well under a page
+
+# Function to stream the input bucket listing page by page
+def iter_input_blobs(prefix=None, max_results=None, page_size=LISTING_PAGE_SIZE):
+    """
+    Yield blobs from the input bucket one listing page at a time, without materializing
+    the full listing in memory.
+
+    Args:
+        prefix (str): Optional blob name prefix to list.
+        max_results (int): Optional maximum number of blobs to list.
+        page_size (int): Number of blobs requested per listing page.
+
+    Yields:
+        google.cloud.storage.Blob: The listed blobs.
+    """
+    iterator = input_bucket.list_blobs(prefix=prefix, max_results=max_results, page_size=page_size)
+    for page_number, page in enumerate(iterator.pages, start=1):
+        print(f"Listed input bucket page {page_number}.")
+        for blob in page:
+            yield blob
+
+# Function to select the JSON blobs that still need annotations
+def filter_json_blobs(blobs, ledger=None, aggregator=None):
+    """
+    Lazily filter blobs down to JSON files that are new or under-annotated.
+
+    Args:
+        blobs (iterable): The listed blobs.
+        ledger (BlobLedger): Optional ledger used to skip fully annotated blobs.
+        aggregator (RatingAggregator): Optional aggregator used to skip items whose ratings converged.
+
+    Yields:
+        google.cloud.storage.Blob: The blobs to process.
+    """
+    for blob in blobs:
+        if not blob.name.endswith('.json'):
+            continue
+        # Skip blobs that already have enough annotations for their current generation
+        if ledger is not None and not ledger.needs_annotation(blob):
+            continue
+        # Skip items whose ratings are already precise enough
+        if aggregator is not None and aggregator.is_converged(blob):
+            continue
+        yield blob
+
+# Function to randomize the order of a stream with bounded memory
+def shuffle_stream(items, buffer_size=SHUFFLE_BUFFER_SIZE):
+    """
+    Randomize the order of a stream using a fixed-size shuffle buffer. Once the buffer is
+    full, each new item replaces a randomly chosen buffered item, which is emitted; the
+    remaining items are shuffled and emitted when the stream ends.
+
+    Args:
+        items (iterable): The items to shuffle.
+        buffer_size (int): Maximum number of items held in memory.
+
+    Yields:
+        The items in randomized order.
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        index = random.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+    random.shuffle(buffer)
+    yield from buffer
+
+# Batch prediction settings
+BATCH_MODE = False  # Backfill under-annotated blobs with a batch prediction job before the online loop starts
+BATCH_BUCKET_NAME = 'label-studio-batch'  # Bucket holding batch request and result files
+BATCH_PREFIX = 'batch-prediction/'
+BATCH_LOCAL_DIR = 'batch-prediction-local'  # Dry runs keep batch files in this local directory instead
+BATCH_SHARD_SIZE = 10000  # Requests per JSONL request file
+BATCH_POLL_SECONDS = 60  # How often a running batch job is checked
+
+# Function to convert a response schema to the REST representation used in batch requests
+def rest_response_schema(schema):
+    """
+    Convert an OpenAPI-style response schema to the REST form (upper-case type names).
+
+    Args:
+        schema (dict): The response schema.
+
+    Returns:
+        dict: The REST response schema.
+    """
+    converted = {}
+    for key, value in schema.items():
+        if key == 'type':
+            value = value.upper()
+        elif key == 'properties':
+            value = {name: rest_response_schema(field) for name, field in value.items()}
+        elif key == 'items':
+            value = rest_response_schema(value)
+        converted[key] = value
+    return converted
+
+# Function to convert a prompt part to its REST representation
+def batch_request_part(part):
+    """
+    Convert a prompt part to the REST representation used in batch request files.
+
+    Args:
+        part (str or Part): The prompt part.
+
+    Returns:
+        dict: The REST part.
+    """
+    if isinstance(part, str):
+        return {"text": part}
+    return part.to_dict()
+
+# Function to build one batch prediction request
+def build_batch_request(request_id, persona, input_task, response_schema=EVALUATION_SCHEMA):
+    """
+    Build a batch prediction request line containing exactly the prompt the online loop sends.
+
+    Args:
+        request_id (str): Key used to match the result back to its blob and persona.
+        persona (str): The persona part of the prompt.
+        input_task (list): The input task for the model.
+        response_schema (dict): Optional schema the JSON response is constrained to.
+
+    Returns:
+        dict: The request line.
+    """
+    request = {
+        "contents": [{"role": "user", "parts": [batch_request_part(part) for part in [persona] + input_task]}],
+        "systemInstruction": {"parts": [{"text": SYSTEM_INSTRUCTION}]},
+        "labels": {"request_id": request_id},
+    }
+    if response_schema is not None:
+        request["generationConfig"] = {
+            "responseMimeType": "application/json",
+            "responseSchema": rest_response_schema(response_schema),
+        }
+    return {"request": request}
+
+# Function to find an account by persona ID
+def find_account(accounts, persona_id):
+    """
+    Find the account with a given persona ID in a persona pool or list of accounts.
+
+    Args:
+        accounts (PersonaPool or list): The synthetic accounts.
+        persona_id (int): The persona ID.
+
+    Returns:
+        dict: The account.
+
+    Raises:
+        KeyError: If no account has this ID.
+    """
+    if isinstance(accounts, PersonaPool):
+        return accounts[accounts.index_of(persona_id)]
+    for account in accounts:
+        if account['id'] == persona_id:
+            return account
+    raise KeyError(persona_id)
+
+# Function to write the batch request files for a backfill
+def write_batch_requests(store, job_name, blobs, accounts, account_index, ledger=None):
+    """
+    Build the prompts for every blob that needs annotations and write them as sharded JSONL
+    request files, plus a manifest that maps each request back to its blob, persona and task type.
+    Each blob gets one request per annotation it is missing (up to the ledger's target), for
+    consecutive personas in the rotation.
+
+    Args:
+        store (FileStore): Where the files are written.
+        job_name (str): Name of the batch job, used as the directory of its files.
+        blobs (iterable): The input JSON blobs.
+        accounts (list): The synthetic accounts to rotate through.
+        account_index (int): The current position in the account rotation.
+        ledger (BlobLedger): Optional ledger giving the annotations each blob still needs.
+
+    Returns:
+        tuple(list, int)
+        list: The names of the request files.
+        int: The new position in the account rotation.
+    """
+    shard_names = []
+    requests_lines = []
+    manifest_lines = []
+    request_count = 0
+
+    def flush_shard():
+        name = f"{BATCH_PREFIX}{job_name}/requests-{len(shard_names):05d}.jsonl"
+        store.write(name, "\n".join(requests_lines) + "\n")
+        shard_names.append(name)
+        requests_lines.clear()
+
+    for blob in blobs:
+        try:
+            input_data = json.loads(blob.download_as_bytes())
+            if ledger is not None:
+                needed = ledger.annotations_per_blob - ledger.annotation_count(blob)
+            else:
+                needed = ANNOTATIONS_PER_BLOB
+            if needed <= 0:
+                continue
+            if COVERAGE_PLANNER is not None:
+                blob_accounts = COVERAGE_PLANNER.choose(blob, needed)
+            else:
+                blob_accounts = select_accounts(accounts, account_index, needed)
+            account_index += len(blob_accounts)
+            input_task, task_type = process_input_data(input_data, blob_accounts[0])
+        except Exception as e:
+            print(f"An error occurred while preparing {blob.name} for batch prediction: {e}")
+            continue
+        for account in blob_accounts:
+            request_id = str(request_count)
+            request_count += 1
+            requests_lines.append(json.dumps(
+                build_batch_request(request_id, render_persona(account).prompt, input_task)
+            ))
+            manifest_lines.append(json.dumps({
+                "request_id": request_id, "blob": blob.name, "generation": blob.generation,
+                "persona_id": int(account['id']), "task_type": task_type,
+            }))
+            if len(requests_lines) >= BATCH_SHARD_SIZE:
+                flush_shard()
+    if requests_lines:
+        flush_shard()
+    store.write(f"{BATCH_PREFIX}{job_name}/manifest.jsonl", "\n".join(manifest_lines) + "\n")
+    print(f"Wrote {request_count} batch requests in {len(shard_names)} files for job {job_name}.")
+    return shard_names, account_index
+
+# Runs batch prediction jobs with the Vertex AI batch prediction service
+class VertexBatchService:
+    """
+    Submit request files to a Vertex AI batch prediction job and wait for its results.
+    """
+
+    def __init__(self, model_name=MODEL_NAME, poll_seconds=BATCH_POLL_SECONDS):
+        self.model_name = model_name
+        self.poll_seconds = poll_seconds
+
+    def run(self, store, request_names, output_prefix):
+        """
+        Run a batch prediction job over the request files.
+
+        Args:
+            store (FileStore): The store holding the request files.
+            request_names (list): The request file names.
+            output_prefix (str): Name prefix under which results are written.
+
+        Returns:
+            list: The names of the result files.
+        """
+        from vertexai.batch_prediction import BatchPredictionJob
+        job = BatchPredictionJob.submit(
+            source_model=self.model_name,
+            input_dataset=[store.uri(name) for name in request_names],
+            output_uri_prefix=store.uri(output_prefix),
+        )
+        print(f"Submitted batch prediction job {job.resource_name}.")
+        while not job.has_ended:
+            time.sleep(self.poll_seconds)
+            job.refresh()
+        if not job.has_succeeded:
+            raise RuntimeError(f"Batch prediction job {job.resource_name} failed: {job.error}")
+        return [name for name in store.list(store.name_of(job.output_location)) if name.endswith('.jsonl')]
+
+# Local stand-in for the batch prediction service, for offline round trips
+class LocalBatchService:
+    """
+    Play the batch prediction service locally: answer each request line with a model backend
+    (e.g. a StubModelBackend) and write result lines in the service's output format.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or StubModelBackend()
+
+    def run(self, store, request_names, output_prefix):
+        """
+        Answer every request in the request files.
+
+        Args:
+            store (FileStore): The store holding the request files.
+            request_names (list): The request file names.
+            output_prefix (str): Name prefix under which results are written.
+
+        Returns:
+            list: The names of the result files.
+        """
+        result_names = []
+        for shard, name in enumerate(request_names):
+            requests = [json.loads(line)["request"] for line in store.read(name).splitlines()]
+            result_lines = run_async(self._answer(requests))
+            result_name = f"{output_prefix}/predictions-{shard:05d}.jsonl"
+            store.write(result_name, "\n".join(result_lines) + "\n")
+            result_names.append(result_name)
+        return result_names
+
+    async def _answer(self, requests):
+        result_lines = []
+        for request in requests:
+            contents = [part.get("text", json.dumps(part)) for part in request["contents"][0]["parts"]]
+            try:
+                response = {"candidates": [{"content": {"role": "model", "parts": [
+                    {"text": (await self.backend.generate(contents)).text}
+                ]}}]}
+                status = ""
+            except Exception as e:
+                response, status = None, str(e)
+            result_lines.append(json.dumps({"status": status, "request": request, "response": response}))
+        return result_lines
+
+# Function to turn batch prediction results into Label Studio annotations
+def ingest_batch_results(store, job_name, result_names, accounts, ledger=None):
+    """
+    Parse batch prediction results and save one Label Studio annotation per successful
+    request, exactly as the online loop does. Failed or unrecoverable results are skipped,
+    so the blobs stay under-annotated and are picked up by the online loop.
+
+    Args:
+        store (FileStore): The store holding the batch files.
+        job_name (str): Name of the batch job.
+        result_names (list): The result file names.
+        accounts (list): The synthetic accounts the requests were built for.
+        ledger (BlobLedger): Optional ledger in which saved annotations are recorded.
+
+    Returns:
+        int: The number of annotations saved.
+    """
+    manifest = {}
+    for line in store.read(f"{BATCH_PREFIX}{job_name}/manifest.jsonl").splitlines():
+        entry = json.loads(line)
+        manifest[entry["request_id"]] = entry
+    saved = failed = 0
+    input_data_by_blob = {}
+    for result_name in result_names:
+        for line in store.read(result_name).splitlines():
+            if not line.strip():
+                continue
+            entry = None
+            try:
+                result = json.loads(line)
+                entry = manifest.get(result.get("request", {}).get("labels", {}).get("request_id"))
+                if entry is None:
+                    raise ValueError("Result does not match any request in the manifest.")
+                if result.get("status"):
+                    raise ValueError(result["status"])
+                response_text = result["response"]["candidates"][0]["content"]["parts"][0]["text"]
+                response_json = parse_evaluation(response_text)
+                problem = _reask_problem(response_json, None)
+                if problem is not None:
+                    # A batch result cannot be re-asked; leave the blob to the online loop
+                    PARSE_STATS['failed'] += 1
+                    raise ValueError(f"The response {problem}.")
+                blob = input_bucket.get_blob(entry["blob"])
+                if blob is None or blob.generation != entry["generation"]:
+                    raise ValueError(f"{entry['blob']} changed since the batch was prepared.")
+                if blob.name not in input_data_by_blob:
+                    input_data_by_blob.clear()  # Results for a blob are usually adjacent; keep only the last
+                    input_data_by_blob[blob.name] = json.loads(blob.download_as_bytes())
+                account = find_account(accounts, entry["persona_id"])
+                result_entries = build_annotation_result(response_json, entry["task_type"])
+                output_data = build_output_data(input_data_by_blob[blob.name], result_entries, account)
+                save_output_data(build_output_name(blob.name), output_data)
+                record_evaluation(blob, account, response_json)
+            except Exception as e:
+                # Storage errors skip only this result, as in the online loop
+                print(f"Skipping batch result {entry['request_id'] if entry else '?'}: {e}")
+                failed += 1
+                continue
+            if ledger is not None:
+                ledger.record_annotation(blob)
+            saved += 1
+    print(f"Ingested batch job {job_name}: {saved} annotations saved, {failed} results skipped.")
+    return saved
+
+# Function to backfill under-annotated blobs with one batch prediction job
+def run_batch_backfill(accounts, account_index, ledger=None, service=None, store=None, listing=None):
+    """
+    Walk the input bucket, write batch requests for every blob that needs annotations, run
+    them through the batch prediction service and ingest the results.
+
+    Args:
+        accounts (list): The synthetic accounts to rotate through.
+        account_index (int): The current position in the account rotation.
+        ledger (BlobLedger): Optional ledger of existing annotations.
+        service: The batch service (VertexBatchService by default, LocalBatchService offline).
+        store (FileStore): Where batch files are kept (the batch bucket by default).
+        listing (dict): Optional arguments for listing the input bucket, e.g. a prefix.
+
+    Returns:
+        int: The new position in the account rotation.
+    """
+    if store is None:
+        store = FileStore(local_dir=BATCH_LOCAL_DIR) if DRYRUN else \
+            FileStore(bucket=storage_client.bucket(BATCH_BUCKET_NAME))
+    service = service or VertexBatchService()
+    job_name = datetime.datetime.utcnow().strftime("backfill-%Y%m%d-%H%M%S")
+    blobs = filter_json_blobs(iter_input_blobs(**(listing or {})), ledger, RATING_AGGREGATOR)
+    request_names, account_index = write_batch_requests(store, job_name, blobs, accounts, account_index, ledger)
+    if not request_names:
+        print("No blobs need annotations; skipping the batch job.")
+        return account_index
+    result_names = service.run(store, request_names, f"{BATCH_PREFIX}{job_name}/results")
+    ingest_batch_results(store, job_name, result_names, accounts, ledger)
+    return account_index
+
+# Main script
+if __name__ == "__main__":
+    # Number of synthetic accounts to generate
+    # Adjust this number as needed to ensure manageability; only the coverage planner needs a large pool
+    num_accounts = COVERAGE_PERSONA_POOL_SIZE if COVERAGE_PLANNER_ENABLED else 5
+    print(f"Starting main script. Dryrun={DRYRUN}")
+    # Generate synthetic accounts as a pool that materializes each account when it is first used
+    accounts = generate_persona_pool(num_accounts)
+    if not EMBED_PERSONA_IN_OUTPUT:
+        write_persona_catalog(accounts)
+    report_persona_rendering_savings(accounts)
+    if RATINGS_EXPORTER is not None:
+        RATINGS_EXPORTER.register_pool(accounts)
+    if COVERAGE_PLANNER_ENABLED:
+        # Dry runs do not upload anything, so their coverage is only tracked in memory
+        COVERAGE_PLANNER = CoveragePlanner(accounts, ':memory:' if DRYRUN else COVERAGE_INDEX_PATH)
+    account_index = 0  # Start from the first account
+    # Dry runs do not upload anything, so they do not count towards the ledger
+    # With early stopping, items whose personas disagree keep being evaluated up to MAX_EVALUATIONS_PER_ITEM.
+    # Blobs annotated before the aggregator existed are counted by the ledger, so they are not re-queued
+    ledger = None if DRYRUN else BlobLedger(
+        annotations_per_blob=MAX_EVALUATIONS_PER_ITEM if EARLY_STOPPING_ENABLED else ANNOTATIONS_PER_BLOB
+    )
+    if BATCH_MODE:
+        # Backfill the existing backlog in one batch job; the online loop then handles new files
+        account_index = run_batch_backfill(accounts, account_index, ledger)
+
+    # Buffered output shards and ratings rows are written out when the loop is interrupted
+    try:
+        while True:
+            print("Checking for JSON files in the input bucket...")
+            # List all JSON files in the input bucket
+            if DRYRUN:
+              listing = {'prefix': 'response-feedback-English/', 'max_results': 100}
+            else:
+              listing = {}
+            if STREAMING_INGESTION:
+                # Stream the listing through a bounded shuffle buffer so work starts after the first page
+                json_blobs = shuffle_stream(filter_json_blobs(iter_input_blobs(**listing), ledger, RATING_AGGREGATOR))
+                print(f"Streaming input files through a shuffle buffer of {SHUFFLE_BUFFER_SIZE}.")
+            else:
+                json_blobs = list(filter_json_blobs(input_bucket.list_blobs(**listing), ledger, RATING_AGGREGATOR))
+                # Randomize the order of the JSON blobs
+                random.shuffle(json_blobs)
+                print("Randomized the order of input files.")
+
+            previous_account_index = account_index
+            # With PIPELINE_CONCURRENCY = 1 the pipeline evaluates one blob at a time, like a serial loop
+            account_index = run_async(run_pipeline(json_blobs, accounts, account_index, ledger,
+                                                   concurrency=PIPELINE_CONCURRENCY))
+            if OUTPUT_SINK is not None:
+                OUTPUT_SINK.flush()
+                OUTPUT_SINK.report()
+            if RATINGS_EXPORTER is not None:
+                RATINGS_EXPORTER.flush()
+                RATINGS_EXPORTER.report()
+            if RATING_AGGREGATOR is not None:
+                RATING_AGGREGATOR.report()
+            if COVERAGE_PLANNER is not None:
+                COVERAGE_PLANNER.report()
+            if DUPLICATE_INDEX is not None:
+                DUPLICATE_INDEX.report()
+            if account_index == previous_account_index:
+                print("No new or under-annotated JSON files found in the input bucket. Waiting for new files...")
+                time.sleep(60)  # Wait for 1 minute before checking again
+                continue
+            if RESPONSE_CACHE is not None:
+                RESPONSE_CACHE.report()
+            if SCRAPE_CACHE is not None:
+                SCRAPE_CACHE.report()
+            if IMAGE_CACHE is not None:
+                IMAGE_CACHE.report()
+            report_compaction()
+            report_parsing()
+            if CONTEXT_CACHE is not None:
+                CONTEXT_CACHE.report()
+            MODEL_RATE_CONTROLLER.report()
+            if REQUEST_HEDGER is not None:
+                REQUEST_HEDGER.report()
+            if MODEL_CASCADE is not None:
+                MODEL_CASCADE.report()
+            # Sleep for a short while before checking for new files
+            print("Sleeping for 10 seconds before checking for new files...")
+            time.sleep(10)
+    finally:
+        if OUTPUT_SINK is not None:
+            OUTPUT_SINK.flush()
+        if RATINGS_EXPORTER is not None:
+            RATINGS_EXPORTER.flush()